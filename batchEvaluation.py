@@ -0,0 +1,240 @@
+""" Evaluation of many positions at once with NumPy.
+Positions are encoded as an N x 64 int8 array of piece codes (white
+positive, black negative, 0 empty) and scored together, so the cost per
+position is a few array operations shared by the whole batch instead of a
+Python loop over the squares. Besides the material and piece-square terms
+of evaluation.py it scores pseudo-legal mobility of the minor and major
+pieces and pawn structure (doubled, isolated and passed pawns).
+
+A standalone experiment: the search does not use it. Its extra terms
+would give a leaf a different score than the incremental evaluation the
+search uses for stand pat, futility and null move decisions, and a batch
+costs more than scoring positions one by one incrementally. NumPy is
+optional, everything else in the engine runs without it.
+
+    python batchEvaluation.py --positions 20000 --batch 1 16 256
+"""
+
+import argparse
+import random
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:  # batch evaluation is unavailable, the engine still works
+    np = None
+
+import chessEngine
+import evaluation
+from evaluation import MAX_PHASE
+
+available = np is not None
+
+PIECE_CODES = {"--": 0, "wp": 1, "wN": 2, "wB": 3, "wR": 4, "wQ": 5, "wK": 6,
+               "bp": -1, "bN": -2, "bB": -3, "bR": -4, "bQ": -5, "bK": -6}
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN = 1, 2, 3, 4, 5
+
+MOBILITY = True
+PAWN_STRUCTURE = True
+# (midgame, endgame) centipawns per square a piece reaches
+MOBILITY_WEIGHTS = {KNIGHT: (4, 4), BISHOP: (5, 5), ROOK: (2, 4), QUEEN: (1, 2)}
+MOBILITY_MOVES = {KNIGHT: (chessEngine.KNIGHT_DIRECTIONS, False),
+                  BISHOP: (chessEngine.DIAGONAL_DIRECTIONS, True),
+                  ROOK: (chessEngine.ORTHOGONAL_DIRECTIONS, True),
+                  QUEEN: (chessEngine.KING_DIRECTIONS, True)}
+DOUBLED_PAWN = (-10, -20)
+ISOLATED_PAWN = (-10, -15)
+# bonus of a passed pawn by row, from the point of view of its own side
+PASSED_PAWN_MG = [0, 60, 40, 25, 15, 10, 5, 0]
+PASSED_PAWN_EG = [0, 120, 80, 50, 30, 15, 10, 0]
+
+
+def buildTables():
+    # rows indexed by piece code + 6
+    mgTable = np.zeros((13, 64), dtype=np.int32)
+    egTable = np.zeros((13, 64), dtype=np.int32)
+    phaseTable = np.zeros(13, dtype=np.int32)
+    charCodes = np.zeros((128, 128), dtype=np.int8)
+    for piece, code in PIECE_CODES.items():
+        charCodes[ord(piece[0]), ord(piece[1])] = code
+        if code:
+            mgTable[code + 6] = evaluation.MG_SCORES[piece]
+            egTable[code + 6] = evaluation.EG_SCORES[piece]
+            phaseTable[code + 6] = evaluation.phaseWeight[piece[1]]
+    return mgTable, egTable, phaseTable, charCodes
+
+
+if available:
+    MG_TABLE, EG_TABLE, PHASE_TABLE, CHAR_CODES = buildTables()
+    SQUARES = np.arange(64)
+    PASSED_MG = np.array(PASSED_PAWN_MG, dtype=np.int32)[:, None]
+    PASSED_EG = np.array(PASSED_PAWN_EG, dtype=np.int32)[:, None]
+
+
+""" The board as one string of 128 characters, a cheap copy to encode later """
+
+
+def snapshot(board):
+    return "".join(map("".join, board))
+
+
+""" N x 64 int8 piece codes of a list of snapshots """
+
+
+def encodeSnapshots(snapshots):
+    data = np.frombuffer("".join(snapshots).encode("ascii"), dtype=np.uint8).reshape(-1, 64, 2)
+    return CHAR_CODES[data[:, :, 0], data[:, :, 1]]
+
+
+def encodeBoards(boards):
+    return encodeSnapshots([snapshot(board) for board in boards])
+
+
+""" Scores in centipawns from white's point of view of N x 64 piece codes """
+
+
+def scorePositions(codes):
+    if not available:
+        raise RuntimeError("batch evaluation needs numpy")
+    codes = np.asarray(codes, dtype=np.int8).reshape(-1, 64)
+    rows = codes.astype(np.intp) + 6
+    mgScore = MG_TABLE[rows, SQUARES].sum(axis=1)
+    egScore = EG_TABLE[rows, SQUARES].sum(axis=1)
+    phase = np.minimum(PHASE_TABLE[rows].sum(axis=1), MAX_PHASE)
+    boards = codes.reshape(-1, 8, 8)
+    if MOBILITY:
+        mgTerm, egTerm = mobilityTerms(boards)
+        mgScore += mgTerm
+        egScore += egTerm
+    if PAWN_STRUCTURE:
+        mgTerm, egTerm = pawnTerms(boards)
+        mgScore += mgTerm
+        egScore += egTerm
+    return (mgScore*phase + egScore*(MAX_PHASE - phase)) // MAX_PHASE
+
+
+def scoreSnapshots(snapshots):
+    return scorePositions(encodeSnapshots(snapshots))
+
+
+def scoreBoards(boards):
+    return scorePositions(encodeBoards(boards))
+
+
+""" N x 8 x 8 masks moved dr rows and dc columns, squares moved off the
+board are dropped """
+
+
+def shift(mask, dr, dc):
+    moved = np.zeros_like(mask)
+    moved[:, max(dr, 0):8 + min(dr, 0), max(dc, 0):8 + min(dc, 0)] = \
+        mask[:, max(-dr, 0):8 + min(-dr, 0), max(-dc, 0):8 + min(-dc, 0)]
+    return moved
+
+
+""" Midgame and endgame mobility, white's minus black's. Counts the empty
+or enemy squares each piece reaches ignoring pins and checks. Rays of
+pieces of one type can't overlap, the nearer piece blocks the other """
+
+
+def mobilityTerms(boards):
+    empty = boards == 0
+    mgTerm = np.zeros(len(boards), dtype=np.int32)
+    egTerm = np.zeros(len(boards), dtype=np.int32)
+    for sign, own in ((1, boards > 0), (-1, boards < 0)):
+        for pieceType, (directions, slides) in MOBILITY_MOVES.items():
+            pieces = boards == sign*pieceType
+            if not pieces.any():
+                continue
+            reach = np.zeros(len(boards), dtype=np.int32)
+            for dr, dc in directions:
+                ray = pieces
+                for _ in range(7 if slides else 1):
+                    ray = shift(ray, dr, dc)
+                    reach += (ray & ~own).sum(axis=(1, 2))
+                    ray = ray & empty
+                    if not ray.any():
+                        break
+            mgWeight, egWeight = MOBILITY_WEIGHTS[pieceType]
+            mgTerm += sign*mgWeight*reach
+            egTerm += sign*egWeight*reach
+    return mgTerm, egTerm
+
+
+""" Midgame and endgame pawn structure, white's minus black's. Black's
+boards are flipped so both sides push their pawns towards row 0 """
+
+
+def pawnTerms(boards):
+    whitePawns = boards == PAWN
+    blackPawns = boards == -PAWN
+    mgWhite, egWhite = sidePawnTerms(whitePawns, blackPawns)
+    mgBlack, egBlack = sidePawnTerms(blackPawns[:, ::-1], whitePawns[:, ::-1])
+    return mgWhite - mgBlack, egWhite - egBlack
+
+
+def sidePawnTerms(own, enemy):
+    files = own.sum(axis=1)  # pawns per file
+    doubled = np.maximum(files - 1, 0).sum(axis=1)
+    occupied = files > 0
+    neighbours = np.zeros_like(occupied)
+    neighbours[:, 1:] |= occupied[:, :-1]
+    neighbours[:, :-1] |= occupied[:, 1:]
+    isolated = (files * ~neighbours).sum(axis=1)
+    # enemy pawns on the same file in front of each square, then the
+    # neighbouring files as well
+    ahead = np.zeros_like(enemy)
+    ahead[:, 1:] = np.logical_or.accumulate(enemy, axis=1)[:, :-1]
+    blocked = ahead | shift(ahead, 0, 1) | shift(ahead, 0, -1)
+    passed = own & ~blocked
+    mgTerm = doubled*DOUBLED_PAWN[0] + isolated*ISOLATED_PAWN[0] + (passed*PASSED_MG).sum(axis=(1, 2))
+    egTerm = doubled*DOUBLED_PAWN[1] + isolated*ISOLATED_PAWN[1] + (passed*PASSED_EG).sum(axis=(1, 2))
+    return mgTerm, egTerm
+
+
+""" Snapshots of the positions met in random games from the start """
+
+
+def randomPositions(count, seed=1):
+    rng = random.Random(seed)
+    gs = chessEngine.GameState()
+    positions = []
+    while len(positions) < count:
+        validMoves = gs.getValidMoves()
+        if not validMoves or len(gs.moveLog) >= 120:
+            gs = chessEngine.GameState()
+            continue
+        gs.makeMove(rng.choice(validMoves))
+        positions.append(snapshot(gs.board))
+    return positions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure batch evaluation throughput")
+    parser.add_argument("--positions", type=int, default=20000)
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 16, 256, 4096])
+    args = parser.parse_args(argv)
+    if not available:
+        print("numpy is not installed")
+        return 1
+
+    positions = randomPositions(args.positions)
+    boards = [[[position[i:i+2] for i in range(row*16, row*16 + 16, 2)] for row in range(8)]
+              for position in positions]
+    start = time.time()
+    for board in boards:
+        evaluation.scoreBoard(board)
+    elapsed = time.time() - start
+    print("scoreBoard   %8d positions/s" % (len(boards) / elapsed))
+    for size in args.batch:
+        start = time.time()
+        for first in range(0, len(positions), size):
+            scoreSnapshots(positions[first:first + size])
+        elapsed = time.time() - start
+        print("batch %-6d %8d positions/s" % (size, len(positions) / elapsed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,374 @@
+""" Bitboard backed game state.
+Keeps one 64 bit integer per piece type plus occupancy sets alongside the
+string board, so move generation works on bit sets while the UI keeps
+reading gs.board. Square index is row*8+col, row 0 being black's back rank.
+
+This is a perft experiment, not a backend the engine plays with: the
+search, uci.py and chessMain.py all use chessEngine.GameState. It still
+keeps the string board in sync and builds a Move for every move, so it is
+only about 1.3 times faster than the mailbox generator in perft. perft.py
+runs its suite on both to keep them in step. The attack tables below are
+also used by tablebase.py. """
+
+from chessEngine import GameState, Move, SQUARES
+
+PIECES = ("wp", "wN", "wB", "wR", "wQ", "wK",
+          "bp", "bN", "bB", "bR", "bQ", "bK")
+
+KNIGHT_OFFSETS = ((2, 1), (2, -1), (-2, 1), (-2, -1),
+                  (1, 2), (1, -2), (-1, 2), (-1, -2))
+KING_OFFSETS = ((1, 1), (-1, 1), (1, -1), (-1, -1),
+                (0, 1), (1, 0), (-1, 0), (0, -1))
+ROOK_DIRECTIONS = ((-1, 0), (0, -1), (1, 0), (0, 1))
+BISHOP_DIRECTIONS = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+
+
+def buildLeaperTable(offsets):
+    table = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        bits = 0
+        for dr, dc in offsets:
+            if 0 <= r+dr < 8 and 0 <= c+dc < 8:
+                bits |= 1 << ((r+dr)*8 + c+dc)
+        table.append(bits)
+    return table
+
+
+def buildRayTable(d):
+    table = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        bits = 0
+        r, c = r+d[0], c+d[1]
+        while 0 <= r < 8 and 0 <= c < 8:
+            bits |= 1 << (r*8 + c)
+            r, c = r+d[0], c+d[1]
+        table.append(bits)
+    return table
+
+
+KNIGHT_ATTACKS = buildLeaperTable(KNIGHT_OFFSETS)
+KING_ATTACKS = buildLeaperTable(KING_OFFSETS)
+# white pawns attack towards row 0, black pawns towards row 7
+PAWN_ATTACKS = {'w': buildLeaperTable(((-1, -1), (-1, 1))),
+                'b': buildLeaperTable(((1, -1), (1, 1)))}
+# (ray table, True if the ray runs towards higher square indexes)
+ROOK_RAYS = [(buildRayTable(d), d[0]*8 + d[1] > 0) for d in ROOK_DIRECTIONS]
+BISHOP_RAYS = [(buildRayTable(d), d[0]*8 + d[1] > 0)
+               for d in BISHOP_DIRECTIONS]
+
+
+def buildBetweenTable():
+    # squares strictly between two squares sharing a line, 0 otherwise
+    table = [[0]*64 for _ in range(64)]
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        for d in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+            bits = 0
+            endRow, endCol = r+d[0], c+d[1]
+            while 0 <= endRow < 8 and 0 <= endCol < 8:
+                table[sq][endRow*8 + endCol] = bits
+                bits |= 1 << (endRow*8 + endCol)
+                endRow, endCol = endRow+d[0], endCol+d[1]
+    return table
+
+
+BETWEEN = buildBetweenTable()
+
+
+def slidingAttacks(sq, occupancy, rays):
+    attacks = 0
+    for table, positive in rays:
+        ray = table[sq]
+        blockers = ray & occupancy
+        if blockers:
+            if positive:  # nearest blocker is the lowest set bit
+                blocker = (blockers & -blockers).bit_length() - 1
+            else:  # nearest blocker is the highest set bit
+                blocker = blockers.bit_length() - 1
+            ray ^= table[blocker]
+        attacks |= ray
+    return attacks
+
+
+def rookAttacks(sq, occupancy):
+    return slidingAttacks(sq, occupancy, ROOK_RAYS)
+
+
+def bishopAttacks(sq, occupancy):
+    return slidingAttacks(sq, occupancy, BISHOP_RAYS)
+
+
+def iterBits(bits):
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+class BitboardGameState(GameState):
+    def resetHistory(self):
+        super().resetHistory()
+        self.syncBitboards()
+
+    """
+    Rebuild every bitboard from the string board
+    """
+
+    def syncBitboards(self):
+        self.pieceBitboards = {piece: 0 for piece in PIECES}
+        self.occupancy = {'w': 0, 'b': 0}
+        for r in range(8):
+            for c in range(8):
+                piece = self.board[r][c]
+                if piece != "--":
+                    self.pieceBitboards[piece] |= 1 << (r*8 + c)
+                    self.occupancy[piece[0]] |= 1 << (r*8 + c)
+
+    def makeMove(self, move):
+        super().makeMove(move)
+        self.toggleMoveBitboards(move)
+
+    def undoMove(self):
+        if len(self.moveLog) != 0:
+            move = self.moveLog[-1]
+            super().undoMove()
+            self.toggleMoveBitboards(move)
+
+    """
+    Flip the bits a move touches. Applying it twice restores the
+    bitboards, so the same function makes and undoes a move
+    """
+
+    def toggleMoveBitboards(self, move):
+        bitboards = self.pieceBitboards
+        color = move.pieceMoved[0]
+        enemyColor = 'b' if color == 'w' else 'w'
+        fromBit = 1 << (move.startRow*8 + move.startCol)
+        toBit = 1 << (move.endRow*8 + move.endCol)
+        if move.isPawnPromotion:
+            bitboards[move.pieceMoved] ^= fromBit
+            bitboards[color + move.promotionPiece] ^= toBit
+        else:
+            bitboards[move.pieceMoved] ^= fromBit | toBit
+        self.occupancy[color] ^= fromBit | toBit
+        if move.pieceCaptured != "--":
+            if move.isEnpassantMove:
+                captureBit = 1 << (move.startRow*8 + move.endCol)
+            else:
+                captureBit = toBit
+            bitboards[move.pieceCaptured] ^= captureBit
+            self.occupancy[enemyColor] ^= captureBit
+        if move.isCastleMove:
+            rowBase = move.endRow*8
+            if move.endCol-move.startCol == 2:  # king side castle
+                rookBits = (1 << (rowBase + 7)) | (1 << (rowBase + 5))
+            else:  # queen side castle
+                rookBits = (1 << rowBase) | (1 << (rowBase + 3))
+            bitboards[color + 'R'] ^= rookBits
+            self.occupancy[color] ^= rookBits
+
+    """
+    Determine if any piece of attackerColor attacks square sq given the
+    occupancy, which lets callers look through a piece that is moving
+    """
+
+    def isSquareAttacked(self, sq, attackerColor, occupancy):
+        bitboards = self.pieceBitboards
+        defenderColor = 'b' if attackerColor == 'w' else 'w'
+        if KNIGHT_ATTACKS[sq] & bitboards[attackerColor + 'N']:
+            return True
+        if PAWN_ATTACKS[defenderColor][sq] & bitboards[attackerColor + 'p']:
+            return True
+        if KING_ATTACKS[sq] & bitboards[attackerColor + 'K']:
+            return True
+        queens = bitboards[attackerColor + 'Q']
+        if rookAttacks(sq, occupancy) & (bitboards[attackerColor + 'R'] | queens):
+            return True
+        if bishopAttacks(sq, occupancy) & (bitboards[attackerColor + 'B'] | queens):
+            return True
+        return False
+
+    """
+    Bitboard of the pieces of attackerColor attacking square sq
+    """
+
+    def attackersBitboard(self, sq, attackerColor, occupancy):
+        bitboards = self.pieceBitboards
+        defenderColor = 'b' if attackerColor == 'w' else 'w'
+        queens = bitboards[attackerColor + 'Q']
+        return ((KNIGHT_ATTACKS[sq] & bitboards[attackerColor + 'N']) |
+                (PAWN_ATTACKS[defenderColor][sq] & bitboards[attackerColor + 'p']) |
+                (KING_ATTACKS[sq] & bitboards[attackerColor + 'K']) |
+                (rookAttacks(sq, occupancy) & (bitboards[attackerColor + 'R'] | queens)) |
+                (bishopAttacks(sq, occupancy) & (bitboards[attackerColor + 'B'] | queens)))
+
+    def squareUnderAttack(self, r, c):
+        enemyColor = 'b' if self.whiteToMove else 'w'
+        return self.isSquareAttacked(r*8 + c, enemyColor, self.occupancy['w'] | self.occupancy['b'])
+
+    def inCheck(self):
+        allyColor = 'w' if self.whiteToMove else 'b'
+        kingSq = self.pieceBitboards[allyColor + 'K'].bit_length() - 1
+        return self.isSquareAttacked(kingSq, 'b' if self.whiteToMove else 'w',
+                                     self.occupancy['w'] | self.occupancy['b'])
+
+    """
+    All moves considering checks, generated from bit sets.
+    Pinned pieces are restricted to the line between king and pinner and
+    single checks restrict every other piece to capturing or blocking
+    """
+
+    def getValidMoves(self):
+        if self.referenceMoveGen:
+            return self.getValidMovesReference()
+        pinsAndChecks = self.getPinsAndChecks()
+        moves = self.getLegalMoves(pinsAndChecks)
+        self.updateEndState(moves, pinsAndChecks[0])
+        return moves
+
+    """
+    (inCheck, checkers, squares non king pieces may move to, pinned piece
+    square -> squares it may still move to). Used by every generator
+    GameState builds on it: getCaptureMoves, getQuietMoves, getLegalMove
+    """
+
+    def getPinsAndChecks(self):
+        bitboards = self.pieceBitboards
+        allyColor, enemyColor = ('w', 'b') if self.whiteToMove else ('b', 'w')
+        ally = self.occupancy[allyColor]
+        enemy = self.occupancy[enemyColor]
+        occupancy = ally | enemy
+        kingSq = bitboards[allyColor + 'K'].bit_length() - 1
+
+        checkers = self.attackersBitboard(kingSq, enemyColor, occupancy)
+        evasionMask = ~0
+        if checkers:
+            checkerSq = checkers.bit_length() - 1
+            evasionMask = BETWEEN[kingSq][checkerSq] | checkers
+
+        pinMasks = {}
+        enemyQueens = bitboards[enemyColor + 'Q']
+        snipers = ((rookAttacks(kingSq, enemy) & (bitboards[enemyColor + 'R'] | enemyQueens)) |
+                   (bishopAttacks(kingSq, enemy) & (bitboards[enemyColor + 'B'] | enemyQueens)))
+        for sniperSq in iterBits(snipers):
+            between = BETWEEN[kingSq][sniperSq] & occupancy
+            if between and between & (between-1) == 0 and between & ally:
+                pinMasks[between.bit_length() - 1] = BETWEEN[kingSq][sniperSq] | (1 << sniperSq)
+        return checkers != 0, checkers, evasionMask, pinMasks
+
+    """
+    Legal moves from getPinsAndChecks, leaving out the captures and
+    promotions or the quiet moves if asked. squares limits the pieces
+    that move, castling is added separately
+    """
+
+    def getLegalMoves(self, pinsAndChecks, captures=True, quiets=True, squares=SQUARES, castling=True):
+        inCheck, checkers, evasionMask, pinMasks = pinsAndChecks
+        bitboards = self.pieceBitboards
+        allyColor, enemyColor = ('w', 'b') if self.whiteToMove else ('b', 'w')
+        ally = self.occupancy[allyColor]
+        enemy = self.occupancy[enemyColor]
+        occupancy = ally | enemy
+        kingSq = bitboards[allyColor + 'K'].bit_length() - 1
+        fromMask = ~0
+        if squares is not SQUARES:
+            fromMask = 0
+            for r, c in squares:
+                fromMask |= 1 << (r*8 + c)
+        if not captures:
+            targets = ~occupancy
+        elif not quiets:
+            targets = enemy
+        else:
+            targets = ~ally
+
+        moves = []
+        board = self.board
+        kingRow, kingCol = divmod(kingSq, 8)
+        if (fromMask >> kingSq) & 1:
+            self.addKingMoves(kingSq, KING_ATTACKS[kingSq] & targets, moves)
+
+        # with two checkers only the king can move
+        if checkers & (checkers-1) == 0:
+            pieceTargets = targets & evasionMask
+            for pieceType, attacksFor in (('N', None), ('B', bishopAttacks),
+                                          ('R', rookAttacks), ('Q', None)):
+                for fromSq in iterBits(bitboards[allyColor + pieceType] & fromMask):
+                    if pieceType == 'N':
+                        if fromSq in pinMasks:
+                            continue  # a pinned knight can never move
+                        attacks = KNIGHT_ATTACKS[fromSq]
+                    elif pieceType == 'Q':
+                        attacks = rookAttacks(fromSq, occupancy) | bishopAttacks(fromSq, occupancy)
+                    else:
+                        attacks = attacksFor(fromSq, occupancy)
+                    attacks &= pieceTargets & pinMasks.get(fromSq, ~0)
+                    fromRC = divmod(fromSq, 8)
+                    for toSq in iterBits(attacks):
+                        moves.append(Move(fromRC, divmod(toSq, 8), board))
+            self.getBitboardPawnMoves(allyColor, enemy, occupancy, evasionMask, pinMasks, moves,
+                                      fromMask, captures, quiets)
+            if castling and quiets and not inCheck:
+                self.getCastleMoves(kingRow, kingCol, moves)
+        return moves
+
+    """
+    King moves from kingSq to the squares in targets that are not
+    attacked, looking through the king's own square so it can't step
+    back along the line of a checking slider
+    """
+
+    def addKingMoves(self, kingSq, targets, moves):
+        enemyColor = 'b' if self.whiteToMove else 'w'
+        occupancyWithoutKing = (self.occupancy['w'] | self.occupancy['b']) ^ (1 << kingSq)
+        kingRC = divmod(kingSq, 8)
+        for toSq in iterBits(targets):
+            if not self.isSquareAttacked(toSq, enemyColor, occupancyWithoutKing):
+                moves.append(Move(kingRC, divmod(toSq, 8), self.board))
+
+    def getLegalKingMoves(self, r, c, moves, capturesOnly=False):
+        allyColor, enemyColor = ('w', 'b') if self.whiteToMove else ('b', 'w')
+        targets = self.occupancy[enemyColor] if capturesOnly else ~self.occupancy[allyColor]
+        self.addKingMoves(r*8 + c, KING_ATTACKS[r*8 + c] & targets, moves)
+
+    """
+    Pawn moves; captures (en passant included) and promotions count as
+    captures, the other pushes as quiet moves
+    """
+
+    def getBitboardPawnMoves(self, allyColor, enemy, occupancy, evasionMask, pinMasks, moves,
+                             fromMask=~0, captures=True, quiets=True):
+        board = self.board
+        forward = -8 if allyColor == 'w' else 8
+        startRow = 6 if allyColor == 'w' else 1
+        promotionRow = 1 if allyColor == 'w' else 6  # one step from promoting
+        epSq = None
+        if captures and self.enpassantPossible != ():
+            epSq = self.enpassantPossible[0]*8 + self.enpassantPossible[1]
+        for fromSq in iterBits(self.pieceBitboards[allyColor + 'p'] & fromMask):
+            firstMove = len(moves)
+            fromRC = divmod(fromSq, 8)
+            promoting = fromRC[0] == promotionRow
+            allowed = evasionMask & pinMasks.get(fromSq, ~0)
+            oneStep = fromSq + forward
+            if not (occupancy >> oneStep) & 1 and (captures if promoting else quiets):
+                if (allowed >> oneStep) & 1:
+                    moves.append(Move(fromRC, divmod(oneStep, 8), board))
+                twoStep = oneStep + forward
+                if fromRC[0] == startRow and not (occupancy >> twoStep) & 1 and (allowed >> twoStep) & 1:
+                    moves.append(Move(fromRC, divmod(twoStep, 8), board))
+            if not captures:
+                continue
+            attacks = PAWN_ATTACKS[allyColor][fromSq]
+            for toSq in iterBits(attacks & enemy & allowed):
+                moves.append(Move(fromRC, divmod(toSq, 8), board))
+            if epSq is not None and (attacks >> epSq) & 1:
+                move = Move(fromRC, divmod(epSq, 8), board, isEnpassantMove=True)
+                # removing two pawns from one rank can expose the king, so
+                # play the capture out instead of trusting the masks
+                if self.isEnpassantLegal(move):
+                    moves.append(move)
+            if promoting:
+                self.addUnderPromotions(moves, firstMove)
@@ -1,6 +1,43 @@
 """ Stores all the information about the current state of the game,
 determines valid moves, keeps a move log. """
 
+import random
+from array import array
+import evaluation
+
+# zobrist keys, generated from a fixed seed so hashes are stable between runs
+zobristRandom = random.Random(20201)
+ZOBRIST_PIECES = {piece: [zobristRandom.getrandbits(64) for _ in range(64)]
+                  for piece in ("wp", "wN", "wB", "wR", "wQ", "wK",
+                                "bp", "bN", "bB", "bR", "bQ", "bK")}
+ZOBRIST_BLACK_TO_MOVE = zobristRandom.getrandbits(64)
+# indexed by the 4 bit castling mask
+ZOBRIST_CASTLING = [zobristRandom.getrandbits(64) for _ in range(16)]
+ZOBRIST_ENPASSANT_FILE = [zobristRandom.getrandbits(64) for _ in range(8)]
+
+# castling right bits of GameState.castleRights
+WKS, BKS, WQS, BQS = 1, 2, 4, 8
+# rights that survive a move starting or ending on a square: moving the
+# king or a rook, or capturing a rook on its home square, clears them
+CASTLING_KEEP = [WKS | BKS | WQS | BQS] * 64
+CASTLING_KEEP[7*8 + 4] &= ~(WKS | WQS)
+CASTLING_KEEP[7*8 + 7] &= ~WKS
+CASTLING_KEEP[7*8 + 0] &= ~WQS
+CASTLING_KEEP[0*8 + 4] &= ~(BKS | BQS)
+CASTLING_KEEP[0*8 + 7] &= ~BKS
+CASTLING_KEEP[0*8 + 0] &= ~BQS
+
+# square index -> (row, col), so restoring a square allocates nothing
+SQUARES = [divmod(sq, 8) for sq in range(64)]
+
+# undo records preallocated per game, doubled if a game runs longer
+MAX_PLY = 1024
+
+ORTHOGONAL_DIRECTIONS = ((-1, 0), (0, -1), (1, 0), (0, 1))
+DIAGONAL_DIRECTIONS = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+KING_DIRECTIONS = ORTHOGONAL_DIRECTIONS + DIAGONAL_DIRECTIONS
+KNIGHT_DIRECTIONS = ((2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2))
+
 
 class GameState():
     def __init__(self):
@@ -23,35 +60,277 @@ class GameState():
                               'Q': self.getQueenMoves, 'K': self.getKingMoves
                               }
         self.whiteToMove = True
-        self.moveLog = []
         self.whiteKingLocation = (7, 4)
         self.blackKingLocation = (0, 4)
-        self.checkMate = False
-        self.staleMate = False
         # coordinates where the enpassant square capture is possible
         self.enpassantPossible = ()
-        # castling rights
-        self.currentCastlingRight = CastleRights(True, True, True, True)
-        self.castleRightLog = [CastleRights(self.currentCastlingRight.wks, self.currentCastlingRight.bks,
-                                            self.currentCastlingRight.wqs, self.currentCastlingRight.bqs)]
+        # castling rights as a 4 bit mask of WKS, BKS, WQS and BQS
+        self.castleRights = WKS | BKS | WQS | BQS
+        # half moves since the last capture or pawn move (50 move rule)
+        self.halfmoveClock = 0
+        self.startFullmoveNumber = 1
+        self.resetHistory()
+        # use the original make/undo based generator to cross check moves
+        self.referenceMoveGen = False
+
+    """
+    Start the logs and the incremental state from the current position.
+    Called when a position is set up rather than reached by moves
+    """
+
+    def resetHistory(self):
+        self.moveLog = []
+        self.checkMate = False
+        self.staleMate = False
+        # the fullmove number is counted from the set up position
+        self.startWhiteToMove = self.whiteToMove
+        # moves are played from this position, see serialize
+        self.startFen = self.getFen()
+        # 64 bit zobrist key of the position, with counts of the keys on
+        # the undo stack so repetitions are found without a scan
+        self.zobristKey = self.computeZobristKey()
+        self.repetitionCounts = {self.zobristKey: 1}
+        # undo stack, entry i describes the position after i moves:
+        # undoStates holds castling (4 bits) | en passant square + 1 (7) |
+        # halfmove clock, undoKeys the zobrist key. Make and undo only
+        # overwrite entries, they never allocate new records
+        self.undoStates = array('L', [0]) * MAX_PLY
+        self.undoKeys = array('Q', [0]) * MAX_PLY
+        self.undoStates[0] = self.packUndoState()
+        self.undoKeys[0] = self.zobristKey
+        # incrementally updated evaluation terms, see evaluation.py
+        self.mgScore, self.egScore, self.phase = evaluation.boardTerms(self.board)
+
+    """
+    Set up the position described by a FEN string
+    """
+
+    def loadFen(self, fen):
+        fields = fen.split()
+        if len(fields) < 2:
+            raise ValueError("FEN needs at least piece placement and side to move: " + fen)
+        rows = fields[0].split('/')
+        if len(rows) != 8:
+            raise ValueError("FEN piece placement needs 8 ranks: " + fen)
+        board = []
+        kings = {'w': [], 'b': []}
+        for r, rowText in enumerate(rows):
+            row = []
+            for char in rowText:
+                if char.isdigit():
+                    row.extend(["--"] * int(char))
+                elif char.upper() in "KQRBNP":
+                    color = 'w' if char.isupper() else 'b'
+                    pieceType = 'p' if char.upper() == 'P' else char.upper()
+                    if pieceType == 'p' and r in (0, 7):
+                        raise ValueError("FEN has a pawn on the first or last rank: " + fen)
+                    if pieceType == 'K':
+                        kings[color].append((r, len(row)))
+                    row.append(color + pieceType)
+                else:
+                    raise ValueError("bad FEN piece " + repr(char) + ": " + fen)
+            if len(row) != 8:
+                raise ValueError("FEN rank does not have 8 squares: " + fen)
+            board.append(row)
+        if len(kings['w']) != 1 or len(kings['b']) != 1:
+            raise ValueError("FEN needs exactly one king per side: " + fen)
+        if fields[1] not in ('w', 'b'):
+            raise ValueError("FEN side to move must be w or b: " + fen)
+        enpassant = fields[3] if len(fields) > 3 else '-'
+        # the square behind a pawn that just moved two, rank 6 with white to move
+        if enpassant != '-' and (len(enpassant) != 2 or enpassant[0] not in Move.filesToCols or
+                                 enpassant[1] != ('6' if fields[1] == 'w' else '3')):
+            raise ValueError("bad FEN en passant square " + repr(enpassant) + ": " + fen)
+        halfmoveClock = int(fields[4]) if len(fields) > 4 else 0
+        startFullmoveNumber = int(fields[5]) if len(fields) > 5 else 1
+        # the side that just moved can't have left its king in check
+        kingRow, kingCol = kings['b' if fields[1] == 'w' else 'w'][0]
+        previousBoard, self.board = self.board, board
+        if self.attackersOfSquare(kingRow, kingCol, fields[1], stopAtFirst=True):
+            self.board = previousBoard
+            raise ValueError("FEN side not to move is in check: " + fen)
+        self.whiteKingLocation = kings['w'][0]
+        self.blackKingLocation = kings['b'][0]
+        self.whiteToMove = fields[1] == 'w'
+        castling = fields[2] if len(fields) > 2 else '-'
+        # rights whose king or rook has left its home square are dropped
+        self.castleRights = (('K' in castling and board[7][4] == "wK" and board[7][7] == "wR") * WKS |
+                             ('k' in castling and board[0][4] == "bK" and board[0][7] == "bR") * BKS |
+                             ('Q' in castling and board[7][4] == "wK" and board[7][0] == "wR") * WQS |
+                             ('q' in castling and board[0][4] == "bK" and board[0][0] == "bR") * BQS)
+        if enpassant == '-':
+            self.enpassantPossible = ()
+        else:
+            self.enpassantPossible = (Move.ranksToRows[enpassant[1]], Move.filesToCols[enpassant[0]])
+        self.halfmoveClock = halfmoveClock
+        self.startFullmoveNumber = startFullmoveNumber
+        self.resetHistory()
+
+    """
+    FEN string of the current position
+    """
+
+    def getFen(self):
+        rows = []
+        for row in self.board:
+            rowText = ""
+            empty = 0
+            for piece in row:
+                if piece == "--":
+                    empty += 1
+                    continue
+                if empty:
+                    rowText += str(empty)
+                    empty = 0
+                letter = 'P' if piece[1] == 'p' else piece[1]
+                rowText += letter if piece[0] == 'w' else letter.lower()
+            if empty:
+                rowText += str(empty)
+            rows.append(rowText)
+        rights = self.castleRights
+        castling = (('K' if rights & WKS else '') + ('Q' if rights & WQS else '') +
+                    ('k' if rights & BKS else '') + ('q' if rights & BQS else '')) or '-'
+        if self.enpassantPossible != ():
+            enpassant = Move.colsToFiles[self.enpassantPossible[1]] + Move.rowsToRanks[self.enpassantPossible[0]]
+        else:
+            enpassant = '-'
+        return " ".join(("/".join(rows), 'w' if self.whiteToMove else 'b', castling, enpassant,
+                         str(self.halfmoveClock), str(self.getFullmoveNumber())))
+
+    """
+    Compact form of the game: the set up position and the packed moves
+    played from it. Unlike a FEN it keeps the history for repetitions
+    """
+
+    def serialize(self):
+        return self.startFen, [move.packed for move in self.moveLog]
+
+    def loadSerialized(self, startFen, packedMoves):
+        self.loadFen(startFen)
+        for packed in packedMoves:
+            self.makeMove(Move.fromPacked(packed, self.board))
+
+    """
+    Standard algebraic notation of a legal move, e.g. Nbd2, exd5, e8=Q+
+    """
+
+    def getSan(self, move, validMoves=None):
+        if validMoves is None:
+            validMoves = self.getValidMoves()
+        if move.isCastleMove:
+            san = "O-O" if move.endCol > move.startCol else "O-O-O"
+        else:
+            pieceType = move.pieceMoved[1]
+            target = move.getRankFile(move.endRow, move.endCol)
+            if pieceType == 'p':
+                san = ""
+                if move.pieceCaptured != "--":
+                    san = Move.colsToFiles[move.startCol] + "x"
+                san += target
+                if move.isPawnPromotion:
+                    san += "=" + move.promotionPiece
+            else:
+                # disambiguate from other pieces of the same type reaching the square
+                others = [m for m in validMoves if m.pieceMoved == move.pieceMoved and
+                          (m.endRow, m.endCol) == (move.endRow, move.endCol) and
+                          (m.startRow, m.startCol) != (move.startRow, move.startCol)]
+                disambiguation = ""
+                if others:
+                    if all(m.startCol != move.startCol for m in others):
+                        disambiguation = Move.colsToFiles[move.startCol]
+                    elif all(m.startRow != move.startRow for m in others):
+                        disambiguation = Move.rowsToRanks[move.startRow]
+                    else:
+                        disambiguation = move.getRankFile(move.startRow, move.startCol)
+                san = pieceType + disambiguation + ("x" if move.pieceCaptured != "--" else "") + target
+        # check and mate suffix, keeping the end state flags of this position
+        checkMate, staleMate = self.checkMate, self.staleMate
+        self.makeMove(move)
+        if self.inCheck():
+            san += "#" if len(self.getValidMoves()) == 0 else "+"
+        self.undoMove()
+        self.checkMate, self.staleMate = checkMate, staleMate
+        return san
+
+    """
+    Find the legal move written as coordinates (e2e4, e7e8q) or SAN.
+    Returns None when no legal move matches
+    """
+
+    def parseMove(self, text, validMoves=None):
+        if validMoves is None:
+            validMoves = self.getValidMoves()
+        text = text.strip().rstrip("+#!?")
+        for move in validMoves:
+            notation = move.getChessNotation()
+            if text == notation or (len(text) == 4 and move.isPawnPromotion and
+                                    move.promotionPiece == 'Q' and text == notation[:4]):
+                return move
+        if text in ("O-O", "0-0", "O-O-O", "0-0-0"):
+            kingSide = len(text) == 3
+            for move in validMoves:
+                if move.isCastleMove and (move.endCol > move.startCol) == kingSide:
+                    return move
+            return None
+        promotionPiece = None
+        if "=" in text:
+            text, promotionPiece = text.split("=")
+            promotionPiece = promotionPiece.upper()
+        pieceType = text[0] if text[0] in "KQRBN" else 'p'
+        if pieceType != 'p':
+            text = text[1:]
+        text = text.replace("x", "").replace("-", "")
+        if len(text) < 2 or text[-2] not in Move.filesToCols or text[-1] not in Move.ranksToRows:
+            return None
+        endRow, endCol = Move.ranksToRows[text[-1]], Move.filesToCols[text[-2]]
+        disambiguation = text[:-2]
+        matches = []
+        for move in validMoves:
+            if move.pieceMoved[1] != pieceType or (move.endRow, move.endCol) != (endRow, endCol):
+                continue
+            if move.isPawnPromotion and move.promotionPiece != (promotionPiece or 'Q'):
+                continue
+            if any((char in Move.filesToCols and Move.filesToCols[char] != move.startCol) or
+                   (char in Move.ranksToRows and Move.ranksToRows[char] != move.startRow)
+                   for char in disambiguation):
+                continue
+            matches.append(move)
+        return matches[0] if len(matches) == 1 else None
+
+    """
+    Fullmove number as in FEN, it goes up after every black move
+    """
+
+    def getFullmoveNumber(self):
+        plies = len(self.moveLog) + (0 if self.startWhiteToMove else 1)
+        return self.startFullmoveNumber + plies // 2
 
     """ Takes Move as a parameter and executes it.
     Will not work for en-passant,pawn promition and castling"""
 
     def makeMove(self, move):
+        startSq = move.startRow*8 + move.startCol
+        endSq = move.endRow*8 + move.endCol
+        key = self.zobristKey ^ ZOBRIST_CASTLING[self.castleRights]
+        if self.enpassantPossible != ():
+            key ^= ZOBRIST_ENPASSANT_FILE[self.enpassantPossible[1]]
+        key ^= ZOBRIST_PIECES[move.pieceMoved][startSq]
+        if move.pieceCaptured != "--":
+            captureRow = move.startRow if move.isEnpassantMove else move.endRow
+            key ^= ZOBRIST_PIECES[move.pieceCaptured][captureRow*8 + move.endCol]
         self.board[move.startRow][move.startCol] = "--"
         self.board[move.endRow][move.endCol] = move.pieceMoved
         self.moveLog.append(move)  # log the move so we can undo it later
         self.whiteToMove = not self.whiteToMove  # swap the chance of player
         # update the king's location if moved
         if move.pieceMoved == 'wK':
-            self.whiteKingLocation = (move.endRow, move.endCol)
+            self.whiteKingLocation = SQUARES[endSq]
         if move.pieceMoved == 'bK':
-            self.blackKingLocation = (move.endRow, move.endCol)
+            self.blackKingLocation = SQUARES[endSq]
 
         # pawn promotion
         if move.isPawnPromotion:
-            self.board[move.endRow][move.endCol] = move.pieceMoved[0]+'Q'
+            self.board[move.endRow][move.endCol] = move.pieceMoved[0]+move.promotionPiece
 
         # enpassant move
         if move.isEnpassantMove:
@@ -60,8 +339,7 @@ class GameState():
         # update enpassant possible variable
         # only on two square pawn advances
         if move.pieceMoved[1] == 'p' and abs(move.startRow-move.endRow) == 2:
-            self.enpassantPossible = (
-                (move.startRow+move.endRow)//2, move.endCol)
+            self.enpassantPossible = SQUARES[(startSq+endSq)//2]
         else:
             self.enpassantPossible = ()
 
@@ -80,8 +358,38 @@ class GameState():
 
         # update castling rights
         self.updateCastleRights(move)
-        self.castleRightLog.append(CastleRights(self.currentCastlingRight.wks, self.currentCastlingRight.bks,
-                                                self.currentCastlingRight.wqs, self.currentCastlingRight.bqs))
+        if move.pieceMoved[1] == 'p' or move.pieceCaptured != "--":
+            self.halfmoveClock = 0
+        else:
+            self.halfmoveClock += 1
+
+        # finish the zobrist key with the landing piece, rook and new state
+        key ^= ZOBRIST_PIECES[self.board[move.endRow][move.endCol]][endSq]
+        if move.isCastleMove:
+            rook = move.pieceMoved[0] + 'R'
+            rowBase = move.endRow*8
+            if move.endCol-move.startCol == 2:  # king side castle
+                key ^= ZOBRIST_PIECES[rook][rowBase + 7] ^ ZOBRIST_PIECES[rook][rowBase + 5]
+            else:  # queen side castle
+                key ^= ZOBRIST_PIECES[rook][rowBase] ^ ZOBRIST_PIECES[rook][rowBase + 3]
+        key ^= ZOBRIST_CASTLING[self.castleRights] ^ ZOBRIST_BLACK_TO_MOVE
+        if self.enpassantPossible != ():
+            key ^= ZOBRIST_ENPASSANT_FILE[self.enpassantPossible[1]]
+        self.zobristKey = key
+        self.repetitionCounts[key] = self.repetitionCounts.get(key, 0) + 1
+
+        # record the new position's state on the undo stack
+        ply = len(self.moveLog)
+        if ply == len(self.undoStates):
+            self.undoStates.extend(self.undoStates)
+            self.undoKeys.extend(self.undoKeys)
+        self.undoStates[ply] = self.packUndoState()
+        self.undoKeys[ply] = key
+
+        mgDelta, egDelta, phaseDelta = evaluation.moveDelta(move)
+        self.mgScore += mgDelta
+        self.egScore += egDelta
+        self.phase += phaseDelta
 
     """
     Undo the last move made
@@ -95,26 +403,32 @@ class GameState():
             self.whiteToMove = not self.whiteToMove
             # update the king's location if moved
             if move.pieceMoved == 'wK':
-                self.whiteKingLocation = (move.startRow, move.startCol)
+                self.whiteKingLocation = SQUARES[move.startRow*8 + move.startCol]
             if move.pieceMoved == 'bK':
-                self.blackKingLocation = (move.startRow, move.startCol)
+                self.blackKingLocation = SQUARES[move.startRow*8 + move.startCol]
 
             # undo enpassant move
             if move.isEnpassantMove:
                 # leave the landing square blank
                 self.board[move.endRow][move.endCol] = "--"
                 self.board[move.startRow][move.endCol] = move.pieceCaptured
-                self.enpassantPossible = (move.endRow, move.endCol)
-            # undo a 2 square pawn advance
-            if move.pieceMoved[1] == 'p' and abs(move.startRow-move.endRow) == 2:
-                self.enpassantPossible = ()
-
-            # undo castling rights
-            self.castleRightLog.pop()  # get rid of new castle rights
-            # set the current castle rights
-            newCastleRights = self.castleRightLog[-1]
-            self.currentCastlingRight = CastleRights(
-                newCastleRights.wks, newCastleRights.bks, newCastleRights.wqs, newCastleRights.bqs)
+
+            # restore castling rights, en passant square, halfmove clock
+            # and zobrist key from the undo stack
+            key = self.zobristKey
+            if self.repetitionCounts[key] == 1:
+                del self.repetitionCounts[key]
+            else:
+                self.repetitionCounts[key] -= 1
+            ply = len(self.moveLog)
+            self.unpackUndoState(self.undoStates[ply])
+            self.zobristKey = self.undoKeys[ply]
+
+            mgDelta, egDelta, phaseDelta = evaluation.moveDelta(move)
+            self.mgScore -= mgDelta
+            self.egScore -= egDelta
+            self.phase -= phaseDelta
+
             # undo castle move
             if move.isCastleMove:
                 if move.endCol-move.startCol == 2:  # king castle
@@ -126,38 +440,347 @@ class GameState():
                                             2] = self.board[move.endRow][move.endCol+1]
                     self.board[move.endRow][move.endCol+1] = "--"
 
+    """
+    Pass the turn without moving, for null move pruning in the search.
+    The null move is not logged: undoNullMove takes the returned state
+    and must be called before any earlier move is undone
+    """
+
+    def makeNullMove(self):
+        ply = len(self.moveLog)
+        state = (self.enpassantPossible, self.zobristKey, self.undoStates[ply])
+        key = self.zobristKey ^ ZOBRIST_BLACK_TO_MOVE
+        if self.enpassantPossible != ():
+            key ^= ZOBRIST_ENPASSANT_FILE[self.enpassantPossible[1]]
+        self.enpassantPossible = ()
+        self.whiteToMove = not self.whiteToMove
+        self.zobristKey = key
+        self.repetitionCounts[key] = self.repetitionCounts.get(key, 0) + 1
+        # moves made after the null move undo back to this entry
+        self.undoStates[ply] = self.packUndoState()
+        self.undoKeys[ply] = key
+        return state
+
+    def undoNullMove(self, state):
+        key = self.zobristKey
+        if self.repetitionCounts[key] == 1:
+            del self.repetitionCounts[key]
+        else:
+            self.repetitionCounts[key] -= 1
+        self.enpassantPossible, self.zobristKey, undoState = state
+        self.whiteToMove = not self.whiteToMove
+        ply = len(self.moveLog)
+        self.undoStates[ply] = undoState
+        self.undoKeys[ply] = self.zobristKey
+
+    """
+    Castling rights, en passant square and halfmove clock in one integer
+    """
+
+    def packUndoState(self):
+        enpassant = self.enpassantPossible
+        enpassantCode = enpassant[0]*8 + enpassant[1] + 1 if enpassant != () else 0
+        return self.castleRights | enpassantCode << 4 | self.halfmoveClock << 11
+
+    def unpackUndoState(self, state):
+        self.castleRights = state & 0xF
+        enpassantCode = (state >> 4) & 0x7F
+        self.enpassantPossible = SQUARES[enpassantCode - 1] if enpassantCode else ()
+        self.halfmoveClock = state >> 11
+
+    """
+    Compute the zobrist key of the position from scratch
+    """
+
+    def computeZobristKey(self):
+        key = 0
+        for r in range(8):
+            for c in range(8):
+                piece = self.board[r][c]
+                if piece != "--":
+                    key ^= ZOBRIST_PIECES[piece][r*8 + c]
+        if not self.whiteToMove:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        key ^= ZOBRIST_CASTLING[self.castleRights]
+        if self.enpassantPossible != ():
+            key ^= ZOBRIST_ENPASSANT_FILE[self.enpassantPossible[1]]
+        return key
+
+    """
+    Material and piece-square score in centipawns from white's point of
+    view, tapered between midgame and endgame by the remaining material
+    """
+
+    def evaluate(self):
+        return evaluation.taperedScore(self.mgScore, self.egScore, self.phase)
+
+    """
+    Determine if the current position has occurred at least count times
+    """
+
+    def isRepetition(self, count=3):
+        return self.repetitionCounts[self.zobristKey] >= count
+
     """
     Update castle rights
     """
 
     def updateCastleRights(self, move):
-        if move.pieceMoved == 'wK':
-            self.currentCastlingRight.wks = False
-            self.currentCastlingRight.wqs = False
-        elif move.pieceMoved == 'bK':
-            self.currentCastlingRight.bks = False
-            self.currentCastlingRight.bqs = False
-        elif move.pieceMoved == 'wR':
-            if move.startRow == 7:
-                if move.startCol == 0:  # left rook
-                    self.currentCastlingRight.wqs = False
-                elif move.startCol == 7:  # right rook
-                    self.currentCastlingRight.wks = False
-        elif move.pieceMoved == 'bR':
-            if move.startRow == 0:
-                if move.startCol == 0:  # left rook
-                    self.currentCastlingRight.bqs = False
-                elif move.startCol == 7:  # right rook
-                    self.currentCastlingRight.bks = False
-
-    """
-    All moves considering checks
+        self.castleRights &= (CASTLING_KEEP[move.startRow*8 + move.startCol] &
+                              CASTLING_KEEP[move.endRow*8 + move.endCol])
+
+    """
+    All moves considering checks.
+    Pins and checks are found once by scanning out from the king, so
+    moves are filtered without making and undoing each one
     """
 
     def getValidMoves(self):
-        tempEnpassantPossible = self.enpassantPossible
-        tempCastlingRight = CastleRights(self.currentCastlingRight.wks, self.currentCastlingRight.bks,
-                                         self.currentCastlingRight.wqs, self.currentCastlingRight.bqs)
+        if self.referenceMoveGen:
+            return self.getValidMovesReference()
+        pinsAndChecks = self.getPinsAndChecks()
+        moves = self.getLegalMoves(pinsAndChecks)
+        self.updateEndState(moves, pinsAndChecks[0])
+        return moves
+
+    """
+    What the legal move generators need to know about pins and checks,
+    found once per position so the staged generators can share it. The
+    first item tells if the side to move is in check, the rest is up to
+    the backend
+    """
+
+    def getPinsAndChecks(self):
+        return self.checkForPinsAndChecks()
+
+    """
+    Legal captures and promotions only, for the quiescence search and the
+    staged move generator. Never generates quiet moves. Does not touch the
+    checkmate/stalemate flags
+    """
+
+    def getCaptureMoves(self, pinsAndChecks=None):
+        if pinsAndChecks is None:
+            pinsAndChecks = self.getPinsAndChecks()
+        return self.getLegalMoves(pinsAndChecks, quiets=False)
+
+    """
+    Legal moves that neither capture nor promote, castling included. Does
+    not touch the checkmate/stalemate flags
+    """
+
+    def getQuietMoves(self, pinsAndChecks=None):
+        if pinsAndChecks is None:
+            pinsAndChecks = self.getPinsAndChecks()
+        return self.getLegalMoves(pinsAndChecks, captures=False)
+
+    """
+    Legal moves given (inCheck, pins, checks) from getPinsAndChecks,
+    leaving out the captures and promotions or the quiet moves if asked.
+    squares limits the pieces that move, castling is added separately
+    """
+
+    def getLegalMoves(self, pinsAndChecks, captures=True, quiets=True, squares=SQUARES, castling=True):
+        inCheck, pins, checks = pinsAndChecks
+        if self.whiteToMove:
+            kingRow, kingCol = self.whiteKingLocation
+        else:
+            kingRow, kingCol = self.blackKingLocation
+
+        moves = []
+        board = self.board
+        blockSquares = self.getBlockSquares(checks, kingRow, kingCol)
+        allyColor = 'w' if self.whiteToMove else 'b'
+        for r, c in squares:
+            piece = board[r][c]
+            if piece[0] != allyColor:
+                continue
+            if piece[1] == 'K':
+                if not quiets:
+                    self.getLegalKingMoves(r, c, moves, capturesOnly=True)
+                elif captures:
+                    self.getLegalKingMoves(r, c, moves)
+                else:
+                    kingMoves = []
+                    self.getLegalKingMoves(r, c, kingMoves)
+                    moves.extend(move for move in kingMoves if move.pieceCaptured == "--")
+                continue
+            if len(checks) > 1:  # double check, only the king can move
+                continue
+            pinDirection = pins.get((r, c))
+            if pinDirection is not None and piece[1] == 'N':
+                continue  # a pinned knight can never move
+            pieceMoves = []
+            if quiets:
+                self.moveFunctions[piece[1]](r, c, pieceMoves)
+            else:
+                self.getPieceCaptures(r, c, piece[1], pieceMoves)
+            for move in pieceMoves:
+                if not captures and (move.pieceCaptured != "--" or move.isPawnPromotion):
+                    continue
+                if pinDirection is not None:
+                    # the piece may only slide along the pin line
+                    if (move.endRow-r)*pinDirection[1] != (move.endCol-c)*pinDirection[0]:
+                        continue
+                if move.isEnpassantMove:
+                    # capturing en passant removes two pawns at once which
+                    # can expose the king, so play it out to be sure
+                    if self.isEnpassantLegal(move):
+                        moves.append(move)
+                    continue
+                if blockSquares is not None and (move.endRow, move.endCol) not in blockSquares:
+                    continue
+                moves.append(move)
+
+        if castling and quiets and not inCheck:
+            self.getCastleMoves(kingRow, kingCol, moves)
+        return moves
+
+    """
+    The legal move of this position with the given packed form, or None.
+    Checks a hash or killer move, which may come from another position,
+    without generating the moves of the other pieces
+    """
+
+    def getLegalMove(self, packed, pinsAndChecks=None):
+        startRow, startCol = SQUARES[packed & 0x3F]
+        if self.board[startRow][startCol][0] != ('w' if self.whiteToMove else 'b'):
+            return None
+        if pinsAndChecks is None:
+            pinsAndChecks = self.getPinsAndChecks()
+        inCheck = pinsAndChecks[0]
+        if packed >> 14 == FLAG_CASTLE:
+            moves = []
+            if not inCheck and self.board[startRow][startCol][1] == 'K':
+                self.getCastleMoves(startRow, startCol, moves)
+        else:
+            moves = self.getLegalMoves(pinsAndChecks, squares=(SQUARES[packed & 0x3F],), castling=False)
+        for move in moves:
+            if move.packed == packed:
+                return move
+        return None
+
+    """
+    Squares a non king piece may move to when in single check (capturing
+    the checker or blocking), None when not in check
+    """
+
+    def getBlockSquares(self, checks, kingRow, kingCol):
+        if len(checks) != 1:
+            return None
+        checkRow, checkCol, dr, dc = checks[0]
+        if self.board[checkRow][checkCol][1] in ('N', 'p'):
+            # knights and pawns can only be captured, not blocked
+            return {(checkRow, checkCol)}
+        blockSquares = set()
+        for i in range(1, 8):
+            square = (kingRow + dr*i, kingCol + dc*i)
+            blockSquares.add(square)
+            if square == (checkRow, checkCol):
+                break
+        return blockSquares
+
+    """
+    Pseudo legal captures (and promotions) of the piece at r,c
+    """
+
+    def getPieceCaptures(self, r, c, pieceType, moves):
+        board = self.board
+        enemyColor = 'b' if self.whiteToMove else 'w'
+        if pieceType == 'p':
+            firstMove = len(moves)
+            endRow = r-1 if self.whiteToMove else r+1
+            if endRow in (0, 7) and board[endRow][c] == "--":
+                moves.append(Move((r, c), (endRow, c), board))
+            for endCol in (c-1, c+1):
+                if 0 <= endCol < 8:
+                    if board[endRow][endCol][0] == enemyColor:
+                        moves.append(Move((r, c), (endRow, endCol), board))
+                    elif (endRow, endCol) == self.enpassantPossible:
+                        moves.append(Move((r, c), (endRow, endCol), board, isEnpassantMove=True))
+            if endRow in (0, 7):
+                self.addUnderPromotions(moves, firstMove)
+            return
+        if pieceType == 'N':
+            for d in KNIGHT_DIRECTIONS:
+                endRow, endCol = r+d[0], c+d[1]
+                if 0 <= endRow < 8 and 0 <= endCol < 8 and board[endRow][endCol][0] == enemyColor:
+                    moves.append(Move((r, c), (endRow, endCol), board))
+            return
+        if pieceType == 'K':
+            for d in KING_DIRECTIONS:
+                endRow, endCol = r+d[0], c+d[1]
+                if 0 <= endRow < 8 and 0 <= endCol < 8 and board[endRow][endCol][0] == enemyColor:
+                    moves.append(Move((r, c), (endRow, endCol), board))
+            return
+        if pieceType == 'R':
+            directions = ORTHOGONAL_DIRECTIONS
+        elif pieceType == 'B':
+            directions = DIAGONAL_DIRECTIONS
+        else:
+            directions = KING_DIRECTIONS
+        for d in directions:
+            endRow, endCol = r+d[0], c+d[1]
+            while 0 <= endRow < 8 and 0 <= endCol < 8:
+                endPiece = board[endRow][endCol]
+                if endPiece != "--":
+                    if endPiece[0] == enemyColor:
+                        moves.append(Move((r, c), (endRow, endCol), board))
+                    break
+                endRow += d[0]
+                endCol += d[1]
+
+    """
+    Static exchange evaluation: the material the side to move wins (or
+    loses, if negative) on the move's target square when both sides keep
+    recapturing with their least valuable attacker. Pins are ignored
+    """
+
+    def staticExchange(self, move):
+        values = evaluation.exchangeValue
+        board = self.board
+        r, c = move.endRow, move.endCol
+        captured = move.pieceCaptured
+        gains = [values[captured[1]] if captured != "--" else 0]
+        if move.isPawnPromotion:
+            gains[0] += values[move.promotionPiece] - values['p']
+        onSquare = move.pieceMoved[0] + move.promotionPiece if move.isPawnPromotion else move.pieceMoved
+        # play the exchange out on the board, remembering what to put back
+        changed = [(move.startRow, move.startCol, board[move.startRow][move.startCol]), (r, c, board[r][c])]
+        if move.isEnpassantMove:
+            changed.append((move.startRow, c, board[move.startRow][c]))
+            board[move.startRow][c] = "--"
+        board[move.startRow][move.startCol] = "--"
+        board[r][c] = onSquare
+        side = 'b' if move.pieceMoved[0] == 'w' else 'w'
+        while True:
+            attackers = self.attackersOfSquare(r, c, side)
+            if not attackers:
+                break
+            attackRow, attackCol = min(attackers, key=lambda square: values[board[square[0]][square[1]][1]])
+            attacker = board[attackRow][attackCol]
+            otherSide = 'b' if side == 'w' else 'w'
+            if attacker[1] == 'K' and self.attackersOfSquare(r, c, otherSide, stopAtFirst=True):
+                break  # the king can't take a defended piece
+            gains.append(values[onSquare[1]] - gains[-1])
+            changed.append((attackRow, attackCol, attacker))
+            board[attackRow][attackCol] = "--"
+            onSquare = attacker
+            board[r][c] = attacker
+            side = otherSide
+        for row, col, piece in reversed(changed):
+            board[row][col] = piece
+        # each side may stop recapturing when that is better for it
+        for i in range(len(gains) - 1, 0, -1):
+            gains[i-1] = -max(-gains[i-1], gains[i])
+        return gains[0]
+
+    """
+    The original generator: every pseudo legal move is made and checked.
+    Kept as a reference mode for cross checking the legal generator
+    """
+
+    def getValidMovesReference(self):
         # 1)generate all possible moves
         moves = self.getAllPossibleMoves()
         # get castle moves
@@ -179,8 +802,17 @@ class GameState():
                 moves.remove(moves[i])
             self.whiteToMove = not self.whiteToMove
             self.undoMove()
+        self.updateEndState(moves, self.inCheck())
+
+        return moves
+
+    """
+    Set checkmate / stalemate flags from the list of legal moves
+    """
+
+    def updateEndState(self, moves, inCheck):
         if len(moves) == 0:  # Either checkmate or stalemate
-            if self.inCheck():
+            if inCheck:
                 self.checkMate = True
             else:
                 self.staleMate = True
@@ -188,9 +820,92 @@ class GameState():
             self.checkMate = False
             self.staleMate = False
 
-        self.enpassantPossible = tempEnpassantPossible
-        self.currentCastlingRight = tempCastlingRight
-        return moves
+    """
+    Scan outward from the king of the side to move.
+    Returns (inCheck, pins, checks) where pins maps the square of a pinned
+    ally piece to the pin direction and checks is a list of
+    (row, col, dirRow, dirCol) for every checking piece
+    """
+
+    def checkForPinsAndChecks(self):
+        pins = {}
+        checks = []
+        if self.whiteToMove:
+            enemyColor, allyColor = 'b', 'w'
+            startRow, startCol = self.whiteKingLocation
+        else:
+            enemyColor, allyColor = 'w', 'b'
+            startRow, startCol = self.blackKingLocation
+        # the first four directions are orthogonal, the last four diagonal
+        directions = ((-1, 0), (0, -1), (1, 0), (0, 1),
+                      (-1, -1), (-1, 1), (1, -1), (1, 1))
+        # enemy pawns attack the king from the squares in front of it
+        pawnDirection = -1 if self.whiteToMove else 1
+        for j, d in enumerate(directions):
+            possiblePin = None
+            for i in range(1, 8):
+                endRow = startRow + d[0]*i
+                endCol = startCol + d[1]*i
+                if not (0 <= endRow < 8 and 0 <= endCol < 8):
+                    break
+                endPiece = self.board[endRow][endCol]
+                if endPiece == "--":
+                    continue
+                if endPiece[0] == allyColor:
+                    if possiblePin is None:  # first ally piece could be pinned
+                        possiblePin = (endRow, endCol)
+                    else:  # second ally piece, no pin or check this way
+                        break
+                else:
+                    pieceType = endPiece[1]
+                    if (pieceType == 'Q' or
+                            (j < 4 and pieceType == 'R') or
+                            (j >= 4 and pieceType == 'B') or
+                            (i == 1 and pieceType == 'p' and j >= 4 and d[0] == pawnDirection)):
+                        if possiblePin is None:
+                            checks.append((endRow, endCol, d[0], d[1]))
+                        else:
+                            pins[possiblePin] = d
+                    break
+        knightMoves = ((2, 1), (2, -1), (-2, 1), (-2, -1),
+                       (1, 2), (1, -2), (-1, 2), (-1, -2))
+        for m in knightMoves:
+            endRow = startRow + m[0]
+            endCol = startCol + m[1]
+            if 0 <= endRow < 8 and 0 <= endCol < 8:
+                if self.board[endRow][endCol] == enemyColor + 'N':
+                    checks.append((endRow, endCol, m[0], m[1]))
+        return len(checks) > 0, pins, checks
+
+    """
+    King moves that do not step onto an attacked square
+    """
+
+    def getLegalKingMoves(self, r, c, moves, capturesOnly=False):
+        kingMoves = []
+        if capturesOnly:
+            self.getPieceCaptures(r, c, 'K', kingMoves)
+        else:
+            self.getKingMoves(r, c, kingMoves)
+        # lift the king so sliders see through the square it is leaving
+        king = self.board[r][c]
+        self.board[r][c] = "--"
+        for move in kingMoves:
+            if not self.squareUnderAttack(move.endRow, move.endCol):
+                moves.append(move)
+        self.board[r][c] = king
+
+    """
+    Play an en passant capture out to see if it leaves the king in check
+    """
+
+    def isEnpassantLegal(self, move):
+        self.makeMove(move)
+        self.whiteToMove = not self.whiteToMove
+        legal = not self.inCheck()
+        self.whiteToMove = not self.whiteToMove
+        self.undoMove()
+        return legal
 
     """
     Determine if the current player is in check
@@ -207,13 +922,62 @@ class GameState():
     """
 
     def squareUnderAttack(self, r, c):
-        self.whiteToMove = not self.whiteToMove
-        oppMoves = self.getAllPossibleMoves()
-        self.whiteToMove = not self.whiteToMove
-        for move in oppMoves:
-            if move.endRow == r and move.endCol == c:  # square is under attack
-                return True
-        return False
+        enemyColor = 'b' if self.whiteToMove else 'w'
+        return len(self.attackersOfSquare(r, c, enemyColor, stopAtFirst=True)) > 0
+
+    """
+    Squares of the pieces of attackerColor that attack the square r,c.
+    Looks outward from the target square along knight, pawn, king and
+    slider lines instead of generating the attacker's moves
+    """
+
+    def attackersOfSquare(self, r, c, attackerColor, stopAtFirst=False):
+        attackers = []
+        board = self.board
+        # knights
+        knight = attackerColor + 'N'
+        for d in ((2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)):
+            endRow = r+d[0]
+            endCol = c+d[1]
+            if 0 <= endRow < 8 and 0 <= endCol < 8 and board[endRow][endCol] == knight:
+                attackers.append((endRow, endCol))
+                if stopAtFirst:
+                    return attackers
+        # pawns, white pawns attack upwards so they sit below the target
+        pawn = attackerColor + 'p'
+        pawnRow = r+1 if attackerColor == 'w' else r-1
+        if 0 <= pawnRow < 8:
+            for pawnCol in (c-1, c+1):
+                if 0 <= pawnCol < 8 and board[pawnRow][pawnCol] == pawn:
+                    attackers.append((pawnRow, pawnCol))
+                    if stopAtFirst:
+                        return attackers
+        # king
+        king = attackerColor + 'K'
+        for d in ((1, 1), (-1, 1), (1, -1), (-1, -1), (0, 1), (1, 0), (-1, 0), (0, -1)):
+            endRow = r+d[0]
+            endCol = c+d[1]
+            if 0 <= endRow < 8 and 0 <= endCol < 8 and board[endRow][endCol] == king:
+                attackers.append((endRow, endCol))
+                if stopAtFirst:
+                    return attackers
+        # sliders, each ray stops at the first piece it meets
+        rook, bishop, queen = attackerColor + 'R', attackerColor + 'B', attackerColor + 'Q'
+        for d in ((-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)):
+            slider = rook if d[0] == 0 or d[1] == 0 else bishop
+            endRow = r+d[0]
+            endCol = c+d[1]
+            while 0 <= endRow < 8 and 0 <= endCol < 8:
+                endPiece = board[endRow][endCol]
+                if endPiece != "--":
+                    if endPiece == slider or endPiece == queen:
+                        attackers.append((endRow, endCol))
+                        if stopAtFirst:
+                            return attackers
+                    break
+                endRow += d[0]
+                endCol += d[1]
+        return attackers
 
     """
     All possible moves for a piece without considering checks
@@ -235,6 +999,7 @@ class GameState():
     """
 
     def getPawnMoves(self, r, c, moves):
+        firstMove = len(moves)
         if self.whiteToMove:  # white pawns
             if self.board[r-1][c] == "--":  # 1 square pawn advance
                 moves.append(Move((r, c), (r-1, c), self.board))
@@ -276,7 +1041,23 @@ class GameState():
                     moves.append(
                         Move((r, c), (r+1, c+1), self.board, isEnpassantMove=True))
 
-        # add pawn promotions later
+        # moves to the last rank were made as queen promotions,
+        # add the under promotions next to them
+        if r == (1 if self.whiteToMove else 6):
+            self.addUnderPromotions(moves, firstMove)
+
+    """
+    Add rook, bishop and knight promotions for the queen promotions in
+    moves[firstMove:]
+    """
+
+    def addUnderPromotions(self, moves, firstMove):
+        for i in range(firstMove, len(moves)):
+            move = moves[i]
+            if move.isPawnPromotion:
+                for piece in ('R', 'B', 'N'):
+                    moves.append(Move((move.startRow, move.startCol), (move.endRow, move.endCol),
+                                      self.board, promotionPiece=piece))
 
     """
     Get all the rook moves for a rook at (row,column)
@@ -384,9 +1165,9 @@ class GameState():
     def getCastleMoves(self, r, c, moves):
         if self.squareUnderAttack(r, c):  # cant castle if in check
             return
-        if (self.whiteToMove and self.currentCastlingRight.wks) or (not self.whiteToMove and self.currentCastlingRight.bks):
+        if self.castleRights & (WKS if self.whiteToMove else BKS):
             self.getKingSideCastleMoves(r, c, moves)
-        if (self.whiteToMove and self.currentCastlingRight.wqs) or (not self.whiteToMove and self.currentCastlingRight.bqs):
+        if self.castleRights & (WQS if self.whiteToMove else BQS):
             self.getQueenSideCastleMoves(r, c, moves)
 
     def getKingSideCastleMoves(self, r, c, moves):
@@ -402,12 +1183,14 @@ class GameState():
                     Move((r, c), (r, c-2), self.board, isCastleMove=True))
 
 
-class CastleRights():
-    def __init__(self, wks, bks, wqs, bqs):
-        self.wks = wks
-        self.bks = bks
-        self.wqs = wqs
-        self.bqs = bqs
+# a move packed into 16 bits:
+# start square (6 bits) | end square (6) | promotion piece (2) | special flag (2)
+# squares are row*8+col, so packed & 0xFFF indexes a from/to table
+PROMOTION_CODES = {"Q": 0, "R": 1, "B": 2, "N": 3}
+PROMOTION_PIECES = "QRBN"
+FLAG_PROMOTION = 1
+FLAG_ENPASSANT = 2
+FLAG_CASTLE = 3
 
 
 class Move():
@@ -421,7 +1204,11 @@ class Move():
                    "d": 3, "e": 4, "f": 5, "g": 6, "h": 7}
     colsToFiles = {v: k for k, v in filesToCols.items()}
 
-    def __init__(self, startSq, endSq, board, isEnpassantMove=False, isCastleMove=False):
+    # no per move __dict__, millions of these are made during a search
+    __slots__ = ("startRow", "startCol", "endRow", "endCol", "pieceMoved", "pieceCaptured",
+                 "isEnpassantMove", "isCastleMove", "isPawnPromotion", "promotionPiece", "packed")
+
+    def __init__(self, startSq, endSq, board, isEnpassantMove=False, isCastleMove=False, promotionPiece='Q'):
         self.startRow = startSq[0]
         self.startCol = startSq[1]
         self.endRow = endSq[0]
@@ -437,9 +1224,36 @@ class Move():
         # pawn promotion
         self.isPawnPromotion = ((self.pieceMoved == 'wp' and self.endRow == 0) or (
             self.pieceMoved == 'bp' and self.endRow == 7))
-        self.moveID = self.startRow * 1000 + self.startCol * \
-            100 + self.endRow * 10 + self.endCol
-        # print(self.moveID)
+        self.promotionPiece = promotionPiece if self.isPawnPromotion else None
+        self.packed = (self.startRow*8 + self.startCol) | (self.endRow*8 + self.endCol) << 6
+        if self.isPawnPromotion:
+            self.packed |= PROMOTION_CODES[promotionPiece] << 12 | FLAG_PROMOTION << 14
+        elif isEnpassantMove:
+            self.packed |= FLAG_ENPASSANT << 14
+        elif isCastleMove:
+            self.packed |= FLAG_CASTLE << 14
+
+    """
+    Rebuild a full Move from its packed form on the board it was made for
+    """
+
+    @classmethod
+    def fromPacked(cls, packed, board):
+        startSq = packed & 0x3F
+        endSq = (packed >> 6) & 0x3F
+        flag = packed >> 14
+        return cls(divmod(startSq, 8), divmod(endSq, 8), board,
+                   isEnpassantMove=flag == FLAG_ENPASSANT, isCastleMove=flag == FLAG_CASTLE,
+                   promotionPiece=PROMOTION_PIECES[(packed >> 12) & 0x3])
+
+    """
+    Identifies the move by squares and promotion piece, not by the special
+    flags, so a move built from two clicks matches the generated one
+    """
+
+    @property
+    def moveID(self):
+        return self.packed & 0x3FFF
 
     """
     Overriding the equals method 
@@ -451,7 +1265,10 @@ class Move():
         return False
 
     def getChessNotation(self):
-        return self.getRankFile(self.startRow, self.startCol) + self.getRankFile(self.endRow, self.endCol)
+        notation = self.getRankFile(self.startRow, self.startCol) + self.getRankFile(self.endRow, self.endCol)
+        if self.isPawnPromotion:
+            notation += self.promotionPiece.lower()
+        return notation
 
     def getRankFile(self, r, c):
         return self.colsToFiles[c] + self.rowsToRanks[r]
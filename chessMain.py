@@ -1,6 +1,8 @@
 """ This is our main driver file. Responsible for handling userinput 
 and displaying the current game state. """
 
+import threading
+import time
 import pygame as p
 import chessEngine
 import moveAI
@@ -11,6 +13,14 @@ DIMENSION = 8  # chess board dimension 8X8
 SQ_SIZE = HEIGHT//DIMENSION  # square size
 MAX_FPS = 15  # for animation
 IMAGES = {}
+FONTS = {}  # by size, SysFont is slow to create
+TEXT_SURFACES = {}  # rendered text by (text, size, color)
+# with moveAI.COLLECT_STATS on, each AI search's stats are printed and, if
+# this names a file, appended to it as a line of JSON
+STATS_LOG = None
+# think on the human's time: once the AI has moved it searches the reply
+# its search predicted (or the human's position when there is none)
+PONDER = True
 
 """ 
 Initialize a global dictionary of images.
@@ -22,11 +32,85 @@ def loadImages():
     pieces = ["wR", "wN", "wB", "wQ", "wK", "wp",
               "bR", "bN", "bB", "bQ", "bK", "bp"]
     for piece in pieces:
+        # converted once to the display format so blits are fast
         IMAGES[piece] = p.transform.scale(p.image.load(
-            "images/" + piece + ".png"), (SQ_SIZE, SQ_SIZE))
+            "images/" + piece + ".png"), (SQ_SIZE, SQ_SIZE)).convert_alpha()
     # Now we can access an image from the dictionary IMAGES
 
 
+""" Searches for the AI's move on a copy of the game state in a background
+thread, so the window keeps handling events while the AI thinks.
+
+With ponder set it thinks on the human's time instead: ponderMove, the
+predicted human reply, is played on the copy and searched with no time
+limit. If the human plays it, ponderHit turns the search into the AI's
+real one; otherwise it is cancelled and the next search starts with the
+transposition table it filled """
+
+
+class AIThinker():
+    def __init__(self, gs, ponder=False, ponderMove=None):
+        self.gs = chessEngine.GameState()
+        self.gs.loadSerialized(*gs.serialize())
+        if ponderMove is not None:
+            self.gs.makeMove(ponderMove)
+        # the position searched, read here as the search changes gs
+        self.key = self.gs.zobristKey
+        timeLimit = None if ponder else moveAI.TIME_LIMIT
+        # the pool when moveAI.WORKERS asks for one, stopped the same way
+        self.searcher = moveAI.makeSearcher(timeLimit)
+        self.bestMove = None
+        self.pv = []
+        self.stats = None
+        self.done = False
+        self.thread = threading.Thread(target=self.think, daemon=True)
+        self.thread.start()
+
+    def think(self):
+        validMoves = self.gs.getValidMoves()
+        if validMoves:
+            result = moveAI.findBestResult(self.gs, validMoves, moveAI.DEPTH, self.searcher)
+            self.bestMove, self.pv, self.stats = result.bestMove, result.pv, result.stats
+        self.done = True
+
+    """
+    The human's reply the search expects, None after a book move
+    """
+
+    def predictedReply(self):
+        return self.pv[1] if len(self.pv) > 1 else None
+
+    """
+    The human played into the pondered position: from now on the search
+    gets the normal time limit
+    """
+
+    def ponderHit(self):
+        self.searcher.timeLimit = moveAI.TIME_LIMIT
+        if moveAI.TIME_LIMIT is not None:
+            self.searcher.deadline = time.time() + moveAI.TIME_LIMIT
+
+    """
+    The move found, as one of validMoves of the real game state
+    """
+
+    def getMove(self, validMoves):
+        for move in validMoves:
+            if move == self.bestMove:
+                return move
+        return None
+
+    """
+    Stop the search and wait for the thread, e.g. on undo, reset or quit
+    """
+
+    def cancel(self):
+        while self.thread.is_alive():
+            # set again until the search sees it, it clears the flag as it starts
+            self.searcher.stopped = True
+            self.thread.join(0.01)
+
+
 """
 Main driver from our code
 """
@@ -44,6 +128,7 @@ def main():
     moveMade = False  # flag variable for when a move is made
     animate = False  # flag variable for when we animate a move
     loadImages()
+    renderer = BoardRenderer(screen)
 
     run = True
     # no square selected initially(keeps track of last square selected)
@@ -54,6 +139,8 @@ def main():
 
     playerOne = False  # if a human is playing white then it will be true,if AI then false
     playerTwo = False  # same as above but for black
+    aiThinker = None  # the AI's background search while it is thinking
+    ponderer = None  # the AI's search on the human's time
 
     while run:
         humanTurn = (gs.whiteToMove and playerOne) or (
@@ -61,6 +148,12 @@ def main():
         for e in p.event.get():
             if e.type == p.QUIT:
                 run = False
+                if aiThinker is not None:
+                    aiThinker.cancel()
+                    aiThinker = None
+                if ponderer is not None:
+                    ponderer.cancel()
+                    ponderer = None
             # mouse handlers
             elif e.type == p.MOUSEBUTTONDOWN:
                 if not gameOver and humanTurn:
@@ -90,6 +183,14 @@ def main():
                             playerClicks = [sqSelected]
             # key handlers
             elif e.type == p.KEYDOWN:
+                if e.key in (p.K_z, p.K_r):
+                    # the searches are for a position that is about to change
+                    if aiThinker is not None:
+                        aiThinker.cancel()
+                        aiThinker = None
+                    if ponderer is not None:
+                        ponderer.cancel()
+                        ponderer = None
                 if e.key == p.K_z:  # undo when z  is pressed
                     gs.undoMove()
                     animate = False
@@ -103,66 +204,160 @@ def main():
                     moveMade = False
                     animate = False
 
-        # AI move
-        if not gameOver and not humanTurn:
-            AIMove = moveAI.findBestMove(gs, validMoves)
-            if AIMove is None:
-                AIMove = moveAI.findRandomMove(validMoves)
-            gs.makeMove(AIMove)
-            moveMade = True
-            animate = True
+        # AI move, searched in the background and picked up once found
+        if run and not gameOver and not humanTurn:
+            if aiThinker is None:
+                if ponderer is not None and ponderer.key == gs.zobristKey:
+                    ponderer.ponderHit()  # the answer may already be there
+                    aiThinker = ponderer
+                else:
+                    if ponderer is not None:
+                        ponderer.cancel()  # a miss, its table entries stay
+                    aiThinker = AIThinker(gs)
+                ponderer = None
+            elif aiThinker.done:
+                AIMove = aiThinker.getMove(validMoves)
+                if AIMove is None:
+                    AIMove = moveAI.findRandomMove(validMoves)
+                if aiThinker.stats is not None:
+                    logStats(aiThinker.stats)
+                gs.makeMove(AIMove)
+                moveMade = True
+                animate = True
+                if PONDER and ((gs.whiteToMove and playerOne) or (not gs.whiteToMove and playerTwo)):
+                    predicted = aiThinker.predictedReply()
+                    if predicted is not None and predicted not in gs.getValidMoves():
+                        predicted = None
+                    ponderer = AIThinker(gs, ponder=True, ponderMove=predicted)
+                aiThinker = None
 
         if moveMade:
             if animate:
                 animateMove(gs.moveLog[-1], screen, gs.board, clock)
+                renderer.invalidate()  # the animation drew over the whole board
             validMoves = gs.getValidMoves()
             moveMade = False
             animate = False
 
-        drawGameState(screen, gs, validMoves, sqSelected)
-
+        overlays = []
         if gs.checkMate:
             gameOver = True
             if gs.whiteToMove:
-                drawText(screen, "BLACK WINS BY CHECKMATE")
+                overlays += gameOverText("BLACK WINS BY CHECKMATE")
             else:
-                drawText(screen, "WHITE WINS BY CHECKMATE")
+                overlays += gameOverText("WHITE WINS BY CHECKMATE")
         elif gs.staleMate:
             gameOver = True
-            drawText(screen, "StaleMate")
+            overlays += gameOverText("StaleMate")
+        if aiThinker is not None:
+            overlays += thinkingText()
 
+        renderer.render(gs.board, validMoves, sqSelected,
+                        'w' if gs.whiteToMove else 'b', overlays)
         clock.tick(MAX_FPS)
-        p.display.flip()
 
 
-""" Responsible for all the graphics within a current game state """
+""" Report the stats of one AI search """
 
 
-def drawGameState(screen, gs, validMoves, sqSelected):
-    # order of the two methods matter
-    drawBoard(screen)  # draws sqare on board
-    highlightSquare(screen, gs, validMoves, sqSelected)
-    drawPieces(screen, gs.board)  # draw pieces
+def logStats(stats):
+    print(stats.summary())
+    if STATS_LOG is not None:
+        with open(STATS_LOG, "a") as log:
+            log.write(stats.toJson() + "\n")
 
 
-""" Highlights the square selected and the moves for the piece selected """
+""" Draws the game into the window, redrawing only the squares whose piece
+or highlight changed since the last frame and updating just those parts of
+the display. The empty board is drawn once and kept as a surface """
 
 
-def highlightSquare(screen, gs, validMoves, sqSelected):
+class BoardRenderer():
+    def __init__(self, screen):
+        self.screen = screen
+        self.boardSurface = p.Surface((WIDTH, HEIGHT))
+        drawBoard(self.boardSurface)
+        # translucent highlights, made once
+        self.highlights = {}
+        for kind, color in (("selected", "blue"), ("target", "green")):
+            s = p.Surface((SQ_SIZE, SQ_SIZE))
+            s.set_alpha(140)  # transparancy value 0->transparent 255->opaque
+            s.fill(p.Color(color))
+            self.highlights[kind] = s
+        # (piece, highlight) shown on each square, None forces a redraw
+        self.shown = [[None]*DIMENSION for _ in range(DIMENSION)]
+        self.shownOverlays = []
+        self.fullRedraw = True
+
+    """
+    Forget what is on screen, e.g. after something else drew over it
+    """
+
+    def invalidate(self):
+        self.fullRedraw = True
+
+    """
+    Bring the screen up to date. overlays is a list of text items from
+    gameOverText and thinkingText, drawn on top of the board
+    """
+
+    def render(self, board, validMoves, sqSelected, colorToMove, overlays):
+        if self.fullRedraw:
+            self.shown = [[None]*DIMENSION for _ in range(DIMENSION)]
+            self.shownOverlays = []
+        highlight = highlightedSquares(board, validMoves, sqSelected, colorToMove)
+        overlayRects = [(item, textSurface(*item[:3]).get_rect(topleft=item[3])) for item in overlays]
+
+        # squares under text that went away or changed need repainting
+        stale = [textSurface(*item[:3]).get_rect(topleft=item[3])
+                 for item in self.shownOverlays if item not in overlays]
+        dirty = []
+        for r in range(DIMENSION):
+            for c in range(DIMENSION):
+                state = (board[r][c], highlight.get((r, c)))
+                square = p.Rect(c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE)
+                if state != self.shown[r][c] or square.collidelist(stale) != -1:
+                    self.drawSquare(square, state)
+                    self.shown[r][c] = state
+                    dirty.append(square)
+
+        # text is redrawn when new or when a square under it was repainted
+        for item, rect in overlayRects:
+            if item not in self.shownOverlays or rect.collidelist(dirty) != -1:
+                self.screen.blit(textSurface(*item[:3]), rect)
+                dirty.append(rect)
+        self.shownOverlays = list(overlays)
+
+        if self.fullRedraw:
+            p.display.flip()
+            self.fullRedraw = False
+        elif dirty:
+            p.display.update(dirty)
+
+    def drawSquare(self, square, state):
+        piece, highlight = state
+        self.screen.blit(self.boardSurface, square, square)
+        if highlight is not None:
+            self.screen.blit(self.highlights[highlight], square)
+        if piece != "--":
+            self.screen.blit(IMAGES[piece], square)
+
+
+""" Highlights for the square selected and the moves of the piece on it,
+as {(row, col): "selected" or "target"} """
+
+
+def highlightedSquares(board, validMoves, sqSelected, colorToMove):
+    highlight = {}
     if sqSelected != ():
         r, c = sqSelected
         # square selected piece can be moved
-        if gs.board[r][c][0] == ('w' if gs.whiteToMove else 'b'):
-            # highlight sq selected
-            s = p.Surface((SQ_SIZE, SQ_SIZE))
-            s.set_alpha(140)  # transparancy value 0->transparent 255->opaque
-            s.fill(p.Color('blue'))
-            screen.blit(s, (c*SQ_SIZE, r*SQ_SIZE))
-            # highlight move from that square
-            s.fill(p.Color('green'))
+        if board[r][c][0] == colorToMove:
             for move in validMoves:
                 if move.startRow == r and move.startCol == c:
-                    screen.blit(s, (move.endCol*SQ_SIZE, move.endRow*SQ_SIZE))
+                    highlight[(move.endRow, move.endCol)] = "target"
+            highlight[(r, c)] = "selected"
+    return highlight
 
 
 """ Draw the squares on board.
@@ -192,7 +387,9 @@ def drawPieces(screen, board):
                     c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE))
 
 
-""" Animating the move """
+""" Animating the move. The board without the moving piece is drawn once;
+each frame restores the piece's previous spot from it and updates only
+the two spots """
 
 
 def animateMove(move, screen, board, clock):
@@ -202,36 +399,66 @@ def animateMove(move, screen, board, clock):
     framesPerSquare = 10  # frames to move one square of an animation
     frameCount = (abs(dR)+abs(dC))*framesPerSquare
 
+    background = p.Surface((WIDTH, HEIGHT))
+    drawBoard(background)
+    drawPieces(background, board)
+    # erase the piece moved from its ending square
+    color = colors[(move.endRow+move.endCol) % 2]
+    endSquare = p.Rect(move.endCol*SQ_SIZE,
+                       move.endRow*SQ_SIZE, SQ_SIZE, SQ_SIZE)
+    p.draw.rect(background, color, endSquare)
+    # draw captured piece onto rectangle
+    if move.pieceCaptured != "--":
+        background.blit(IMAGES[move.pieceCaptured], endSquare)
+    screen.blit(background, (0, 0))
+    p.display.flip()
+
+    previous = None
     for frame in range(frameCount+1):
         r, c = (move.startRow + dR*frame/frameCount,
                 move.startCol + dC*frame/frameCount)
-        drawBoard(screen)
-        drawPieces(screen, board)
-        # erase the piece moved from its ending square
-        color = colors[(move.endRow+move.endCol) % 2]
-        endSquare = p.Rect(move.endCol*SQ_SIZE,
-                           move.endRow*SQ_SIZE, SQ_SIZE, SQ_SIZE)
-        p.draw.rect(screen, color, endSquare)
-
-        # draw captured piece onto rectangle
-        if move.pieceCaptured != "--":
-            screen.blit(IMAGES[move.pieceCaptured], endSquare)
-
+        pieceRect = p.Rect(c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE)
+        dirty = [pieceRect]
+        if previous is not None:
+            screen.blit(background, previous, previous)
+            dirty.append(previous)
         # draw the moving piece
-        screen.blit(IMAGES[move.pieceMoved], p.Rect(
-            c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE))
-        p.display.flip()
+        screen.blit(IMAGES[move.pieceMoved], pieceRect)
+        p.display.update(dirty)
+        previous = pieceRect
         clock.tick(120)
 
 
-def drawText(screen, text):
-    font = p.font.SysFont("Helvitca", 50, False, False)
-    textObject = font.render(text, 0, p.Color('red'))
-    textLocation = p.Rect(0, 0, WIDTH, HEIGHT).move(
-        WIDTH/2-textObject.get_width()/2, HEIGHT/2)
-    screen.blit(textObject, textLocation)
-    textObject = font.render(text, 0, p.Color("darkblue"))
-    screen.blit(textObject, textLocation.move(3, 3))
+def getFont(size):
+    if size not in FONTS:
+        FONTS[size] = p.font.SysFont("Helvitca", size, False, False)
+    return FONTS[size]
+
+
+def textSurface(text, size, color):
+    key = (text, size, color)
+    if key not in TEXT_SURFACES:
+        TEXT_SURFACES[key] = getFont(size).render(text, 0, p.Color(color))
+    return TEXT_SURFACES[key]
+
+
+""" Overlay items are (text, size, color, topleft) tuples, so the renderer
+can tell whether the text on screen changed """
+
+
+def gameOverText(text):
+    width = textSurface(text, 50, 'red').get_width()
+    x, y = WIDTH//2 - width//2, HEIGHT//2
+    return [(text, 50, 'red', (x, y)), (text, 50, 'darkblue', (x+3, y+3))]
+
+
+""" Thinking indicator with dots that cycle while the AI searches """
+
+
+def thinkingText():
+    text = "AI thinking" + "." * (p.time.get_ticks() // 400 % 4)
+    height = textSurface(text, 28, 'darkblue').get_height()
+    return [(text, 28, 'darkblue', (6, HEIGHT - height - 6))]
 
 
 if __name__ == "__main__":
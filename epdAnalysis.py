@@ -0,0 +1,173 @@
+""" Streaming EPD analysis.
+Reads an EPD file one line at a time, searches every position with moveAI
+and writes an EPD line with the result as soon as it is known, so memory
+use does not grow with the size of the suite. Runs headless.
+
+    python epdAnalysis.py suite.epd results.epd --depth 4 --movetime 2
+
+Each output line is the input position with these operations added:
+acd (depth reached), acn (nodes), acs (seconds), ce (centipawns for the
+side to move), pm (predicted move) and pv (principal variation), all in SAN.
+"""
+
+import argparse
+import sys
+import time
+
+import chessEngine
+import moveAI
+
+LOG_EVERY = 100  # positions between progress lines
+
+
+""" Split an EPD line into a FEN (with default move clocks) and a dict of
+operations. Operands keep their quotes stripped, e.g. {"bm": "Nf3", "id": "WAC.001"} """
+
+
+def parseEpd(line):
+    fields = line.split(None, 4)
+    if len(fields) < 4:
+        raise ValueError("EPD needs 4 position fields: " + line)
+    operations = {}
+    rest = fields[4] if len(fields) > 4 else ""
+    for operation in splitOperations(rest):
+        parts = operation.split(None, 1)
+        if parts:
+            operations[parts[0]] = parts[1].strip().strip('"') if len(parts) > 1 else ""
+    # EPD can carry the move clocks as hmvc and fmvn operations
+    fen = " ".join(fields[:4] + [operations.get("hmvc", "0"), operations.get("fmvn", "1")])
+    return fen, operations
+
+
+def splitOperations(text):
+    # operations end with ';', which may also appear inside quoted strings
+    operations = []
+    current = ""
+    quoted = False
+    for char in text:
+        if char == '"':
+            quoted = not quoted
+        if char == ';' and not quoted:
+            operations.append(current.strip())
+            current = ""
+        else:
+            current += char
+    if current.strip():
+        operations.append(current.strip())
+    return operations
+
+
+def formatEpd(fen, operations):
+    text = " ".join(fen.split()[:4])
+    for opcode, operand in operations.items():
+        if opcode == "id" or (opcode[0] == "c" and opcode[1:].isdigit()):  # string operands
+            operand = '"' + operand + '"'
+        text += " " + opcode + (" " + operand if operand else "") + ";"
+    return text
+
+
+""" Lazily yield (lineNumber, line) for each position line of an open EPD
+file, skipping blank lines and comments """
+
+
+def readEpd(lines):
+    for lineNumber, line in enumerate(lines, 1):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield lineNumber, line
+
+
+""" Search one position and return its operations with the results added """
+
+
+def analysePosition(gs, fen, operations, depth, timeLimit):
+    gs.loadFen(fen)
+    validMoves = gs.getValidMoves()
+    results = dict(operations)
+    if not validMoves:
+        results["ce"] = str(-moveAI.CHECKMATE if gs.checkMate else moveAI.STALEMATE)
+        return results, None
+    result = moveAI.searchBestMove(gs, validMoves, depth, timeLimit)
+    # the pv is written in SAN, playing it out to get each move's context
+    sanPv = []
+    for move in result.pv:
+        sanPv.append(gs.getSan(move))
+        gs.makeMove(move)
+    for _ in result.pv:
+        gs.undoMove()
+    bestSan = gs.getSan(result.bestMove, validMoves)
+    results.update({"acd": str(result.depth), "acn": str(result.nodes),
+                    "acs": "%.2f" % result.elapsed, "ce": str(result.score),
+                    "pm": bestSan, "pv": " ".join(sanPv) or bestSan})
+    return results, bestSan
+
+
+""" True/False when the line has a bm or am operation to check, else None """
+
+
+def isSolved(operations, bestSan):
+    if bestSan is None:
+        return None
+    strip = lambda san: san.rstrip("+#!?")
+    if "bm" in operations:
+        return strip(bestSan) in [strip(san) for san in operations["bm"].split()]
+    if "am" in operations:
+        return strip(bestSan) not in [strip(san) for san in operations["am"].split()]
+    return None
+
+
+""" Analyse every position from the input lines and write a result line per
+position to out, flushing each one. Returns (positions, checked, solved) """
+
+
+def analyseStream(lines, out, depth=moveAI.DEPTH, timeLimit=moveAI.TIME_LIMIT, log=None):
+    gs = chessEngine.GameState()
+    positions = checked = solved = 0
+    startTime = time.time()
+    for lineNumber, line in readEpd(lines):
+        try:
+            fen, operations = parseEpd(line)
+            results, bestSan = analysePosition(gs, fen, operations, depth, timeLimit)
+        except ValueError as e:
+            if log is not None:
+                log.write("line %d skipped: %s\n" % (lineNumber, e))
+            continue
+        out.write(formatEpd(fen, results) + "\n")
+        out.flush()
+        positions += 1
+        verdict = isSolved(operations, bestSan)
+        if verdict is not None:
+            checked += 1
+            solved += verdict
+        if log is not None and positions % LOG_EVERY == 0:
+            log.write("%d positions, %d/%d solved, %.1f positions/sec\n" % (
+                positions, solved, checked, positions / max(time.time() - startTime, 1e-9)))
+    return positions, checked, solved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search every position of an EPD file")
+    parser.add_argument("input", help="EPD file, - for stdin")
+    parser.add_argument("output", nargs="?", default="-", help="result file, - for stdout")
+    parser.add_argument("--depth", type=int, default=moveAI.DEPTH)
+    parser.add_argument("--movetime", type=float, default=moveAI.TIME_LIMIT,
+                        help="seconds per position, 0 for no limit")
+    parser.add_argument("--append", action="store_true", help="append to the output file")
+    args = parser.parse_args(argv)
+
+    timeLimit = args.movetime or None
+    inFile = sys.stdin if args.input == "-" else open(args.input)
+    outFile = sys.stdout if args.output == "-" else open(args.output, "a" if args.append else "w")
+    try:
+        positions, checked, solved = analyseStream(inFile, outFile, args.depth, timeLimit, sys.stderr)
+    finally:
+        if inFile is not sys.stdin:
+            inFile.close()
+        if outFile is not sys.stdout:
+            outFile.close()
+    sys.stderr.write("done: %d positions, %d of %d solved\n" % (positions, solved, checked))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
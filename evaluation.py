@@ -0,0 +1,167 @@
+""" Material and piece-square evaluation with midgame and endgame tables.
+GameState keeps the midgame score, endgame score and game phase up to
+date in makeMove/undoMove using moveDelta, so reading the evaluation of a
+position is O(1). scoreBoard computes the same value by scanning the
+board and is used to check the incremental terms. Scores are in
+centipawns from white's point of view. """
+
+mgMaterial = {"p": 82, "N": 337, "B": 365, "R": 477, "Q": 1025, "K": 0}
+egMaterial = {"p": 94, "N": 281, "B": 297, "R": 512, "Q": 936, "K": 0}
+# values for static exchange evaluation, the king outweighs everything
+exchangeValue = {"p": 100, "N": 325, "B": 325, "R": 500, "Q": 975, "K": 20000}
+# contribution of each piece to the game phase, 24 is a full midgame
+phaseWeight = {"p": 0, "N": 1, "B": 1, "R": 2, "Q": 4, "K": 0}
+MAX_PHASE = 24
+
+# piece-square tables from white's point of view, row 0 is the 8th rank
+pawnTable = [
+    0, 0, 0, 0, 0, 0, 0, 0,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    10, 10, 20, 30, 30, 20, 10, 10,
+    5, 5, 10, 25, 25, 10, 5, 5,
+    0, 0, 0, 20, 20, 0, 0, 0,
+    5, -5, -10, 0, 0, -10, -5, 5,
+    5, 10, 10, -20, -20, 10, 10, 5,
+    0, 0, 0, 0, 0, 0, 0, 0]
+pawnEndgameTable = [
+    0, 0, 0, 0, 0, 0, 0, 0,
+    80, 80, 80, 80, 80, 80, 80, 80,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    30, 30, 30, 30, 30, 30, 30, 30,
+    15, 15, 15, 15, 15, 15, 15, 15,
+    5, 5, 5, 5, 5, 5, 5, 5,
+    0, 0, 0, 0, 0, 0, 0, 0,
+    0, 0, 0, 0, 0, 0, 0, 0]
+knightTable = [
+    -50, -40, -30, -30, -30, -30, -40, -50,
+    -40, -20, 0, 0, 0, 0, -20, -40,
+    -30, 0, 10, 15, 15, 10, 0, -30,
+    -30, 5, 15, 20, 20, 15, 5, -30,
+    -30, 0, 15, 20, 20, 15, 0, -30,
+    -30, 5, 10, 15, 15, 10, 5, -30,
+    -40, -20, 0, 5, 5, 0, -20, -40,
+    -50, -40, -30, -30, -30, -30, -40, -50]
+bishopTable = [
+    -20, -10, -10, -10, -10, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 10, 10, 5, 0, -10,
+    -10, 5, 5, 10, 10, 5, 5, -10,
+    -10, 0, 10, 10, 10, 10, 0, -10,
+    -10, 10, 10, 10, 10, 10, 10, -10,
+    -10, 5, 0, 0, 0, 0, 5, -10,
+    -20, -10, -10, -10, -10, -10, -10, -20]
+rookTable = [
+    0, 0, 0, 0, 0, 0, 0, 0,
+    5, 10, 10, 10, 10, 10, 10, 5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    0, 0, 0, 5, 5, 0, 0, 0]
+queenTable = [
+    -20, -10, -10, -5, -5, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 5, 5, 5, 0, -10,
+    -5, 0, 5, 5, 5, 5, 0, -5,
+    0, 0, 5, 5, 5, 5, 0, -5,
+    -10, 5, 5, 5, 5, 5, 0, -10,
+    -10, 0, 5, 0, 0, 0, 0, -10,
+    -20, -10, -10, -5, -5, -10, -10, -20]
+kingTable = [
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -20, -30, -30, -40, -40, -30, -30, -20,
+    -10, -20, -20, -20, -20, -20, -20, -10,
+    20, 20, 0, 0, 0, 0, 20, 20,
+    20, 30, 10, 0, 0, 10, 30, 20]
+kingEndgameTable = [
+    -50, -40, -30, -20, -20, -30, -40, -50,
+    -30, -20, -10, 0, 0, -10, -20, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -30, 0, 0, 0, 0, -30, -30,
+    -50, -30, -30, -30, -30, -30, -30, -50]
+
+mgTables = {"p": pawnTable, "N": knightTable, "B": bishopTable,
+            "R": rookTable, "Q": queenTable, "K": kingTable}
+egTables = {"p": pawnEndgameTable, "N": knightTable, "B": bishopTable,
+            "R": rookTable, "Q": queenTable, "K": kingEndgameTable}
+
+
+def buildScoreTables(material, tables):
+    # piece -> 64 signed values including material, black tables mirrored
+    scores = {}
+    for pieceType, table in tables.items():
+        scores['w' + pieceType] = [material[pieceType] + table[sq] for sq in range(64)]
+        scores['b' + pieceType] = [-(material[pieceType] + table[(7 - sq//8)*8 + sq % 8])
+                                   for sq in range(64)]
+    return scores
+
+
+MG_SCORES = buildScoreTables(mgMaterial, mgTables)
+EG_SCORES = buildScoreTables(egMaterial, egTables)
+
+
+""" Blend midgame and endgame scores by the game phase """
+
+
+def taperedScore(mgScore, egScore, phase):
+    phase = min(phase, MAX_PHASE)
+    return (mgScore*phase + egScore*(MAX_PHASE - phase)) // MAX_PHASE
+
+
+""" Midgame score, endgame score and phase of a board by full scan """
+
+
+def boardTerms(board):
+    mgScore = egScore = phase = 0
+    for r in range(8):
+        for c in range(8):
+            piece = board[r][c]
+            if piece != "--":
+                mgScore += MG_SCORES[piece][r*8 + c]
+                egScore += EG_SCORES[piece][r*8 + c]
+                phase += phaseWeight[piece[1]]
+    return mgScore, egScore, phase
+
+
+""" Evaluation of a board by full scan, the debug reference for
+GameState.evaluate """
+
+
+def scoreBoard(board):
+    return taperedScore(*boardTerms(board))
+
+
+""" Change of (midgame score, endgame score, phase) caused by a move.
+Only uses fields of the move so undoMove can subtract the same delta """
+
+
+def moveDelta(move):
+    startSq = move.startRow*8 + move.startCol
+    endSq = move.endRow*8 + move.endCol
+    moved = move.pieceMoved
+    landing = moved[0] + move.promotionPiece if move.isPawnPromotion else moved
+    mgDelta = MG_SCORES[landing][endSq] - MG_SCORES[moved][startSq]
+    egDelta = EG_SCORES[landing][endSq] - EG_SCORES[moved][startSq]
+    phaseDelta = phaseWeight[landing[1]] - phaseWeight[moved[1]]
+    if move.pieceCaptured != "--":
+        captureSq = move.startRow*8 + move.endCol if move.isEnpassantMove else endSq
+        mgDelta -= MG_SCORES[move.pieceCaptured][captureSq]
+        egDelta -= EG_SCORES[move.pieceCaptured][captureSq]
+        phaseDelta -= phaseWeight[move.pieceCaptured[1]]
+    if move.isCastleMove:
+        rook = moved[0] + 'R'
+        rowBase = move.endRow*8
+        if move.endCol-move.startCol == 2:  # king side castle
+            rookFrom, rookTo = rowBase + 7, rowBase + 5
+        else:  # queen side castle
+            rookFrom, rookTo = rowBase, rowBase + 3
+        mgDelta += MG_SCORES[rook][rookTo] - MG_SCORES[rook][rookFrom]
+        egDelta += EG_SCORES[rook][rookTo] - EG_SCORES[rook][rookFrom]
+    return mgDelta, egDelta, phaseDelta
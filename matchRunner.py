@@ -0,0 +1,425 @@
+""" Headless self-play matches between two engine configurations.
+Games are played in parallel on a process pool, each opening twice with
+colors swapped. Every finished game is appended to a JSONL file (and a
+PGN file) straight away, so an interrupted run picks up where it stopped
+when started again with the same output. The first line of the file holds
+the engine configurations, openings and move time, and a run with other
+settings refuses to resume from it. Prints games/sec, the Elo
+difference with a 95% error margin and a sequential probability ratio
+test that stops the match once the result is clear.
+
+    python matchRunner.py --engine1 "DEPTH=4" --engine2 "DEPTH=4,QUIESCENCE=False" \\
+        --openings openings.txt --games 1000 --movetime 0.1 --out results.jsonl
+
+An engine configuration is a comma separated list of moveAI settings,
+e.g. "DEPTH=3,DELTA_MARGIN=150,TT_SIZE_MB=8". Opening lines are either a
+FEN/EPD or moves from the start position (coordinate notation or SAN).
+"""
+
+import argparse
+import ast
+import hashlib
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import chessEngine
+import moveAI
+from moveOrdering import MoveOrderer
+from transpositionTable import TranspositionTable
+
+STARTING_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+MAX_PLIES = 400  # longer games are adjudicated as draws
+LOG_EVERY = 10  # games between progress lines
+SPRT_MIN_GAMES = 20  # games before the SPRT may stop the match
+# pseudo games added to each of win, draw and loss when estimating the
+# variance, so a few identical results don't look like a certainty
+PRIOR_GAMES = 0.5
+
+
+""" Parse "DEPTH=3,QUIESCENCE=False" into a dict of moveAI settings """
+
+
+def parseConfig(text):
+    config = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        name, _, value = item.partition("=")
+        name = name.strip()
+        if not hasattr(moveAI, name):
+            raise ValueError("moveAI has no setting " + name)
+        try:
+            config[name] = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            raise ValueError("bad value for %s: %s" % (name, value))
+    return config
+
+
+""" Opening lines of a file as start FENs, skipping blanks and comments """
+
+
+def readOpenings(path):
+    openings = []
+    gs = chessEngine.GameState()
+    with open(path) as openingFile:
+        for line in openingFile:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            if "/" in line:
+                fields = line.split()
+                gs.loadFen(" ".join(fields[:6]) if len(fields) >= 6 and fields[4].isdigit()
+                           else " ".join(fields[:4] + ["0", "1"]))
+            else:
+                gs.loadFen(STARTING_FEN)
+                for text in line.split():
+                    if text[0].isdigit() and text.rstrip(".").isdigit():
+                        continue  # move numbers
+                    move = gs.parseMove(text.split(".")[-1])
+                    if move is None:
+                        raise ValueError("illegal opening move %s in: %s" % (text, line))
+                    gs.makeMove(move)
+            openings.append(gs.getFen())
+    return openings
+
+
+# per worker process: the searcher of each configuration, so their
+# transposition tables and history stay separate
+workerEngines = {}
+
+
+class Engine():
+    def __init__(self, config):
+        self.config = config
+        self.tt = TranspositionTable(config.get("TT_SIZE_MB", moveAI.TT_SIZE_MB))
+        self.ordering = MoveOrderer()
+
+    """
+    Search a move with this engine's settings applied to moveAI, putting
+    the defaults back afterwards
+    """
+
+    def findMove(self, gs, validMoves, moveTime):
+        saved = {name: getattr(moveAI, name) for name in self.config}
+        for name, value in self.config.items():
+            setattr(moveAI, name, value)
+        try:
+            move = moveAI.findBookMove(gs, validMoves)
+            if move is None:
+                searcher = moveAI.Searcher(moveTime, self.tt, self.ordering)
+                move = searcher.search(gs, validMoves, moveAI.DEPTH).bestMove
+        finally:
+            for name, value in saved.items():
+                setattr(moveAI, name, value)
+        return move
+
+
+def getEngine(name, config):
+    if name not in workerEngines:
+        # the book would make every game from an opening the same
+        workerEngines[name] = Engine(dict({"USE_BOOK": False}, **config))
+    return workerEngines[name]
+
+
+""" Only kings, or a king and one minor piece against a bare king """
+
+
+def insufficientMaterial(board):
+    pieces = [piece[1] for row in board for piece in row if piece != "--" and piece[1] != 'K']
+    return len(pieces) == 0 or (len(pieces) == 1 and pieces[0] in ('N', 'B'))
+
+
+""" Play one game in a worker. Returns a dict ready for the JSONL file """
+
+
+def playGame(gameId, startFen, white, black, moveTime):
+    startTime = time.time()
+    gs = chessEngine.GameState()
+    gs.loadFen(startFen)
+    engines = {True: getEngine(*white), False: getEngine(*black)}
+    for engine in engines.values():
+        engine.tt.clear()
+    sanMoves = []
+    result, termination = "1/2-1/2", "max plies"
+    while len(gs.moveLog) < MAX_PLIES:
+        validMoves = gs.getValidMoves()
+        if gs.checkMate:
+            result, termination = ("0-1" if gs.whiteToMove else "1-0"), "checkmate"
+            break
+        if gs.staleMate:
+            termination = "stalemate"
+            break
+        if gs.isRepetition(3):
+            termination = "repetition"
+            break
+        if gs.halfmoveClock >= 100:
+            termination = "50 move rule"
+            break
+        if insufficientMaterial(gs.board):
+            termination = "insufficient material"
+            break
+        move = engines[gs.whiteToMove].findMove(gs, validMoves, moveTime)
+        sanMoves.append(gs.getSan(move, validMoves))
+        gs.makeMove(move)
+    return {"id": gameId, "white": white[0], "black": black[0], "fen": startFen,
+            "result": result, "termination": termination, "moves": sanMoves,
+            "seconds": round(time.time() - startTime, 3)}
+
+
+def formatPgn(game, roundNumber):
+    lines = ['[Event "self-play match"]', '[Round "%d"]' % roundNumber,
+             '[White "%s"]' % game["white"], '[Black "%s"]' % game["black"],
+             '[Result "%s"]' % game["result"], '[Termination "%s"]' % game["termination"]]
+    fields = game["fen"].split()
+    if game["fen"] != STARTING_FEN:
+        lines += ['[SetUp "1"]', '[FEN "%s"]' % game["fen"]]
+    moveNumber, whiteToMove = int(fields[5]), fields[1] == 'w'
+    text = []
+    for i, san in enumerate(game["moves"]):
+        if whiteToMove:
+            text.append("%d. %s" % (moveNumber, san))
+        elif i == 0:
+            text.append("%d... %s" % (moveNumber, san))
+        else:
+            text.append(san)
+        if not whiteToMove:
+            moveNumber += 1
+        whiteToMove = not whiteToMove
+    text.append(game["result"])
+    return "\n".join(lines) + "\n\n" + " ".join(text) + "\n\n"
+
+
+""" Score of a game for engine1: 1, 0.5 or 0 """
+
+
+def engine1Score(game):
+    if game["result"] == "1/2-1/2":
+        return 0.5
+    whiteWon = game["result"] == "1-0"
+    return 1.0 if whiteWon == (game["white"] == "engine1") else 0.0
+
+
+class MatchStats():
+    def __init__(self):
+        self.wins = self.losses = self.draws = 0
+
+    def add(self, score):
+        if score == 1.0:
+            self.wins += 1
+        elif score == 0.0:
+            self.losses += 1
+        else:
+            self.draws += 1
+
+    def games(self):
+        return self.wins + self.losses + self.draws
+
+    """
+    Mean score and its per game variance. The variance is regularised with
+    PRIOR_GAMES of each result, the mean is the observed one
+    """
+
+    def meanAndVariance(self):
+        n = self.games()
+        mean = (self.wins + 0.5 * self.draws) / n
+        wins, losses, draws = (count + PRIOR_GAMES for count in (self.wins, self.losses, self.draws))
+        priorMean = (wins + 0.5 * draws) / (n + 3 * PRIOR_GAMES)
+        variance = (wins * (1 - priorMean) ** 2 + losses * priorMean ** 2 +
+                    draws * (0.5 - priorMean) ** 2) / (n + 3 * PRIOR_GAMES)
+        return mean, variance
+
+    """
+    Elo difference of engine1 over engine2 with its 95% error margin
+    """
+
+    def elo(self):
+        n = self.games()
+        if n == 0:
+            return 0.0, float("inf")
+        mean, variance = self.meanAndVariance()
+        margin = 1.96 * math.sqrt(variance / n)
+        elo = scoreToElo(mean)
+        return elo, (scoreToElo(mean + margin) - scoreToElo(mean - margin)) / 2
+
+    """
+    Log likelihood ratio of H1 (engine1 is elo1 better) against H0 (elo0
+    better), by the normal approximation used for engine testing
+    """
+
+    def llr(self, elo0, elo1):
+        n = self.games()
+        if n == 0:
+            return 0.0
+        mean, variance = self.meanAndVariance()
+        score0, score1 = eloToScore(elo0), eloToScore(elo1)
+        return n * (score1 - score0) * (2 * mean - score0 - score1) / (2 * variance)
+
+
+def scoreToElo(score):
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+
+def eloToScore(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+""" The settings that must not change when a run is resumed, as JSON
+would read them back: the engine configurations, the openings (by hash)
+and the move time """
+
+
+def runParameters(openings, config1, config2, moveTime):
+    parameters = {"engine1": config1, "engine2": config2, "moveTime": moveTime,
+                  "openings": hashlib.sha1("\n".join(openings).encode()).hexdigest()}
+    return json.loads(json.dumps(parameters))
+
+
+""" The run parameters of a JSONL results file (None when it has none) and
+the games already in it, by id """
+
+
+def readResults(path):
+    parameters = None
+    games = {}
+    if os.path.exists(path):
+        with open(path) as resultFile:
+            for line in resultFile:
+                line = line.strip()
+                if line:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short when the run was stopped
+                    if "parameters" in record:
+                        parameters = record["parameters"]
+                    else:
+                        games[record["id"]] = record
+    return parameters, games
+
+
+""" "H1" or "H0" once the log likelihood ratio leaves its bounds after at
+least minGames games, otherwise None """
+
+
+def sprtVerdict(stats, elo0, elo1, lowerBound, upperBound, minGames):
+    if stats.games() < minGames:
+        return None
+    llr = stats.llr(elo0, elo1)
+    if llr >= upperBound:
+        return "H1"
+    if llr <= lowerBound:
+        return "H0"
+    return None
+
+
+""" Play the match, appending each game to out (JSONL) and pgnOut. Returns
+the MatchStats and the SPRT verdict ("H1", "H0" or None) """
+
+
+def runMatch(openings, config1, config2, games, moveTime, workers, resultsPath, pgnPath=None,
+             elo0=0.0, elo1=5.0, alpha=0.05, beta=0.05, minGames=SPRT_MIN_GAMES, log=sys.stderr):
+    lowerBound = math.log(beta / (1 - alpha))
+    upperBound = math.log((1 - beta) / alpha)
+    stats = MatchStats()
+    parameters = runParameters(openings, config1, config2, moveTime)
+    storedParameters, finished = readResults(resultsPath)
+    if (storedParameters is not None or finished) and storedParameters != parameters:
+        raise ValueError("%s was written with other engines, openings or move time: %s" % (
+            resultsPath, json.dumps(storedParameters)))
+    for game in finished.values():
+        stats.add(engine1Score(game))
+    # the games already played may decide the test
+    verdict = sprtVerdict(stats, elo0, elo1, lowerBound, upperBound, minGames)
+    if finished and log is not None:
+        log.write("resuming after %d games%s\n" % (
+            len(finished), "" if verdict is None else ", SPRT already accepted " + verdict))
+
+    def gameSpec(gameId):
+        # each opening twice, engine1 white in the first game of the pair
+        startFen = openings[(gameId // 2) % len(openings)]
+        engines = [("engine1", config1), ("engine2", config2)]
+        if gameId % 2:
+            engines.reverse()
+        return gameId, startFen, engines[0], engines[1], moveTime
+
+    pending = iter([gameId for gameId in range(games) if gameId not in finished])
+    startTime = time.time()
+    played = 0
+    with open(resultsPath, "a") as out, \
+            (open(pgnPath, "a") if pgnPath else open(os.devnull, "w")) as pgnOut, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        if storedParameters is None:
+            out.write(json.dumps({"parameters": parameters}) + "\n")
+            out.flush()
+        running = set()
+        while True:
+            # keep a short queue so an SPRT stop leaves little work behind
+            while verdict is None and len(running) < 2 * workers:
+                gameId = next(pending, None)
+                if gameId is None:
+                    break
+                running.add(executor.submit(playGame, *gameSpec(gameId)))
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                game = future.result()
+                out.write(json.dumps(game) + "\n")
+                out.flush()
+                pgnOut.write(formatPgn(game, game["id"] + 1))
+                pgnOut.flush()
+                stats.add(engine1Score(game))
+                played += 1
+                llr = stats.llr(elo0, elo1)
+                if verdict is None:
+                    verdict = sprtVerdict(stats, elo0, elo1, lowerBound, upperBound, minGames)
+                if log is not None and (played % LOG_EVERY == 0 or verdict is not None):
+                    elo, margin = stats.elo()
+                    log.write("%d games  +%d -%d =%d  elo %+.1f +/- %.1f  llr %.2f (%.2f, %.2f)  %.2f games/sec\n" % (
+                        stats.games(), stats.wins, stats.losses, stats.draws, elo, margin,
+                        llr, lowerBound, upperBound, played / max(time.time() - startTime, 1e-9)))
+            if verdict is not None:
+                # drop the queued games, those already being played are
+                # still recorded so the results file matches the stats
+                running = {future for future in running if not future.cancel()}
+    return stats, verdict
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Self-play match between two engine configurations")
+    parser.add_argument("--engine1", default="", help="moveAI settings, e.g. DEPTH=4,QUIESCENCE=False")
+    parser.add_argument("--engine2", default="")
+    parser.add_argument("--openings", help="file of FENs or move lists, the start position by default")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--movetime", type=float, default=0.1, help="seconds per move")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--out", default="match.jsonl", help="JSONL results, appended to and resumed from")
+    parser.add_argument("--pgn", help="also append the games to this PGN file")
+    parser.add_argument("--elo0", type=float, default=0.0, help="SPRT null hypothesis")
+    parser.add_argument("--elo1", type=float, default=5.0, help="SPRT alternative hypothesis")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    parser.add_argument("--min-games", type=int, default=SPRT_MIN_GAMES, help="games before the SPRT may stop the match")
+    args = parser.parse_args(argv)
+
+    config1, config2 = parseConfig(args.engine1), parseConfig(args.engine2)
+    openings = readOpenings(args.openings) if args.openings else [STARTING_FEN]
+    try:
+        stats, verdict = runMatch(openings, config1, config2, args.games, args.movetime, args.workers,
+                                  args.out, args.pgn, args.elo0, args.elo1, args.alpha, args.beta,
+                                  args.min_games)
+    except ValueError as error:
+        print(error)
+        return 1
+    elo, margin = stats.elo()
+    print("engine1 vs engine2: +%d -%d =%d  elo %+.1f +/- %.1f  sprt %s" % (
+        stats.wins, stats.losses, stats.draws, elo, margin,
+        {"H1": "accepted H1", "H0": "accepted H0", None: "inconclusive"}[verdict]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,43 +1,516 @@
+import os
 import random
+import sys
+import time
+import openingBook
+import tablebase
+from transpositionTable import TranspositionTable, EXACT, LOWER, UPPER
+from moveOrdering import MoveOrderer
+import evaluation
+from evaluation import exchangeValue
+from searchStats import SearchStats
 
 pieceScore = {"K": 0, "Q": 9, "R": 5, "B": 3, "N": 3, "p": 1}
-CHECKMATE = 1000
+CHECKMATE = 30000  # in centipawns, must fit the transposition table
 STALEMATE = 0
+DEPTH = 4  # deepest iteration of the search
+TIME_LIMIT = 3.0  # seconds the AI may think per move, None for no limit
+TT_SIZE_MB = 16  # memory budget of the transposition table
+WORKERS = 1  # processes for the root parallel search, 1 searches in this process
+# opening book played from before searching, see openingBook.py
+BOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "book.bin")
+USE_BOOK = True
+# endgame tables probed in the search, see tablebase.py
+USE_TABLEBASES = True
+MATE_BOUND = CHECKMATE - 1000  # scores beyond this are mates
+# search captures past the horizon instead of scoring unquiet leaves
+QUIESCENCE = True
+DELTA_MARGIN = 200  # centipawns of positional gain a capture may bring
+DELTA_MIN_PHASE = 6  # no delta pruning in endings with less material
+# selective search, each switchable on its own to measure it
+# null move pruning: let the opponent move twice, if a reduced search
+# still fails high the node is cut. Not used in check, after a null move
+# or with only king and pawns, where zugzwang makes passing unsound
+NULL_MOVE = True
+NULL_MOVE_REDUCTION = 2
+NULL_MOVE_MIN_DEPTH = 3
+# late move reductions: quiet moves ordered late are searched one ply
+# shallower with a null window and searched again in full if they beat alpha
+LATE_MOVE_REDUCTIONS = True
+LMR_MIN_DEPTH = 3
+LMR_MIN_MOVES = 4  # moves searched in full before reducing
+# futility pruning: near the leaves skip quiet moves that don't give
+# check when the static score plus a margin can't reach alpha
+FUTILITY_PRUNING = True
+FUTILITY_MARGINS = [0, 200, 500]  # by remaining depth
+# search one ply deeper when the side to move is in check
+CHECK_EXTENSIONS = True
+MAX_EXTENDED_PLY = 32  # no extensions past this ply
+# search each iteration in a window around the last score, widened on a fail
+ASPIRATION_WINDOWS = True
+ASPIRATION_WINDOW = 50
+ASPIRATION_MIN_DEPTH = 3
+# check every leaf's incremental evaluation against a full board scan
+DEBUG_EVAL = False
+# collect a SearchStats for every search (SearchResult.stats), off by
+# default as timing the game state's methods slows the search down
+COLLECT_STATS = False
+# generate the moves of a node stage by stage (MoveOrderer.stagedMoves)
+# rather than all at once
+STAGED_MOVES = True
+
+# shared between AI moves so earlier searches help later ones
+transpositionTable = TranspositionTable(TT_SIZE_MB)
+moveOrderer = MoveOrderer()
+book = None  # opened on first use
+# checked once so searches without tables pay nothing
+tablebasesAvailable = tablebase.tablebases.hasAnyTable()
+
+
+""" A weighted random book move, or None when out of book or there is no
+book file """
+
+
+def findBookMove(gs, validMoves):
+    global book
+    if not USE_BOOK:
+        return None
+    if book is None:
+        if not os.path.exists(BOOK_PATH):
+            return None
+        try:
+            book = openingBook.OpeningBook(BOOK_PATH)
+        except ValueError as error:
+            sys.stderr.write("%s, playing without it\n" % error)
+            book = False  # refused, not opened again
+    return book.pickMove(gs, validMoves) if book else None
 
 
 def findRandomMove(validMoves):
     return validMoves[random.randint(0, len(validMoves)-1)]
 
 
-def findBestMove(gs, validMoves):
-    turnMultiplier = 1 if gs.whiteToMove else -1
-    opponentMinMaxScore = CHECKMATE
-    bestPlayerMove = None
-    random.shuffle(validMoves)
-    for playerMove in validMoves:
-        gs.makeMove(playerMove)
-        opponentMoves = gs.getValidMoves()
-        opponentMaxScore = -CHECKMATE
-        for opponentMove in opponentMoves:
-            gs.makeMove(opponentMove)
-            if gs.checkMate:
-                score = -turnMultiplier * CHECKMATE
-            elif gs.staleMate:
-                score = STALEMATE
+""" Pick the AI's move. Keeps the signature chessMain uses; plays from the
+opening book while in book and runs the iterative deepening negamax
+search underneath """
+
+
+def findBestMove(gs, validMoves, depth=DEPTH, timeLimit=TIME_LIMIT):
+    return findBestResult(gs, validMoves, depth, makeSearcher(timeLimit)).bestMove
+
+
+""" The book move as a SearchResult, or else the result of searcher, e.g.
+one from makeSearcher that another thread can stop """
+
+
+def findBestResult(gs, validMoves, depth=DEPTH, searcher=None):
+    bookMove = findBookMove(gs, validMoves)
+    if bookMove is not None:
+        return SearchResult(bookMove, 0, 0, [bookMove], 0, 0.0)
+    if searcher is None:
+        searcher = makeSearcher()
+    return searcher.search(gs, validMoves, depth)
+
+
+""" The searcher findBestMove uses: the parallel search pool when WORKERS is
+more than 1, otherwise a Searcher with the shared table and history. Both
+have search(), and stopped and deadline can be set while it runs """
+
+
+def makeSearcher(timeLimit=TIME_LIMIT):
+    if WORKERS > 1:
+        import parallelSearch  # imported here, it imports this module
+        return parallelSearch.ParallelSearcher(parallelSearch.getSearchPool(WORKERS), timeLimit)
+    return Searcher(timeLimit, transpositionTable, moveOrderer)
+
+
+""" Search the position with iterative deepening and return a SearchResult
+for the deepest iteration that produced a move """
+
+
+def searchBestMove(gs, validMoves, depth=DEPTH, timeLimit=TIME_LIMIT):
+    searcher = Searcher(timeLimit, transpositionTable, moveOrderer)
+    return searcher.search(gs, validMoves, depth)
+
+
+class SearchResult():
+    def __init__(self, bestMove, score, depth, pv, nodes, elapsed):
+        self.bestMove = bestMove
+        self.score = score  # from the side to move's point of view
+        self.depth = depth
+        self.pv = pv  # principal variation, a list of moves
+        self.nodes = nodes
+        self.elapsed = elapsed
+        # share of beta cutoffs made by the first move searched
+        self.firstMoveCutoffRate = 0.0
+        self.stats = None  # SearchStats when COLLECT_STATS is on
+
+
+class Searcher():
+    def __init__(self, timeLimit=TIME_LIMIT, tt=None, ordering=None):
+        self.timeLimit = timeLimit
+        self.tt = tt
+        self.ordering = ordering if ordering is not None else MoveOrderer()
+        self.deadline = None
+        self.nodes = 0
+        self.stopped = False
+        # SearchResult of every iteration that searched all root moves
+        self.completedIterations = []
+        # called with each completed iteration's SearchResult, e.g. for UCI info
+        self.onIteration = None
+
+    """
+    Iterative deepening: search depth 1, 2, ... and keep the result of the
+    last iteration. The previous best move is searched first so an
+    iteration cut short by the clock can still improve on it
+    """
+
+    def search(self, gs, validMoves, maxDepth=DEPTH):
+        startTime = time.time()
+        self.deadline = None if self.timeLimit is None else startTime + self.timeLimit
+        self.nodes = 0
+        self.stopped = False
+        self.completedIterations = []
+        if self.tt is not None:
+            self.tt.newSearch()
+        self.ordering.newSearch()
+        stats = SearchStats() if COLLECT_STATS else None
+        if stats is not None:
+            stats.attach(gs, self.tt)
+        try:
+            result = self.iterativeDeepening(gs, validMoves, maxDepth, startTime, stats)
+        finally:
+            if stats is not None:
+                stats.detach(gs)
+        result.nodes = self.nodes
+        result.elapsed = time.time()-startTime
+        result.firstMoveCutoffRate = self.ordering.firstMoveCutoffRate()
+        if stats is not None:
+            stats.finish(self.nodes, self.tt)
+            result.stats = stats
+        return result
+
+    def iterativeDeepening(self, gs, validMoves, maxDepth, startTime, stats):
+        rootMoves = list(validMoves)
+        random.shuffle(rootMoves)  # vary the choice between equal moves
+        result = SearchResult(rootMoves[0] if rootMoves else None, 0, 0, [], 0, 0.0)
+
+        for depth in range(1, maxDepth+1):
+            window = None
+            if ASPIRATION_WINDOWS and depth >= ASPIRATION_MIN_DEPTH and abs(result.score) < MATE_BOUND:
+                window = ASPIRATION_WINDOW
+            while True:
+                if window is None:
+                    alpha, beta = -CHECKMATE - 1, CHECKMATE + 1
+                else:
+                    alpha, beta = result.score - window, result.score + window
+                bestScore, bestMove, bestPv = self.searchRoot(gs, rootMoves, depth, alpha, beta)
+                if self.stopped or window is None or alpha < bestScore < beta:
+                    break
+                # failed low or high: widen the window once, then drop it
+                window = window*4 if window == ASPIRATION_WINDOW else None
+            if self.stopped and bestScore <= alpha:
+                bestMove = None  # only upper bounds, keep the last iteration
+            if bestMove is not None:
+                if self.tt is not None:
+                    bestPv = self.tablePv(gs, bestPv, depth)
+                # a partial iteration is only trusted because the previous
+                # best move was searched first
+                result = SearchResult(bestMove, bestScore, depth, bestPv,
+                                      self.nodes, time.time()-startTime)
+                rootMoves.remove(bestMove)
+                rootMoves.insert(0, bestMove)
+                if not self.stopped:
+                    self.completedIterations.append(result)
+                    if stats is not None:
+                        stats.recordIteration(depth, self.nodes, self.ordering.cutoffs,
+                                              self.ordering.firstMoveCutoffs)
+                    if self.onIteration is not None:
+                        self.onIteration(result)
+            if self.stopped or abs(bestScore) >= CHECKMATE - maxDepth:
+                break
+        return result
+
+    """
+    Search every root move in the window alpha, beta. Returns the best
+    score, move and principal variation, stopping early on a fail high
+    """
+
+    def searchRoot(self, gs, rootMoves, depth, alpha, beta):
+        bestScore = -CHECKMATE - 1
+        bestMove = None
+        bestPv = []
+        for move in rootMoves:
+            childPv = []
+            gs.makeMove(move)
+            score = -self.negaMax(gs, depth-1, -beta, -alpha, 1, childPv)
+            gs.undoMove()
+            if self.stopped:
+                break
+            if score > bestScore:
+                bestScore, bestMove, bestPv = score, move, [move] + childPv
+            if score > alpha:
+                alpha = score
+                if alpha >= beta:
+                    break
+        return bestScore, bestMove, bestPv
+
+    """
+    Negamax with alpha-beta pruning. Scores are from the point of view of
+    the side to move; pv is filled with the best line found below this node.
+    allowNull is False right after a null move
+    """
+
+    def negaMax(self, gs, depth, alpha, beta, ply, pv, allowNull=True):
+        self.nodes += 1
+        if self.deadline is not None and self.nodes & 1023 == 0 and time.time() > self.deadline:
+            self.stopped = True
+        if self.stopped:
+            return 0
+        if gs.isRepetition(2):
+            return STALEMATE
+        if USE_TABLEBASES and tablebasesAvailable:
+            score = probeTablebases(gs, ply)
+            if score is not None:
+                return score
+        inCheck = gs.inCheck()
+        if CHECK_EXTENSIONS and inCheck and ply < MAX_EXTENDED_PLY:
+            depth += 1
+        if depth == 0:
+            if QUIESCENCE:
+                return self.quiescence(gs, alpha, beta, ply)
+            return self.staticScore(gs)
+
+        alphaOrig = alpha
+        hashMove = 0
+        if self.tt is not None:
+            entry = self.tt.probe(gs.zobristKey)
+            if entry is not None:
+                entryDepth, entryScore, bound, hashMove = entry
+                if entryDepth >= depth:
+                    entryScore = scoreFromTable(entryScore, ply)
+                    if bound == EXACT:
+                        pv[:] = self.tablePv(gs, [], entryDepth)
+                        return entryScore
+                    if bound == LOWER and entryScore > alpha:
+                        alpha = entryScore
+                    elif bound == UPPER and entryScore < beta:
+                        beta = entryScore
+                    if alpha >= beta:
+                        return entryScore
+
+        if (NULL_MOVE and allowNull and depth >= NULL_MOVE_MIN_DEPTH and not inCheck
+                and abs(beta) < MATE_BOUND and hasPieces(gs) and self.staticScore(gs) >= beta):
+            state = gs.makeNullMove()
+            score = -self.negaMax(gs, depth-1-NULL_MOVE_REDUCTION, -beta, -beta+1, ply+1, [], False)
+            gs.undoNullMove(state)
+            if self.stopped:
+                return 0
+            if score >= beta:
+                return beta if score >= MATE_BOUND else score  # don't trust mates found by passing
+
+        futilityScore = None
+        if (FUTILITY_PRUNING and depth < len(FUTILITY_MARGINS) and not inCheck
+                and abs(alpha) < MATE_BOUND):
+            futilityScore = self.staticScore(gs) + FUTILITY_MARGINS[depth]
+            if futilityScore > alpha:
+                futilityScore = None
+
+        if STAGED_MOVES:
+            moves = self.ordering.stagedMoves(gs, hashMove, ply)
+        else:
+            moves = gs.getValidMoves()
+            self.ordering.orderMoves(moves, hashMove, ply, gs.whiteToMove)
+
+        bestScore = -CHECKMATE - 1
+        bestMove = None
+        movesFound = 0
+        for i, move in enumerate(moves):
+            movesFound += 1
+            childPv = []
+            quiet = move.pieceCaptured == "--" and not move.isPawnPromotion
+            futile = quiet and futilityScore is not None
+            reduce = (LATE_MOVE_REDUCTIONS and quiet and i >= LMR_MIN_MOVES
+                      and depth >= LMR_MIN_DEPTH and not inCheck)
+            gs.makeMove(move)
+            if (futile or reduce) and gs.inCheck():  # moves giving check are searched in full
+                futile = reduce = False
+            if futile:
+                gs.undoMove()
+                bestScore = max(bestScore, futilityScore)
+                continue
+            if reduce:
+                score = -self.negaMax(gs, depth-2, -alpha-1, -alpha, ply+1, childPv)
+                if score > alpha and not self.stopped:
+                    childPv = []
+                    score = -self.negaMax(gs, depth-1, -beta, -alpha, ply+1, childPv)
             else:
-                score = -turnMultiplier * scoreMaterial(gs.board)
+                score = -self.negaMax(gs, depth-1, -beta, -alpha, ply+1, childPv)
+            gs.undoMove()
+            if self.stopped:
+                return 0
+            if score > bestScore:
+                bestScore = score
+                bestMove = move
+                if score > alpha:
+                    alpha = score
+                    pv[:] = [move] + childPv
+                    if alpha >= beta:
+                        self.ordering.recordCutoff(move, depth, ply, gs.whiteToMove, i)
+                        break
+        if movesFound == 0:
+            # no legal moves, prefer the quickest mate
+            return -CHECKMATE + ply if inCheck else STALEMATE
+
+        if self.tt is not None:
+            if bestScore <= alphaOrig:
+                bound = UPPER
+            elif bestScore >= beta:
+                bound = LOWER
+            else:
+                bound = EXACT
+            self.tt.store(gs.zobristKey, depth, scoreToTable(bestScore, ply), bound,
+                          bestMove.packed if bound != UPPER and bestMove is not None else 0)
+        return bestScore
+
+    """
+    line followed by the moves stored in the transposition table after
+    it, up to length moves in all: the hash moves are followed while they
+    are legal. Fills in principal variations cut short by table hits
+    """
+
+    def tablePv(self, gs, line, length):
+        pv = list(line)
+        for move in pv:
+            gs.makeMove(move)
+        while len(pv) < length and not gs.isRepetition(2):
+            entry = self.tt.probe(gs.zobristKey)
+            move = gs.getLegalMove(entry[3]) if entry is not None and entry[3] else None
+            if move is None:
+                break
+            pv.append(move)
+            gs.makeMove(move)
+        for _ in pv:
+            gs.undoMove()
+        return pv
+
+    def staticScore(self, gs):
+        turnMultiplier = 1 if gs.whiteToMove else -1
+        score = gs.evaluate()
+        if DEBUG_EVAL:
+            assert score == evaluation.scoreBoard(gs.board), "incremental evaluation is out of sync"
+        return turnMultiplier * score
+
+    """
+    Quiescence search: at the horizon keep playing captures and
+    promotions until the position is quiet, so a leaf is never scored in
+    the middle of an exchange. The side to move may stand pat on the
+    static score; captures that can't lift it to alpha (delta pruning) or
+    that lose material by static exchange evaluation are skipped. In check
+    every evasion is searched
+    """
+
+    def quiescence(self, gs, alpha, beta, ply):
+        self.nodes += 1
+        if self.deadline is not None and self.nodes & 1023 == 0 and time.time() > self.deadline:
+            self.stopped = True
+        if self.stopped:
+            return 0
 
-            if score > opponentMaxScore:
-                opponentMaxScore = score
+        if gs.inCheck():
+            moves = gs.getValidMoves()
+            if len(moves) == 0:
+                return -CHECKMATE + ply
+            bestScore = -CHECKMATE - 1
+            standPat = None
+        else:
+            standPat = self.staticScore(gs)
+            if standPat >= beta:
+                return standPat
+            if standPat > alpha:
+                alpha = standPat
+            bestScore = standPat
+            moves = gs.getCaptureMoves()
+        self.ordering.orderMoves(moves, 0, ply, gs.whiteToMove)
+        # delta pruning is unsafe with little material left, where a
+        # single capture can decide the game
+        deltaPruning = standPat is not None and gs.phase > DELTA_MIN_PHASE
+
+        for move in moves:
+            if standPat is not None:
+                if move.isPawnPromotion and move.promotionPiece != 'Q':
+                    continue
+                if deltaPruning:
+                    gain = exchangeValue[move.pieceCaptured[1]] if move.pieceCaptured != "--" else 0
+                    if move.isPawnPromotion:
+                        gain += exchangeValue['Q'] - exchangeValue['p']
+                    if standPat + gain + DELTA_MARGIN <= alpha:
+                        continue
+                if gs.staticExchange(move) < 0:
+                    continue
+            gs.makeMove(move)
+            score = -self.quiescence(gs, -beta, -alpha, ply+1)
             gs.undoMove()
+            if self.stopped:
+                return 0
+            if score > bestScore:
+                bestScore = score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+        return bestScore
+
+
+""" True when the side to move has a piece besides its king and pawns,
+so passing is unlikely to be its best option """
+
+
+def hasPieces(gs):
+    color = 'w' if gs.whiteToMove else 'b'
+    for row in gs.board:
+        for piece in row:
+            if piece[0] == color and piece[1] in "NBRQ":
+                return True
+    return False
+
+
+""" Exact score of a position with few pieces from the endgame tables, or
+None when it is not covered. Mates are scored like the search's own """
 
-        if opponentMaxScore < opponentMinMaxScore:
-            opponentMinMaxScore = opponentMaxScore
-            bestPlayerMove = playerMove
 
-        gs.undoMove()
+def probeTablebases(gs, ply):
+    if 64 - sum(row.count("--") for row in gs.board) > tablebase.MAX_PIECES:
+        return None
+    result = tablebase.tablebases.probe(gs)
+    if result is None:
+        return None
+    outcome, plies = result
+    if outcome == tablebase.DRAW:
+        return STALEMATE
+    if outcome == tablebase.WIN:
+        return CHECKMATE - ply - plies
+    return -CHECKMATE + ply + plies
 
-    return bestPlayerMove
+
+""" Mate scores count plies from the root; the table stores them counted
+from the node so they stay valid when reached through another path """
+
+
+def scoreToTable(score, ply):
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def scoreFromTable(score, ply):
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
 
 
 """ Calculate the Score of board based on material """
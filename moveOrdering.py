@@ -0,0 +1,140 @@
+""" Move ordering for the alpha-beta search in moveAI.
+Moves are tried hash move first, then captures by MVV-LVA (most valuable
+victim, least valuable attacker), then killer moves, then quiet moves by
+their history score. orderMoves sorts a complete move list, stagedMoves
+generates the moves in that order stage by stage. """
+
+MAX_PLY = 64
+KILLERS_PER_PLY = 2
+
+# piece values used only to rank captures
+victimValue = {"p": 1, "N": 3, "B": 3, "R": 5, "Q": 9, "K": 10}
+
+HASH_MOVE_SCORE = 1 << 30
+CAPTURE_SCORE = 1 << 28
+KILLER_SCORE = 1 << 26  # history scores stay below this
+
+
+class MoveOrderer():
+    def __init__(self):
+        # killers[ply] holds the packed moves of recent quiet cutoff moves
+        self.killers = [[None]*KILLERS_PER_PLY for _ in range(MAX_PLY)]
+        # history[color][packed & 0xFFF], indexed by the from and to squares,
+        # 0 is white and 1 is black
+        self.history = [[0]*4096, [0]*4096]
+        self.resetStats()
+
+    def resetStats(self):
+        self.cutoffs = 0
+        self.firstMoveCutoffs = 0
+
+    """
+    Called at the start of a search: forget the killers, which belong to
+    the previous position, and halve the history so it favours recent play
+    """
+
+    def newSearch(self):
+        self.killers = [[None]*KILLERS_PER_PLY for _ in range(MAX_PLY)]
+        for table in self.history:
+            for i in range(4096):
+                table[i] >>= 1
+        self.resetStats()
+
+    """
+    Sort moves in place, best candidates first
+    """
+
+    def orderMoves(self, moves, hashMove, ply, whiteToMove):
+        killers = self.killers[ply] if ply < MAX_PLY else ()
+        history = self.history[0 if whiteToMove else 1]
+
+        def moveScore(move):
+            if move.packed == hashMove:
+                return HASH_MOVE_SCORE
+            if move.pieceCaptured != "--" or move.isPawnPromotion:
+                return captureScore(move)
+            if move.packed in killers:
+                return KILLER_SCORE
+            return history[move.packed & 0xFFF]
+
+        moves.sort(key=moveScore, reverse=True)
+        return moves
+
+    """
+    Generate the legal moves of gs lazily, in the order of orderMoves:
+    the hash move, captures and promotions, killers, then quiet moves.
+    Each stage is only generated once the moves before it have been used
+    up, so a node that cuts off early skips most of the generation. The
+    hash move and killers are checked for legality on their own. The
+    caller must undo each move before asking for the next
+    """
+
+    def stagedMoves(self, gs, hashMove, ply):
+        pinsAndChecks = gs.getPinsAndChecks()
+        tried = []  # packed hash and killer moves already yielded
+        if hashMove:
+            move = gs.getLegalMove(hashMove, pinsAndChecks)
+            if move is not None:
+                tried.append(hashMove)
+                yield move
+
+        captures = gs.getCaptureMoves(pinsAndChecks)
+        captures.sort(key=captureScore, reverse=True)
+        for move in captures:
+            if move.packed not in tried:
+                yield move
+
+        for killer in (self.killers[ply] if ply < MAX_PLY else ()):
+            if killer is not None and killer not in tried:
+                move = gs.getLegalMove(killer, pinsAndChecks)
+                # a killer that captures here was already tried as a capture
+                if move is not None and move.pieceCaptured == "--" and not move.isPawnPromotion:
+                    tried.append(killer)
+                    yield move
+
+        history = self.history[0 if gs.whiteToMove else 1]
+        quiets = gs.getQuietMoves(pinsAndChecks)
+        quiets.sort(key=lambda move: history[move.packed & 0xFFF], reverse=True)
+        for move in quiets:
+            if move.packed not in tried:
+                yield move
+
+    """
+    Record a beta cutoff. moveIndex is the position of the move in the
+    ordered list, so index 0 counts towards the first move cutoff rate
+    """
+
+    def recordCutoff(self, move, depth, ply, whiteToMove, moveIndex):
+        self.cutoffs += 1
+        if moveIndex == 0:
+            self.firstMoveCutoffs += 1
+        if move.pieceCaptured != "--" or move.isPawnPromotion:
+            return
+        if ply < MAX_PLY:
+            killers = self.killers[ply]
+            if killers[0] != move.packed:
+                killers[1] = killers[0]
+                killers[0] = move.packed
+        history = self.history[0 if whiteToMove else 1]
+        index = move.packed & 0xFFF
+        history[index] = min(history[index] + depth*depth, KILLER_SCORE - 1)
+
+    """
+    Share of beta cutoffs produced by the first move tried, the usual
+    measure of ordering quality (above 0.9 is good)
+    """
+
+    def firstMoveCutoffRate(self):
+        return self.firstMoveCutoffs / self.cutoffs if self.cutoffs else 0.0
+
+
+""" Sort score of a capture or promotion, above every quiet move """
+
+
+def captureScore(move):
+    score = CAPTURE_SCORE
+    if move.pieceCaptured != "--":
+        score += victimValue[move.pieceCaptured[1]] * 16 - victimValue[move.pieceMoved[1]]
+    if move.isPawnPromotion:
+        score += victimValue[move.promotionPiece] * 16
+    return score
@@ -0,0 +1,241 @@
+""" Opening book read through mmap. After a 16 byte header each entry is
+16 big endian bytes: position key (8), move (2), weight (2) and learn (4),
+sorted by key, the entry and move layout of Polyglot. A lookup binary
+searches the mapped file, so a book of any size costs no memory beyond
+the pages touched.
+
+The books are not Polyglot compatible: the keys are this engine's zobrist
+keys (GameState.zobristKey), not the published Polyglot random numbers.
+A book without this engine's header, e.g. a downloaded Polyglot book, is
+refused when opened. Books are built from PGN with the tool below:
+
+    python openingBook.py build games.pgn more.pgn -o book.bin --plies 24
+    python openingBook.py probe --fen "<fen>" --book book.bin
+"""
+
+import argparse
+import mmap
+import os
+import random
+import re
+import struct
+import sys
+
+import chessEngine
+
+STARTING_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+HEADER = struct.Struct(">4sH10x")  # magic, version, padded to an entry
+MAGIC = b"CEBK"
+VERSION = 1
+ENTRY = struct.Struct(">QHHI")
+PROMOTION_BITS = {"N": 1, "B": 2, "R": 3, "Q": 4}
+MAX_WEIGHT = 0xFFFF
+# points to the side that played a move, by game result
+RESULT_POINTS = {"win": 2, "draw": 1, "loss": 0, "unknown": 1}
+
+
+""" Polyglot move word: to file | to rank << 3 | from file << 6 | from rank
+<< 9 | promotion << 12, ranks counted from white's side. Castling is
+written as the king taking its own rook """
+
+
+def encodeBookMove(move):
+    endCol = move.endCol
+    if move.isCastleMove:
+        endCol = 7 if move.endCol > move.startCol else 0
+    word = endCol | (7 - move.endRow) << 3 | move.startCol << 6 | (7 - move.startRow) << 9
+    if move.isPawnPromotion:
+        word |= PROMOTION_BITS[move.promotionPiece] << 12
+    return word
+
+
+class OpeningBook():
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        header = self.file.read(HEADER.size)
+        if len(header) < HEADER.size or HEADER.unpack(header) != (MAGIC, VERSION):
+            self.file.close()
+            raise ValueError("%s is not a book built by openingBook.py (Polyglot books use other keys)" % path)
+        self.entries = (size - HEADER.size) // ENTRY.size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    """
+    (move word, weight) of every entry for the key
+    """
+
+    def findEntries(self, key):
+        low, high = 0, self.entries
+        while low < high:  # first entry with a key not below the one asked for
+            middle = (low + high) // 2
+            if ENTRY.unpack_from(self.data, HEADER.size + middle * ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        found = []
+        for index in range(low, self.entries):
+            entryKey, moveWord, weight, _ = ENTRY.unpack_from(self.data, HEADER.size + index * ENTRY.size)
+            if entryKey != key:
+                break
+            found.append((moveWord, weight))
+        return found
+
+    """
+    Book moves of the position as (move, weight), the moves taken from
+    validMoves
+    """
+
+    def getMoves(self, gs, validMoves):
+        entries = self.findEntries(gs.zobristKey)
+        if not entries:
+            return []
+        byWord = {encodeBookMove(move): move for move in validMoves}
+        return [(byWord[word], weight) for word, weight in entries if word in byWord and weight > 0]
+
+    """
+    A book move picked at random in proportion to its weight, or None when
+    the position is out of book
+    """
+
+    def pickMove(self, gs, validMoves, rng=random):
+        moves = self.getMoves(gs, validMoves)
+        if not moves:
+            return None
+        pick = rng.randrange(sum(weight for _, weight in moves))
+        for move, weight in moves:
+            pick -= weight
+            if pick < 0:
+                return move
+
+
+""" Lazily yield (headers, move text) for every game of an open PGN file """
+
+
+def readPgnGames(lines):
+    headers = {}
+    moveText = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith("["):
+            if moveText:
+                yield headers, " ".join(moveText)
+                headers, moveText = {}, []
+            match = re.match(r'\[(\w+)\s+"(.*)"\]', line)
+            if match:
+                headers[match.group(1)] = match.group(2)
+        elif line and not line.startswith("%"):
+            moveText.append(line)
+    if moveText:
+        yield headers, " ".join(moveText)
+
+
+""" SAN moves of a PGN move text, without comments, variations, NAGs, move
+numbers and the result """
+
+
+def pgnMoves(moveText):
+    moveText = re.sub(r"\{[^}]*\}|;[^\n]*", " ", moveText)
+    while "(" in moveText:  # variations may nest
+        stripped = re.sub(r"\([^()]*\)", " ", moveText)
+        if stripped == moveText:
+            break
+        moveText = stripped
+    moves = []
+    for token in moveText.split():
+        token = re.sub(r"^\d+\.+", "", token)
+        if not token or token.startswith("$") or token in ("1-0", "0-1", "1/2-1/2", "*"):
+            continue
+        moves.append(token)
+    return moves
+
+
+""" Count book entries from PGN games: every move of the first plies of a
+game scores RESULT_POINTS for its side. Returns {(key, move word): points} """
+
+
+def collectBookMoves(pgnFiles, plies, counts=None):
+    counts = {} if counts is None else counts
+    gs = chessEngine.GameState()
+    for pgnFile in pgnFiles:
+        for headers, moveText in readPgnGames(pgnFile):
+            result = headers.get("Result", "*")
+            try:
+                gs.loadFen(headers.get("FEN", STARTING_FEN))
+            except ValueError:
+                continue
+            for san in pgnMoves(moveText)[:plies]:
+                move = gs.parseMove(san)
+                if move is None:
+                    break  # bad or ambiguous move text, keep what came before
+                if result == "1/2-1/2":
+                    outcome = "draw"
+                elif result in ("1-0", "0-1"):
+                    outcome = "win" if (result == "1-0") == gs.whiteToMove else "loss"
+                else:
+                    outcome = "unknown"
+                entry = (gs.zobristKey, encodeBookMove(move))
+                counts[entry] = counts.get(entry, 0) + RESULT_POINTS[outcome]
+                gs.makeMove(move)
+    return counts
+
+
+""" Write the counted entries as a sorted book, scaling weights to 16 bits.
+Returns the number of entries written """
+
+
+def writeBook(counts, path):
+    top = max(counts.values(), default=0)
+    scale = min(1.0, MAX_WEIGHT / top) if top else 1.0
+    written = 0
+    with open(path, "wb") as out:
+        out.write(HEADER.pack(MAGIC, VERSION))
+        for (key, moveWord), points in sorted(counts.items()):
+            weight = int(points * scale)
+            if weight > 0:
+                out.write(ENTRY.pack(key, moveWord, weight, 0))
+                written += 1
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query an opening book")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build a book from PGN files")
+    build.add_argument("pgn", nargs="+")
+    build.add_argument("-o", "--output", default="book.bin")
+    build.add_argument("--plies", type=int, default=24, help="moves from the start of each game to use")
+    probe = commands.add_parser("probe", help="list the book moves of a position")
+    probe.add_argument("--book", default="book.bin")
+    probe.add_argument("--fen", help="the start position by default")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        counts = {}
+        for path in args.pgn:
+            with open(path, errors="replace") as pgnFile:
+                collectBookMoves([pgnFile], args.plies, counts)
+        written = writeBook(counts, args.output)
+        print("%d entries written to %s" % (written, args.output))
+        return 0
+
+    gs = chessEngine.GameState()
+    if args.fen:
+        gs.loadFen(args.fen)
+    try:
+        book = OpeningBook(args.book)
+    except ValueError as error:
+        print(error)
+        return 1
+    validMoves = gs.getValidMoves()
+    for move, weight in sorted(book.getMoves(gs, validMoves), key=lambda entry: -entry[1]):
+        print("%-7s %d" % (gs.getSan(move, validMoves), weight))
+    book.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
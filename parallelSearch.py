@@ -0,0 +1,212 @@
+""" Root parallel search over a pool of worker processes.
+The root moves are dealt out to the workers, each of which runs the
+moveAI iterative deepening search on its share. The pool is created once
+and reused between AI turns, so every worker keeps its own transposition
+table and move ordering history warm. Positions are sent as the start FEN
+plus the packed moves played since (GameState.serialize).
+
+    python parallelSearch.py --workers 4 --depth 4     # speedup benchmark
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import chessEngine
+import moveAI
+from moveOrdering import MoveOrderer
+
+# one game state per worker process, reused between tasks
+workerGameState = None
+# the pool's stop flag and deadline (0.0 for none), shared by its workers
+workerStop = None
+workerDeadline = None
+
+
+def initWorker(stop, deadline):
+    global workerGameState, workerStop, workerDeadline
+    workerGameState = chessEngine.GameState()
+    workerStop = stop
+    workerDeadline = deadline
+
+
+""" Runs beside a worker's search until finished is set, passing on a stop
+or a new deadline from the pool """
+
+
+def watchSearch(searcher, finished):
+    while not finished.wait(0.01):
+        if workerStop.is_set():
+            searcher.stopped = True
+        if workerDeadline.value:
+            searcher.deadline = workerDeadline.value
+
+
+""" Runs in a worker: search the given root moves and return every
+completed iteration as plain data """
+
+
+def searchRootMoves(startFen, packedMoves, rootPacked, depth, timeLimit):
+    gs = workerGameState
+    gs.loadSerialized(startFen, packedMoves)
+    rootMoves = [move for move in gs.getValidMoves() if move.packed in rootPacked]
+    searcher = moveAI.Searcher(timeLimit, moveAI.transpositionTable, moveAI.moveOrderer)
+    finished = threading.Event()
+    watcher = threading.Thread(target=watchSearch, args=(searcher, finished), daemon=True)
+    watcher.start()
+    try:
+        result = searcher.search(gs, rootMoves, depth)
+    finally:
+        finished.set()
+        watcher.join()
+    iterations = [(iteration.depth, iteration.score, [move.packed for move in iteration.pv])
+                  for iteration in searcher.completedIterations]
+    return iterations, result.nodes
+
+
+class SearchPool():
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        context = multiprocessing.get_context()
+        self.stop = context.Event()
+        self.deadline = context.Value('d', 0.0, lock=False)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                            initializer=initWorker, initargs=(self.stop, self.deadline))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    """
+    Split the root moves over the workers and combine their results. The
+    answer comes from the deepest iteration every worker completed, so
+    scores compared across workers are all from the same depth
+    """
+
+    def search(self, gs, validMoves, depth=moveAI.DEPTH, timeLimit=moveAI.TIME_LIMIT):
+        startTime = time.time()
+        self.stop.clear()
+        self.deadline.value = 0.0 if timeLimit is None else startTime + timeLimit
+        if len(validMoves) == 0:
+            return moveAI.SearchResult(None, 0, 0, [], 0, 0.0)
+        # deal likely good moves (captures first) round robin so every
+        # worker gets a similar mix
+        rootMoves = MoveOrderer().orderMoves(list(validMoves), 0, 0, gs.whiteToMove)
+        shares = [rootMoves[i::self.workers] for i in range(self.workers)]
+        startFen, packedMoves = gs.serialize()
+        futures = [self.executor.submit(searchRootMoves, startFen, packedMoves,
+                                        {move.packed for move in share}, depth, timeLimit)
+                   for share in shares if share]
+        workerResults = [future.result() for future in futures]
+
+        nodes = sum(workerNodes for _, workerNodes in workerResults)
+        finished = [iterations for iterations, _ in workerResults if iterations]
+        if not finished:
+            return moveAI.SearchResult(rootMoves[0], 0, 0, [rootMoves[0]], nodes, time.time()-startTime)
+        commonDepth = min(iterations[-1][0] for iterations in finished)
+        bestDepth, bestScore, bestPv = None, None, None
+        for iterations in finished:
+            for iterationDepth, score, pv in iterations:
+                if iterationDepth == commonDepth and (bestScore is None or score > bestScore):
+                    bestDepth, bestScore, bestPv = iterationDepth, score, pv
+        # turn the packed principal variation back into moves
+        pv = []
+        for packed in bestPv:
+            pv.append(chessEngine.Move.fromPacked(packed, gs.board))
+            gs.makeMove(pv[-1])
+        for _ in pv:
+            gs.undoMove()
+        bestMove = next(move for move in validMoves if move.packed == bestPv[0])
+        return moveAI.SearchResult(bestMove, bestScore, bestDepth, pv, nodes, time.time()-startTime)
+
+
+""" A search on a pool with the interface of moveAI.Searcher: search() and
+stopped and deadline, which another thread may set while it runs """
+
+
+class ParallelSearcher():
+    def __init__(self, pool, timeLimit=moveAI.TIME_LIMIT):
+        self.pool = pool
+        self.timeLimit = timeLimit
+
+    def search(self, gs, validMoves, maxDepth=moveAI.DEPTH):
+        return self.pool.search(gs, validMoves, maxDepth, self.timeLimit)
+
+    @property
+    def stopped(self):
+        return self.pool.stop.is_set()
+
+    @stopped.setter
+    def stopped(self, stopped):
+        if stopped:
+            self.pool.stop.set()
+        else:
+            self.pool.stop.clear()
+
+    @property
+    def deadline(self):
+        return self.pool.deadline.value or None
+
+    @deadline.setter
+    def deadline(self, deadline):
+        self.pool.deadline.value = deadline or 0.0
+
+
+# pools by worker count, created on first use and kept for later turns
+searchPools = {}
+
+
+def getSearchPool(workers):
+    if workers not in searchPools:
+        searchPools[workers] = SearchPool(workers)
+    return searchPools[workers]
+
+
+""" Time a fixed depth search in this process and on the pool. Returns
+(single process seconds, parallel seconds, speedup) """
+
+
+def measureSpeedup(gs, depth, workers):
+    validMoves = gs.getValidMoves()
+    pool = getSearchPool(workers)
+    # warm the pool up so process start up is not counted
+    pool.search(gs, validMoves, 1, None)
+
+    moveAI.transpositionTable.clear()
+    startTime = time.time()
+    single = moveAI.Searcher(None, moveAI.transpositionTable, MoveOrderer()).search(gs, validMoves, depth)
+    singleTime = time.time() - startTime
+
+    startTime = time.time()
+    parallel = pool.search(gs, validMoves, depth, None)
+    parallelTime = time.time() - startTime
+    print("single   depth %d  score %6d  nodes %8d  %.2fs  %s" % (
+        single.depth, single.score, single.nodes, singleTime, single.bestMove.getChessNotation()))
+    print("parallel depth %d  score %6d  nodes %8d  %.2fs  %s  (%d workers)" % (
+        parallel.depth, parallel.score, parallel.nodes, parallelTime,
+        parallel.bestMove.getChessNotation(), workers))
+    return singleTime, parallelTime, singleTime / parallelTime if parallelTime > 0 else 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the root parallel search")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--depth", type=int, default=moveAI.DEPTH)
+    parser.add_argument("--fen", help="position to search, the start position by default")
+    args = parser.parse_args(argv)
+
+    gs = chessEngine.GameState()
+    if args.fen:
+        gs.loadFen(args.fen)
+    singleTime, parallelTime, speedup = measureSpeedup(gs, args.depth, args.workers)
+    print("speedup %.2fx" % speedup)
+    for pool in searchPools.values():
+        pool.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+""" Perft: count the leaf nodes of the legal move tree to a given depth.
+Used to measure move generator speed and to check it against published
+node counts. Runs headless, pygame is not needed.
+
+    python perft.py                       # run the suite to depth 3 on both backends
+    python perft.py --depth 4 --position kiwipete --divide
+    python perft.py --fen "<fen>" --depth 2 --backend bitboard
+
+The suite also checks, in every position of the tree, that the staged
+generators partition the legal moves: getCaptureMoves is the legal
+captures and promotions, adding getQuietMoves gives getValidMoves, and
+getLegalMove accepts exactly the legal moves. It also checks that loadFen
+refuses impossible positions and drops castling rights it can't use.
+"""
+
+import argparse
+import sys
+import time
+
+import chessEngine
+import bitboardEngine
+
+STARTING_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# name -> (fen, known node counts for depth 1, 2, ...)
+POSITIONS = {
+    "initial": (STARTING_FEN,
+                [20, 400, 8902, 197281, 4865609]),
+    "kiwipete": ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+                 [48, 2039, 97862, 4085603]),
+    # en passant discovered checks along the rank
+    "position3": ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+                  [14, 191, 2812, 43238, 674624]),
+    # promotions, under promotions and castling rights lost to captures
+    "position4": ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+                  [6, 264, 9467, 422333]),
+    "position4mirrored": ("r2q1rk1/pP1p2pp/Q4n2/bbp1p3/Np6/1B3NBn/pPPP1PPP/R3K2R b KQ - 0 1",
+                          [6, 264, 9467, 422333]),
+    "position5": ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+                  [44, 1486, 62379, 2103487]),
+    "position6": ("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+                  [46, 2079, 89890, 3894594]),
+}
+
+# checked by the partition test only, no known node counts
+PARTITION_POSITIONS = {
+    # a king in check may not step back along the checking rook's line
+    "kingOnCheckRay": "B4b2/6k1/2Q1n3/6Rp/1n1r4/2p4K/2P4P/R4r2 b - - 0 40",
+    # nor capture a piece behind it on that line
+    "kingCaptureOnCheckRay": "4r2k/8/8/8/8/8/4K3/4n3 w - - 0 1",
+}
+
+# loadFen must refuse these with ValueError
+BAD_FENS = {
+    "enpassantOffBoard": "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq e9 0 1",
+    "enpassantWrongRank": "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR w KQkq e3 0 1",
+    "noBlackKing": "8/8/8/8/8/8/8/K7 w - - 0 1",
+    "twoBlackKings": "kk6/8/8/8/8/8/8/K7 w - - 0 1",
+    "pawnOnLastRank": "P3k3/8/8/8/8/8/8/4K3 w - - 0 1",
+    "pawnOnFirstRank": "4k3/8/8/8/8/8/8/p3K3 b - - 0 1",
+    "sideNotToMoveInCheck": "8/8/8/8/8/2k5/8/K1Q5 w - - 0 1",
+}
+
+# FEN -> the castling field loadFen keeps, rights without their king and
+# rook on the home squares are dropped
+CASTLING_FENS = {
+    "4k3/8/8/8/8/8/8/4K3 w K - 0 1": "-",
+    "r3k3/8/8/8/8/8/8/R3K2R w KQkq - 0 1": "KQq",
+    "r3k2r/8/8/8/8/8/8/1R2K2R b KQkq - 0 1": "Kkq",
+    "r3k2r/8/8/8/8/8/8/R4K1R w KQkq - 0 1": "kq",
+}
+
+BACKENDS = ("mailbox", "bitboard", "reference")
+# run by the suite when no backend is named
+SUITE_BACKENDS = ("mailbox", "bitboard")
+
+
+""" Count leaf nodes below the position to the given depth """
+
+
+def perft(gs, depth):
+    if depth == 0:
+        return 1
+    moves = gs.getValidMoves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        gs.makeMove(move)
+        nodes += perft(gs, depth-1)
+        gs.undoMove()
+    return nodes
+
+
+""" Walk the tree to the given depth and return the number of positions
+where the staged generators disagree with getValidMoves. candidates are
+packed moves to try with getLegalMove besides the legal ones, the
+parent's moves are a good source of nearly legal ones """
+
+
+def checkPartition(gs, depth, candidates=(), out=sys.stdout):
+    moves = gs.getValidMoves()
+    legal = sorted(move.packed for move in moves)
+    captures = gs.getCaptureMoves()
+    staged = sorted(move.packed for move in captures + gs.getQuietMoves())
+    errors = 0
+    if staged != legal:
+        out.write("partition mismatch in %s\n" % gs.getFen())
+        errors += 1
+    # what quiescence searches: every capture and promotion, nothing else
+    expectedCaptures = sorted(move.packed for move in moves
+                              if move.pieceCaptured != "--" or move.isPawnPromotion)
+    if sorted(move.packed for move in captures) != expectedCaptures:
+        out.write("capture moves wrong in %s\n" % gs.getFen())
+        errors += 1
+    legalSet = set(legal)
+    for packed in set(candidates) | legalSet:
+        move = gs.getLegalMove(packed)
+        if (move is not None) != (packed in legalSet):
+            out.write("getLegalMove(%d) wrong in %s\n" % (packed, gs.getFen()))
+            errors += 1
+    if depth > 0:
+        for move in moves:
+            gs.makeMove(move)
+            errors += checkPartition(gs, depth-1, legal, out)
+            gs.undoMove()
+    return errors
+
+
+""" Load BAD_FENS and CASTLING_FENS and return the number that loadFen
+handles wrongly """
+
+
+def checkFens(backend="mailbox", out=sys.stdout):
+    errors = 0
+    for name, fen in BAD_FENS.items():
+        try:
+            makeGameState(fen, backend)
+        except ValueError:
+            continue
+        out.write("%s loaded: %s\n" % (name, fen))
+        errors += 1
+    for fen, castling in CASTLING_FENS.items():
+        gs = makeGameState(fen, backend)
+        kept = gs.getFen().split()[2]
+        castles = [move for move in gs.getValidMoves() if move.isCastleMove]
+        if kept != castling or (castles and castling == "-"):
+            out.write("castling %s instead of %s: %s\n" % (kept, castling, fen))
+            errors += 1
+    return errors
+
+
+""" Leaf node count below each root move, as (notation, nodes) pairs """
+
+
+def divide(gs, depth):
+    counts = []
+    for move in gs.getValidMoves():
+        gs.makeMove(move)
+        counts.append((move.getChessNotation(), perft(gs, depth-1)))
+        gs.undoMove()
+    return counts
+
+
+""" Game state for a FEN using one of the move generators """
+
+
+def makeGameState(fen, backend="mailbox"):
+    if backend == "bitboard":
+        gs = bitboardEngine.BitboardGameState()
+    else:
+        gs = chessEngine.GameState()
+        gs.referenceMoveGen = backend == "reference"
+    gs.loadFen(fen)
+    return gs
+
+
+""" Run perft on every named position up to maxDepth and compare with the
+known counts. Returns True when every count matches """
+
+
+def runSuite(maxDepth, backend="mailbox", names=None, out=sys.stdout):
+    allPassed = True
+    totalNodes = 0
+    totalTime = 0.0
+    for name in names or POSITIONS:
+        fen, expected = POSITIONS[name]
+        for depth in range(1, min(maxDepth, len(expected)) + 1):
+            gs = makeGameState(fen, backend)
+            startTime = time.time()
+            nodes = perft(gs, depth)
+            elapsed = time.time() - startTime
+            totalNodes += nodes
+            totalTime += elapsed
+            passed = nodes == expected[depth-1]
+            allPassed = allPassed and passed
+            out.write("%-18s depth %d  nodes %10d  expected %10d  %6.2fs  %8.0f nps  %s\n" % (
+                name, depth, nodes, expected[depth-1], elapsed,
+                nodes / elapsed if elapsed > 0 else 0, "ok" if passed else "FAIL"))
+    # the partition walk is slower than perft, two plies are plenty
+    partitionDepth = min(maxDepth - 1, 2)
+    fens = [POSITIONS[name][0] for name in names or POSITIONS]
+    if names is None:
+        fens += PARTITION_POSITIONS.values()
+    errors = sum(checkPartition(makeGameState(fen, backend), partitionDepth, out=out) for fen in fens)
+    allPassed = allPassed and errors == 0
+    out.write("partition to depth %d: %s\n" % (partitionDepth, "ok" if errors == 0 else "%d FAILED" % errors))
+    errors = checkFens(backend, out)
+    allPassed = allPassed and errors == 0
+    out.write("fen validation: %s\n" % ("ok" if errors == 0 else "%d FAILED" % errors))
+    out.write("total %d nodes in %.2fs, %.0f nodes/sec: %s\n" % (
+        totalNodes, totalTime, totalNodes / totalTime if totalTime > 0 else 0,
+        "all passed" if allPassed else "FAILED"))
+    return allPassed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Perft move generator benchmark and validation")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--position", choices=sorted(POSITIONS), help="run a single named position")
+    parser.add_argument("--fen", help="run an arbitrary position (no known count to compare)")
+    parser.add_argument("--divide", action="store_true", help="print the node count below each root move")
+    parser.add_argument("--backend", choices=BACKENDS,
+                        help="the suite runs %s by default, single positions mailbox" % " and ".join(SUITE_BACKENDS))
+    args = parser.parse_args(argv)
+
+    if args.fen is None and not args.divide:
+        names = [args.position] if args.position else None
+        allPassed = True
+        for backend in [args.backend] if args.backend else SUITE_BACKENDS:
+            print("%s backend" % backend)
+            allPassed = runSuite(args.depth, backend, names) and allPassed
+        return 0 if allPassed else 1
+
+    fen = args.fen or POSITIONS[args.position or "initial"][0]
+    gs = makeGameState(fen, args.backend or "mailbox")
+    startTime = time.time()
+    if args.divide:
+        counts = divide(gs, args.depth)
+        for notation, nodes in sorted(counts):
+            print("%s: %d" % (notation, nodes))
+        nodes = sum(count for _, count in counts)
+    else:
+        nodes = perft(gs, args.depth)
+    elapsed = time.time() - startTime
+    print("nodes %d  time %.2fs  %.0f nodes/sec" % (nodes, elapsed, nodes / elapsed if elapsed > 0 else 0))
+    if args.fen is None:
+        expected = POSITIONS[args.position or "initial"][1]
+        if args.depth <= len(expected):
+            print("expected %d: %s" % (expected[args.depth-1], "ok" if nodes == expected[args.depth-1] else "FAIL"))
+            return 0 if nodes == expected[args.depth-1] else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
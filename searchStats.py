@@ -0,0 +1,153 @@
+""" Opt-in statistics for one AI search.
+Counts per iteration (nodes, nodes/sec, effective branching factor, beta
+cutoff rates) and time spent per phase of the work: move generation, the
+legality filter of the generators (pins and checks, attacked squares),
+the search's own make/unmake, its check tests and evaluation.
+
+Phase timing wraps the game state's methods on the instance for the
+length of the search and removes the wrappers afterwards, so nothing in
+GameState or the search pays for it when stats are off (moveAI.COLLECT_STATS).
+Times are exclusive below move generation: the legality filter run by
+getValidMoves is timed as legality, not move generation. Any other timed
+call counts to its caller, e.g. the makeMove of the en passant legality
+test is legality and the attack test of inCheck is check detection.
+"""
+
+import json
+import time
+
+# phase -> GameState methods timed under it
+PHASES = {"moveGeneration": ("getValidMoves", "getCaptureMoves", "getQuietMoves", "getLegalMove"),
+          "legality": ("getPinsAndChecks", "squareUnderAttack", "isSquareAttacked", "isEnpassantLegal"),
+          "makeUnmake": ("makeMove", "undoMove", "makeNullMove", "undoNullMove"),
+          "checkDetection": ("inCheck",),
+          "evaluation": ("evaluate", "staticExchange")}
+# calls made inside these phases are timed under their own phase, inside
+# any other they count to the caller
+SPLIT_PHASES = ("moveGeneration",)
+
+
+class DepthStats():
+    def __init__(self, depth, nodes, elapsed, cutoffs, firstMoveCutoffs, branchingFactor):
+        self.depth = depth
+        self.nodes = nodes
+        self.elapsed = elapsed
+        self.cutoffs = cutoffs
+        self.firstMoveCutoffs = firstMoveCutoffs
+        # nodes of this iteration over nodes of the one before
+        self.branchingFactor = branchingFactor
+
+    def toDict(self):
+        return {"depth": self.depth, "nodes": self.nodes, "seconds": round(self.elapsed, 4),
+                "nodesPerSecond": round(self.nodes / self.elapsed) if self.elapsed > 0 else 0,
+                "branchingFactor": round(self.branchingFactor, 2) if self.branchingFactor else None,
+                "cutoffs": self.cutoffs,
+                "firstMoveCutoffRate": round(self.firstMoveCutoffs / self.cutoffs, 3) if self.cutoffs else 0.0}
+
+
+class SearchStats():
+    def __init__(self):
+        self.depths = []
+        self.phaseTimes = {phase: 0.0 for phase in PHASES}
+        self.phaseCalls = {phase: 0 for phase in PHASES}
+        self.nodes = 0
+        self.elapsed = 0.0
+        self.ttProbes = self.ttHits = 0
+        self.startTime = None
+        # exclusive timing: phase and time of nested timed calls per open call
+        self.openPhases = []
+        self.childTimes = []
+        self.lastIterationEnd = None
+
+    """
+    Start timing the phases of gs and the search as a whole
+    """
+
+    def attach(self, gs, tt=None):
+        self.startTime = self.lastIterationEnd = time.time()
+        if tt is not None:
+            # the table's counters run across searches
+            self.ttProbes, self.ttHits = -tt.probes, -tt.hits
+        for phase, names in PHASES.items():
+            for name in names:
+                if hasattr(gs, name):  # some only exist on one backend
+                    setattr(gs, name, self.timed(phase, getattr(gs, name)))
+
+    """
+    Remove the timers, the class methods show through again
+    """
+
+    def detach(self, gs):
+        for names in PHASES.values():
+            for name in names:
+                gs.__dict__.pop(name, None)
+        self.elapsed = time.time() - self.startTime
+
+    def timed(self, phase, method):
+        phaseTimes, phaseCalls = self.phaseTimes, self.phaseCalls
+        openPhases, childTimes = self.openPhases, self.childTimes
+
+        def wrapper(*args, **kwargs):
+            if openPhases and openPhases[-1] not in SPLIT_PHASES:
+                return method(*args, **kwargs)
+            openPhases.append(phase)
+            childTimes.append(0.0)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                openPhases.pop()
+                phaseTimes[phase] += elapsed - childTimes.pop()
+                phaseCalls[phase] += 1
+                if childTimes:
+                    childTimes[-1] += elapsed
+        return wrapper
+
+    """
+    Record a finished iteration from the searcher's cumulative counters
+    """
+
+    def recordIteration(self, depth, nodes, cutoffs, firstMoveCutoffs):
+        now = time.time()
+        previous = self.depths[-1] if self.depths else None
+        done = sum(record.nodes for record in self.depths)
+        doneCutoffs = sum(record.cutoffs for record in self.depths)
+        doneFirst = sum(record.firstMoveCutoffs for record in self.depths)
+        iterationNodes = nodes - done
+        branchingFactor = iterationNodes / previous.nodes if previous and previous.nodes else None
+        self.depths.append(DepthStats(depth, iterationNodes, now - self.lastIterationEnd,
+                                      cutoffs - doneCutoffs, firstMoveCutoffs - doneFirst, branchingFactor))
+        self.lastIterationEnd = now
+
+    def finish(self, nodes, tt=None):
+        self.nodes = nodes
+        if tt is not None:
+            self.ttProbes += tt.probes
+            self.ttHits += tt.hits
+
+    def toDict(self):
+        timed = sum(self.phaseTimes.values())
+        return {"nodes": self.nodes, "seconds": round(self.elapsed, 4),
+                "nodesPerSecond": round(self.nodes / self.elapsed) if self.elapsed > 0 else 0,
+                "depths": [record.toDict() for record in self.depths],
+                "phases": {phase: {"seconds": round(self.phaseTimes[phase], 4), "calls": self.phaseCalls[phase]}
+                           for phase in PHASES},
+                "otherSeconds": round(max(self.elapsed - timed, 0.0), 4),
+                "ttHitRate": round(self.ttHits / self.ttProbes, 3) if self.ttProbes else 0.0}
+
+    def toJson(self):
+        return json.dumps(self.toDict())
+
+    """
+    One line for logs
+    """
+
+    def summary(self):
+        data = self.toDict()
+        deepest = data["depths"][-1] if data["depths"] else {}
+        phases = "  ".join("%s %.2fs" % (phase, values["seconds"]) for phase, values in data["phases"].items())
+        return "depth %s  nodes %d  %d nps  ebf %s  first cutoff %.0f%%  tt hits %.0f%%  %s  other %.2fs" % (
+            deepest.get("depth", 0), data["nodes"], data["nodesPerSecond"],
+            deepest.get("branchingFactor"), 100 * deepest.get("firstMoveCutoffRate", 0.0),
+            100 * data["ttHitRate"], phases, data["otherSeconds"])
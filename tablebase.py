@@ -0,0 +1,555 @@
+""" Endgame tablebases for 3 and 4 piece endings.
+Tables are generated here by retrograde analysis, working back from the
+mates with the move rules of chessEngine and the attack tables of
+bitboardEngine, and hold the distance to mate of every position.
+
+A table file is an 8 byte header followed by one byte per position:
+0 for a draw (or an impossible position), otherwise the distance to mate
+in plies plus one, the side to move winning when the distance is odd.
+Positions are indexed by side to move, then the white king's square
+folded by symmetry (10 squares without pawns, 32 with), then 64 squares
+for each other piece, so a 4 piece table without pawns takes 5 MB.
+Tables are memory mapped when probed. Generation is pure Python: the 3
+piece tables take seconds, a 4 piece table several minutes.
+
+    python tablebase.py generate             # every 3 piece table
+    python tablebase.py generate KQvKR KRvKB
+    python tablebase.py probe --fen "8/8/8/8/8/2k5/8/K2Q4 w - - 0 1"
+
+Castling, en passant and the 50 move rule are ignored, so positions with
+castling rights are not probed. Endings with pawns on both sides are not
+supported, that is where en passant would matter.
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+import chessEngine
+from bitboardEngine import KNIGHT_ATTACKS, KING_ATTACKS, PAWN_ATTACKS, rookAttacks, bishopAttacks
+
+TABLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tablebases")
+MAX_PIECES = 4
+HEADER = struct.Struct("<4sBBBB")  # magic, version, pieces, pawns, unused
+MAGIC = b"CETB"
+VERSION = 1
+PIECE_ORDER = "KQRBNP"
+THREE_PIECE_TABLES = ("KQvK", "KRvK", "KBvK", "KNvK", "KPvK")
+
+WIN, DRAW, LOSS = 1, 0, -1
+
+
+def buildTransforms():
+    # the 8 symmetries of the board as square maps
+    transforms = []
+    for flipRow in (False, True):
+        for flipCol in (False, True):
+            for swap in (False, True):
+                table = []
+                for sq in range(64):
+                    r, c = divmod(sq, 8)
+                    if swap:
+                        r, c = c, r
+                    if flipRow:
+                        r = 7 - r
+                    if flipCol:
+                        c = 7 - c
+                    table.append(r*8 + c)
+                transforms.append(table)
+    return transforms
+
+
+TRANSFORMS = buildTransforms()
+MIRROR_FILES = TRANSFORMS[2]
+# without pawns the white king is brought to the a1-d1-d4 triangle, with
+# pawns only files can be mirrored so it goes to the a-d files
+TRIANGLE = [sq for sq in range(64) if 7 - sq // 8 <= sq % 8 <= 3]
+QUEEN_SIDE = [sq for sq in range(64) if sq % 8 <= 3]
+
+
+def kingTransforms(region, transforms):
+    # for every king square, the symmetries taking it into the region
+    return [[t for t in transforms if t[sq] in region] for sq in range(64)]
+
+
+PAWNLESS_KING_TRANSFORMS = kingTransforms(TRIANGLE, TRANSFORMS)
+PAWN_KING_TRANSFORMS = kingTransforms(QUEEN_SIDE, [TRANSFORMS[0], MIRROR_FILES])
+
+
+""" Table name of a material balance, e.g. ("KQ", "KR") -> "KQvKR" """
+
+
+def sortPieces(pieces):
+    return "".join(sorted(pieces, key=PIECE_ORDER.index))
+
+
+def strength(pieces):
+    return (len(pieces), [-PIECE_ORDER.index(piece) for piece in pieces])
+
+
+""" The table holding a material balance and whether colors must be
+swapped to use it, the stronger side always being white in tables """
+
+
+def canonicalName(white, black):
+    white, black = sortPieces(white), sortPieces(black)
+    if strength(white) >= strength(black):
+        return white + "v" + black, False
+    return black + "v" + white, True
+
+
+class Layout():
+    """ How positions of one material balance map to table indexes """
+
+    def __init__(self, name):
+        white, black = name.split("v")
+        self.name = name
+        self.colors = ['w'] * len(white) + ['b'] * len(black)
+        self.types = [('p' if piece == 'P' else piece) for piece in white + black]
+        self.pieceCount = len(self.types)
+        self.hasPawns = 'p' in self.types
+        self.kingTransforms = PAWN_KING_TRANSFORMS if self.hasPawns else PAWNLESS_KING_TRANSFORMS
+        region = QUEEN_SIDE if self.hasPawns else TRIANGLE
+        self.regionSquares = region
+        self.regionIndex = {sq: i for i, sq in enumerate(region)}
+        self.half = len(region) * 64 ** (self.pieceCount - 1)
+        self.size = 2 * self.half
+        self.blackKing = len(white)
+
+    """
+    Index of a position, squares listed in the layout's piece order
+    """
+
+    def index(self, squares, whiteToMove):
+        best = None
+        for transform in self.kingTransforms[squares[0]]:
+            index = self.regionIndex[transform[squares[0]]]
+            for sq in squares[1:]:
+                index = index*64 + transform[sq]
+            if best is None or index < best:
+                best = index
+        return best if whiteToMove else best + self.half
+
+    def decode(self, index):
+        whiteToMove = index < self.half
+        if not whiteToMove:
+            index -= self.half
+        squares = []
+        for _ in range(self.pieceCount - 1):
+            index, sq = divmod(index, 64)
+            squares.append(sq)
+        squares.append(self.regionSquares[index])
+        squares.reverse()
+        return squares, whiteToMove
+
+
+""" True if the king of color is attacked in the position """
+
+
+def kingAttacked(types, colors, squares, color):
+    king = None
+    occupancy = 0
+    for i, sq in enumerate(squares):
+        occupancy |= 1 << sq
+        if types[i] == 'K' and colors[i] == color:
+            king = squares[i]
+    for i, sq in enumerate(squares):
+        if colors[i] == color:
+            continue
+        pieceType = types[i]
+        if pieceType == 'K':
+            attacks = KING_ATTACKS[sq]
+        elif pieceType == 'N':
+            attacks = KNIGHT_ATTACKS[sq]
+        elif pieceType == 'p':
+            attacks = PAWN_ATTACKS[colors[i]][sq]
+        elif pieceType == 'R':
+            attacks = rookAttacks(sq, occupancy)
+        elif pieceType == 'B':
+            attacks = bishopAttacks(sq, occupancy)
+        else:
+            attacks = rookAttacks(sq, occupancy) | bishopAttacks(sq, occupancy)
+        if attacks >> king & 1:
+            return True
+    return False
+
+
+""" Pseudo legal moves of the side to move as (piece, to square,
+captured piece or None, promotion type or None) """
+
+
+def pseudoMoves(types, colors, squares, color):
+    occupancy = own = 0
+    for i, sq in enumerate(squares):
+        occupancy |= 1 << sq
+        if colors[i] == color:
+            own |= 1 << sq
+    moves = []
+    for i, sq in enumerate(squares):
+        if colors[i] != color:
+            continue
+        pieceType = types[i]
+        if pieceType == 'p':
+            targets = PAWN_ATTACKS[color][sq] & occupancy & ~own
+            step = -8 if color == 'w' else 8
+            if not occupancy >> (sq+step) & 1:
+                targets |= 1 << (sq+step)
+                startRow = 6 if color == 'w' else 1
+                if sq // 8 == startRow and not occupancy >> (sq+2*step) & 1:
+                    targets |= 1 << (sq+2*step)
+        elif pieceType == 'K':
+            targets = KING_ATTACKS[sq] & ~own
+        elif pieceType == 'N':
+            targets = KNIGHT_ATTACKS[sq] & ~own
+        elif pieceType == 'R':
+            targets = rookAttacks(sq, occupancy) & ~own
+        elif pieceType == 'B':
+            targets = bishopAttacks(sq, occupancy) & ~own
+        else:
+            targets = (rookAttacks(sq, occupancy) | bishopAttacks(sq, occupancy)) & ~own
+        while targets:
+            low = targets & -targets
+            target = low.bit_length() - 1
+            targets ^= low
+            captured = squares.index(target) if occupancy >> target & 1 else None
+            if pieceType == 'p' and target // 8 in (0, 7):
+                for promotion in "QRBN":
+                    moves.append((i, target, captured, promotion))
+            else:
+                moves.append((i, target, captured, None))
+    return moves
+
+
+""" Squares a piece may have come from by a quiet move (no capture, no
+promotion) to sq """
+
+
+def retroSources(pieceType, color, sq, occupancy):
+    if pieceType == 'K':
+        sources = KING_ATTACKS[sq]
+    elif pieceType == 'N':
+        sources = KNIGHT_ATTACKS[sq]
+    elif pieceType == 'R':
+        sources = rookAttacks(sq, occupancy)
+    elif pieceType == 'B':
+        sources = bishopAttacks(sq, occupancy)
+    elif pieceType == 'Q':
+        sources = rookAttacks(sq, occupancy) | bishopAttacks(sq, occupancy)
+    else:
+        step = 8 if color == 'w' else -8  # backwards
+        sources = 0
+        back = sq + step
+        if 8 <= back < 56 and not occupancy >> back & 1:
+            sources |= 1 << back
+            doubleRow = 4 if color == 'w' else 3
+            if sq // 8 == doubleRow and not occupancy >> (back+step) & 1:
+                sources |= 1 << (back+step)
+    return sources & ~occupancy
+
+
+class Tablebases():
+    """ Loaded tables by name, each a Layout and a byte buffer """
+
+    def __init__(self, directory=TABLE_DIR):
+        self.directory = directory
+        self.tables = {}
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".tb")
+
+    """
+    (Layout, buffer) of a table, mapping the file on first use. None when
+    the table does not exist
+    """
+
+    def getTable(self, name):
+        if name not in self.tables:
+            table = None
+            path = self.path(name)
+            if os.path.exists(path):
+                with open(path, "rb") as tableFile:
+                    data = mmap.mmap(tableFile.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, version, _, _, _ = HEADER.unpack_from(data, 0)
+                if magic == MAGIC and version == VERSION:
+                    table = (Layout(name), data)
+            self.tables[name] = table
+        return self.tables[name]
+
+    def hasAnyTable(self):
+        return os.path.isdir(self.directory) and any(
+            fileName.endswith(".tb") for fileName in os.listdir(self.directory))
+
+    """
+    Stored value of a position given as pieces ('w', 'Q') and squares, or
+    None without a table. Bare kings are always drawn
+    """
+
+    def probeValue(self, pieces, squares, whiteToMove):
+        white = "".join('P' if t == 'p' else t for c, t in pieces if c == 'w')
+        black = "".join('P' if t == 'p' else t for c, t in pieces if c == 'b')
+        if white == "K" and black == "K":
+            return 0
+        name, swapColors = canonicalName(white, black)
+        table = self.getTable(name)
+        if table is None:
+            return None
+        layout, data = table
+        if swapColors:
+            pieces = [('b' if c == 'w' else 'w', t) for c, t in pieces]
+            squares = [sq ^ 56 for sq in squares]  # mirror the ranks
+            whiteToMove = not whiteToMove
+        # put the squares in the layout's piece order
+        remaining = list(zip(pieces, squares))
+        ordered = []
+        for color, pieceType in zip(layout.colors, layout.types):
+            for i, (piece, sq) in enumerate(remaining):
+                if piece == (color, pieceType):
+                    ordered.append(sq)
+                    del remaining[i]
+                    break
+        return data[HEADER.size + layout.index(ordered, whiteToMove)]
+
+    """
+    Probe a game state: None when it is not covered, else (outcome, plies)
+    with outcome WIN, DRAW or LOSS for the side to move and plies the
+    distance to mate
+    """
+
+    def probe(self, gs):
+        if gs.castleRights != 0:
+            return None
+        pieces = []
+        squares = []
+        for r in range(8):
+            for c in range(8):
+                piece = gs.board[r][c]
+                if piece != "--":
+                    pieces.append((piece[0], piece[1]))
+                    squares.append(r*8 + c)
+        if len(pieces) > MAX_PIECES:
+            return None
+        value = self.probeValue(pieces, squares, gs.whiteToMove)
+        if value is None:
+            return None
+        if value == 0:
+            return DRAW, 0
+        plies = value - 1
+        return (WIN if plies % 2 else LOSS), plies
+
+    """
+    Build a table by retrograde analysis and write it to the table
+    directory, building the tables it converts into (captures and
+    promotions) first. Returns the number of positions won, lost, drawn
+    """
+
+    def generate(self, name, log=None):
+        layout = Layout(name)
+        if layout.hasPawns and 'p' in layout.types[:layout.blackKing] and 'p' in layout.types[layout.blackKing:]:
+            raise ValueError("endings with pawns on both sides are not supported: " + name)
+        for dependency in conversions(layout):
+            if self.getTable(dependency) is None:
+                self.generate(dependency, log)
+        startTime = time.time()
+        values = retrogradeAnalysis(layout, self)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(name), "wb") as out:
+            out.write(HEADER.pack(MAGIC, VERSION, layout.pieceCount, layout.hasPawns, 0))
+            out.write(values)
+        self.tables.pop(name, None)
+        wins = losses = 0
+        for value in values:
+            if value:
+                if value % 2 == 0:
+                    wins += 1
+                else:
+                    losses += 1
+        if log is not None:
+            log.write("%s: %d positions, %d won, %d lost, %.1fs\n" % (
+                name, layout.size, wins, losses, time.time() - startTime))
+        return wins, losses, layout.size - wins - losses
+
+
+""" Tables a material balance can convert into by a capture or promotion """
+
+
+def conversions(layout):
+    white = [t for c, t in zip(layout.colors, layout.types) if c == 'w']
+    black = [t for c, t in zip(layout.colors, layout.types) if c == 'b']
+    names = set()
+    for side, other in ((white, black), (black, white)):
+        for i, pieceType in enumerate(side):
+            if pieceType != 'K':
+                # captured by the other side
+                remaining = side[:i] + side[i+1:]
+                names.add(canonicalPair(remaining, other))
+            if pieceType == 'p':
+                for promotion in "QRBN":
+                    names.add(canonicalPair(side[:i] + [promotion] + side[i+1:], other))
+    names.discard("KvK")
+    return sorted(names, key=len)
+
+
+def canonicalPair(side, other):
+    name, _ = canonicalName("".join('P' if t == 'p' else t for t in side),
+                            "".join('P' if t == 'p' else t for t in other))
+    return name
+
+
+""" Distance to mate of every position of a layout, as a bytearray in the
+table format. Positions are first scored from their own moves (mates,
+stalemates and conversions into smaller tables), then results spread
+backwards through un-moves in order of distance """
+
+
+def retrogradeAnalysis(layout, tablebases):
+    size = layout.size
+    types, colors = layout.types, layout.colors
+    values = bytearray(size)
+    done = bytearray(size)  # resolved, or not a legal position
+    counts = bytearray(size)  # distinct quiet moves not yet known to lose
+    exitLoss = bytearray(size)  # longest losing conversion, in plies
+    winExit = bytearray(size)  # a conversion wins
+    CANNOT_LOSE = 255
+    buckets = []
+
+    def push(distance, index):
+        while len(buckets) <= distance:
+            buckets.append(array('L'))
+        buckets[distance].append(index)
+
+    for index in range(size):
+        squares, whiteToMove = layout.decode(index)
+        color = 'w' if whiteToMove else 'b'
+        enemy = 'b' if whiteToMove else 'w'
+        if (len(set(squares)) != len(squares) or layout.index(squares, whiteToMove) != index or
+                any(t == 'p' and sq // 8 in (0, 7) for t, sq in zip(types, squares)) or
+                kingAttacked(types, colors, squares, enemy)):
+            done[index] = 1
+            continue
+        children = set()
+        legalMoves = 0
+        cannotLose = False
+        for piece, target, captured, promotion in pseudoMoves(types, colors, squares, color):
+            childSquares = list(squares)
+            childSquares[piece] = target
+            if captured is None and promotion is None:
+                if kingAttacked(types, colors, childSquares, color):
+                    continue
+                legalMoves += 1
+                children.add(layout.index(childSquares, not whiteToMove))
+                continue
+            childPieces = list(zip(colors, types))
+            if promotion is not None:
+                childPieces[piece] = (color, promotion)
+            if captured is not None:
+                del childPieces[captured]
+                del childSquares[captured]
+            if kingAttacked([t for _, t in childPieces], [c for c, _ in childPieces], childSquares, color):
+                continue
+            legalMoves += 1
+            value = tablebases.probeValue(childPieces, childSquares, not whiteToMove)
+            if not value:
+                cannotLose = True
+            elif value % 2 == 1:  # child side to move loses in value-1 plies
+                winExit[index] = 1
+                push(value, index)
+            else:
+                exitLoss[index] = max(exitLoss[index], value - 1)
+        if legalMoves == 0:
+            if kingAttacked(types, colors, squares, color):
+                push(0, index)  # checkmated
+            else:
+                done[index] = 1  # stalemate
+            continue
+        counts[index] = CANNOT_LOSE if cannotLose else len(children)
+        if counts[index] == 0 and not winExit[index]:
+            push(exitLoss[index] + 1, index)
+
+    distance = 0
+    while distance < len(buckets):
+        for index in buckets[distance]:
+            if done[index]:
+                continue
+            if distance + 1 > 255:
+                raise OverflowError("distance to mate does not fit the table format")
+            done[index] = 1
+            values[index] = distance + 1
+            for previous in predecessors(layout, index):
+                if done[previous]:
+                    continue
+                if distance % 2 == 0:  # lost here, so won by moving here
+                    push(distance + 1, previous)
+                elif counts[previous] != CANNOT_LOSE:
+                    counts[previous] -= 1
+                    if counts[previous] == 0 and not winExit[previous]:
+                        push(max(distance, exitLoss[previous]) + 1, previous)
+        buckets[distance] = None
+        distance += 1
+    return values
+
+
+""" Indexes of the positions that reach this one by a quiet move """
+
+
+def predecessors(layout, index):
+    squares, whiteToMove = layout.decode(index)
+    mover = 'b' if whiteToMove else 'w'
+    occupancy = 0
+    for sq in squares:
+        occupancy |= 1 << sq
+    found = set()
+    for i, sq in enumerate(squares):
+        if layout.colors[i] != mover:
+            continue
+        sources = retroSources(layout.types[i], mover, sq, occupancy)
+        while sources:
+            low = sources & -sources
+            sources ^= low
+            previous = list(squares)
+            previous[i] = low.bit_length() - 1
+            found.add(layout.index(previous, not whiteToMove))
+    return found
+
+
+# tables used by the search, opened lazily
+tablebases = Tablebases()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate or probe endgame tablebases")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate = commands.add_parser("generate", help="build tables, every 3 piece table by default")
+    generate.add_argument("names", nargs="*", help="tables such as KQvKR")
+    probe = commands.add_parser("probe", help="look a position up")
+    probe.add_argument("--fen", required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        for name in args.names or THREE_PIECE_TABLES:
+            tablebases.generate(name, sys.stderr)
+        return 0
+
+    gs = chessEngine.GameState()
+    try:
+        gs.loadFen(args.fen)
+    except ValueError as error:
+        print(error)
+        return 1
+    result = tablebases.probe(gs)
+    if result is None:
+        print("not in the tablebases")
+        return 1
+    outcome, plies = result
+    if outcome == DRAW:
+        print("draw")
+    else:
+        print("%s, mate in %d plies" % ("win" if outcome == WIN else "loss", plies))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+""" Fixed size transposition table for the search in moveAI.
+Entries live in two flat arrays of unsigned 64 bit integers (the zobrist
+key and a packed data word) instead of a dict of objects, so the memory
+used is exactly the budget asked for. """
+
+from array import array
+
+# bound types of a stored score
+EXACT = 0
+LOWER = 1  # the score is at least this (fail high)
+UPPER = 2  # the score is at most this (fail low)
+
+ENTRY_BYTES = 16  # one key word and one data word
+SLOTS_PER_BUCKET = 2  # slot 0 prefers depth, slot 1 is always replaced
+SCORE_OFFSET = 1 << 15  # scores are stored as unsigned 16 bit values
+GENERATIONS = 1 << 6
+
+# data word layout, from the low bits up:
+# packed move (16 bits, 0 = no move) | score (16) | depth (8) | bound (2) | generation (6)
+
+
+class TranspositionTable():
+    def __init__(self, sizeMB=16):
+        buckets = 1
+        # largest power of two number of buckets that fits the budget
+        while buckets * 2 * SLOTS_PER_BUCKET * ENTRY_BYTES <= sizeMB * 1024 * 1024:
+            buckets *= 2
+        self.bucketMask = buckets - 1
+        self.size = buckets * SLOTS_PER_BUCKET
+        self.keys = array('Q', bytes(8 * self.size))
+        self.data = array('Q', bytes(8 * self.size))
+        self.generation = 0
+        self.resetStats()
+
+    def resetStats(self):
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+        # stores that overwrote a live entry of a different position
+        self.collisions = 0
+
+    """
+    Clear every entry, e.g. for a new game
+    """
+
+    def clear(self):
+        self.keys = array('Q', bytes(8 * self.size))
+        self.data = array('Q', bytes(8 * self.size))
+        self.generation = 0
+        self.resetStats()
+
+    """
+    Called once per AI move so entries from earlier searches age and
+    become the first to be replaced
+    """
+
+    def newSearch(self):
+        self.generation = (self.generation + 1) % GENERATIONS
+
+    """
+    Look a position up. Returns (depth, score, bound, packedMove) or None,
+    packedMove being 0 when no best move was stored
+    """
+
+    def probe(self, key):
+        self.probes += 1
+        index = (key & self.bucketMask) * SLOTS_PER_BUCKET
+        keys = self.keys
+        for slot in range(index, index + SLOTS_PER_BUCKET):
+            if keys[slot] == key:
+                word = self.data[slot]
+                if word == 0:
+                    continue
+                self.hits += 1
+                return ((word >> 32) & 0xFF, ((word >> 16) & 0xFFFF) - SCORE_OFFSET,
+                        (word >> 40) & 0x3, word & 0xFFFF)
+        return None
+
+    """
+    Store a search result. The depth preferred slot keeps the deepest
+    entry of the current generation, everything else goes to the always
+    replace slot
+    """
+
+    def store(self, key, depth, score, bound, packedMove=0):
+        self.stores += 1
+        index = (key & self.bucketMask) * SLOTS_PER_BUCKET
+        keys, data = self.keys, self.data
+        word = (packedMove |
+                (score + SCORE_OFFSET) << 16 | min(depth, 0xFF) << 32 |
+                bound << 40 | self.generation << 42)
+        oldWord = data[index]
+        if (keys[index] == key or oldWord == 0 or
+                (oldWord >> 42) != self.generation or ((oldWord >> 32) & 0xFF) <= depth):
+            slot = index
+        else:
+            slot = index + 1
+        if keys[slot] == key and packedMove == 0:
+            # keep the best move of an earlier search of this position
+            word |= data[slot] & 0xFFFF
+        elif keys[slot] != key and data[slot] != 0:
+            self.collisions += 1
+        keys[slot] = key
+        data[slot] = word
+
+    """
+    Hit rate, collisions and how full the table is, for logging
+    """
+
+    def getStats(self):
+        used = sum(1 for word in self.data if word != 0)
+        return {"sizeEntries": self.size,
+                "probes": self.probes,
+                "hits": self.hits,
+                "hitRate": self.hits / self.probes if self.probes else 0.0,
+                "stores": self.stores,
+                "collisions": self.collisions,
+                "fill": used / self.size}
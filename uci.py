@@ -0,0 +1,212 @@
+""" Headless UCI front end, for chess GUIs, match runners and servers
+without a display. Reads commands on stdin and answers on stdout; pygame
+is never imported.
+
+    python uci.py
+
+Supported: uci, isready, setoption name Hash, ucinewgame,
+position startpos|fen <fen> [moves ...], go [depth|movetime|wtime|btime|
+winc|binc|movestogo|infinite], stop and quit. The search runs on a thread
+so stop and isready are answered while it thinks.
+"""
+
+import sys
+import threading
+
+import chessEngine
+import moveAI
+from transpositionTable import TranspositionTable
+
+ENGINE_NAME = "chessEngine"
+ENGINE_AUTHOR = "hack-panda"
+STARTING_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+MAX_DEPTH = 64  # depth for searches limited only by time
+MOVES_TO_GO = 30  # moves the remaining clock is shared over when not given
+MOVE_OVERHEAD = 0.05  # seconds kept back per move for lag
+
+
+""" Seconds to think for a go command, or None to search without a clock """
+
+
+def allocateTime(params, whiteToMove):
+    if "movetime" in params:
+        return max(params["movetime"] / 1000 - MOVE_OVERHEAD, 0.01)
+    remaining = params.get("wtime" if whiteToMove else "btime")
+    if remaining is None:
+        return None
+    increment = params.get("winc" if whiteToMove else "binc", 0)
+    movesToGo = params.get("movestogo", MOVES_TO_GO)
+    budget = remaining / movesToGo + increment * 3 / 4
+    # never plan to use more than half of what is left
+    return max(min(budget, remaining / 2) / 1000 - MOVE_OVERHEAD, 0.01)
+
+
+""" UCI score text: centipawns, or moves to mate (negative when being mated) """
+
+
+def formatScore(score):
+    if score > moveAI.MATE_BOUND:
+        return "mate %d" % ((moveAI.CHECKMATE - score + 1) // 2)
+    if score < -moveAI.MATE_BOUND:
+        return "mate %d" % -((moveAI.CHECKMATE + score) // 2)
+    return "cp %d" % score
+
+
+class UciEngine():
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.outputLock = threading.Lock()
+        self.gs = chessEngine.GameState()
+        self.searcher = None
+        self.searchThread = None
+        # set by stop so an infinite search can send its bestmove
+        self.stopRequested = threading.Event()
+
+    def send(self, line):
+        with self.outputLock:
+            self.out.write(line + "\n")
+            self.out.flush()
+
+    """
+    Handle one command line. Returns False when the engine should quit
+    """
+
+    def handle(self, line):
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, args = tokens[0], tokens[1:]
+        if command == "uci":
+            self.send("id name " + ENGINE_NAME)
+            self.send("id author " + ENGINE_AUTHOR)
+            self.send("option name Hash type spin default %d min 1 max 1024" % moveAI.TT_SIZE_MB)
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "setoption":
+            self.setOption(args)
+        elif command == "ucinewgame":
+            self.stopSearch()
+            self.gs = chessEngine.GameState()
+            moveAI.transpositionTable.clear()
+        elif command == "position":
+            self.stopSearch()
+            self.setPosition(args)
+        elif command == "go":
+            self.stopSearch()
+            self.go(args)
+        elif command == "stop":
+            self.stopSearch()
+        elif command == "quit":
+            self.stopSearch()
+            return False
+        return True
+
+    def setOption(self, args):
+        text = " ".join(args)
+        if not text.startswith("name ") or " value " not in text:
+            return
+        name, value = text[5:].split(" value ", 1)
+        if name.strip().lower() == "hash":
+            try:
+                sizeMB = int(value)
+            except ValueError:
+                return
+            self.stopSearch()
+            moveAI.transpositionTable = TranspositionTable(max(1, min(sizeMB, 1024)))
+
+    def setPosition(self, args):
+        if "moves" in args:
+            split = args.index("moves")
+            args, moves = args[:split], args[split+1:]
+        else:
+            moves = []
+        if args[:1] == ["startpos"]:
+            fen = STARTING_FEN
+        elif args[:1] == ["fen"]:
+            fen = " ".join(args[1:])
+        else:
+            return
+        try:
+            self.gs.loadFen(fen)
+        except ValueError as e:
+            self.send("info string bad fen: %s" % e)
+            return
+        for text in moves:
+            move = self.gs.parseMove(text)
+            if move is None:
+                self.send("info string illegal move " + text)
+                return
+            self.gs.makeMove(move)
+
+    def go(self, args):
+        params = {}
+        infinite = False
+        i = 0
+        while i < len(args):
+            if args[i] == "infinite":
+                infinite = True
+            elif args[i] in ("depth", "movetime", "wtime", "btime", "winc", "binc", "movestogo") \
+                    and i + 1 < len(args):
+                try:
+                    params[args[i]] = int(args[i+1])
+                except ValueError:
+                    pass
+                i += 1
+            i += 1
+        depth = params.get("depth", MAX_DEPTH)
+        timeLimit = None if infinite else allocateTime(params, self.gs.whiteToMove)
+        validMoves = self.gs.getValidMoves()
+        if not validMoves:
+            self.send("bestmove 0000")
+            return
+        bookMove = None if infinite or "depth" in params else moveAI.findBookMove(self.gs, validMoves)
+        if bookMove is not None:
+            self.send("bestmove " + bookMove.getChessNotation())
+            return
+        self.searcher = moveAI.Searcher(timeLimit, moveAI.transpositionTable, moveAI.moveOrderer)
+        self.searcher.onIteration = self.sendInfo
+        self.stopRequested.clear()
+        self.searchThread = threading.Thread(target=self.runSearch, args=(validMoves, depth, infinite),
+                                             daemon=True)
+        self.searchThread.start()
+
+    def runSearch(self, validMoves, depth, infinite):
+        result = self.searcher.search(self.gs, validMoves, depth)
+        if infinite:
+            # UCI: an infinite search only reports its move once stopped
+            self.stopRequested.wait()
+        self.send("bestmove " + result.bestMove.getChessNotation())
+
+    def sendInfo(self, result):
+        elapsed = max(result.elapsed, 1e-6)
+        self.send("info depth %d score %s nodes %d nps %d time %d pv %s" % (
+            result.depth, formatScore(result.score), result.nodes, result.nodes / elapsed,
+            elapsed * 1000, " ".join(move.getChessNotation() for move in result.pv)))
+
+    """
+    Stop a running search and wait for its bestmove to be sent
+    """
+
+    def stopSearch(self):
+        if self.searchThread is None:
+            return
+        self.stopRequested.set()
+        while self.searchThread.is_alive():
+            # set again until the search sees it, it clears the flag as it starts
+            self.searcher.stopped = True
+            self.searchThread.join(0.01)
+        self.searchThread = None
+
+
+def main():
+    engine = UciEngine()
+    for line in sys.stdin:
+        if not engine.handle(line):
+            break
+    engine.stopSearch()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())